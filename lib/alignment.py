@@ -0,0 +1,131 @@
+import numpy as np
+
+
+# time aligned table of a recording: one row per eeg row, with heart_rate and acc resampled to the receive time of
+# the eeg row (linear interpolation between the two samples around it, or the last sample before it) and
+# signal_quality, ica and drlref forward filled (their changes are stored by eeg row already, lib/side_channels.py)
+#
+# Stream_Aligner is fed block by block, while recording (--aligned_file, lib/record_to_file.py) after every write
+# or with a whole recording at once (align_recording(), tools/align_export.py). an eeg row is ready when every
+# sample stream has a sample received after it and the side channel changes are known up to it. a stream that
+# has nothing newer for HOLD_SECONDS (stopped) holds its last value, before its first sample it is nan.
+#
+# lags: the muse computes the ica from the past second of eeg, its values arrive about 1s after the eeg rows they
+# belong to (--ica_lag). the changes of a side channel with a lag are moved back by it, so the table waits for them.
+
+HOLD_SECONDS = 2.0
+NOMINAL_RATES = {'eeg': 256, 'heart_rate': 64, 'acc': 52}
+
+
+def column_names(stream, columns):
+    """ column names in the aligned table: acc x -> acc_x, eeg and heart_rate_1 stay """
+    return [c if stream == 'eeg' or c.startswith(stream) else f"{stream}_{c}" for c in columns]
+
+
+class Stream_Aligner:
+
+    def __init__(self, eeg_columns, streams, changes, eeg_rate=256, lags=None, method='linear'):
+        """ streams / changes: name -> columns of the sample streams / side channels. method: 'linear' or 'previous' """
+        self.method = method
+        # in eeg rows
+        self.lags = {name: int(round((lags or {}).get(name, 0) * eeg_rate)) for name in changes}
+        self.columns = ['time'] + column_names('eeg', eeg_columns)
+        for name, columns in list(streams.items()) + list(changes.items()):
+            self.columns += column_names(name, columns)
+
+        self.row = 0            # eeg row of the first pending eeg sample
+        self.eeg_times = np.zeros(0)
+        self.eeg = np.zeros((0, len(eeg_columns)))
+        self.samples = {name: (np.zeros(0), np.zeros((0, len(columns)))) for name, columns in streams.items()}
+        self.changes = {name: (np.zeros(0, dtype=np.int64), np.zeros((0, len(columns)))) for name, columns in changes.items()}
+        self.known = {name: 0 for name in changes}      # the changes of a side channel are complete before this row
+
+    def add_eeg(self, rows, times):
+        self.eeg = np.concatenate((self.eeg, rows))
+        self.eeg_times = np.concatenate((self.eeg_times, times))
+
+    def add_samples(self, name, rows, times):
+        """ rows of a sample stream with their receive times (same clock as the eeg) """
+        old_times, old_rows = self.samples[name]
+        self.samples[name] = (np.concatenate((old_times, times)), np.concatenate((old_rows, rows)))
+
+    def add_changes(self, name, rows, values, upto):
+        """ changes of a side channel (eeg row, value), all changes before eeg row 'upto' are known """
+        lag = self.lags[name]
+        old_rows, old_values = self.changes[name]
+        self.changes[name] = (np.concatenate((old_rows, np.asarray(rows, dtype=np.int64) - lag)),
+                              np.concatenate((old_values, np.reshape(values, (len(rows), old_values.shape[1])))))
+        self.known[name] = upto - lag
+
+    def _ready(self, final):
+        """ number of pending eeg rows that can be aligned """
+        n = len(self.eeg_times)
+        if final or n == 0:
+            return n
+        ready = n
+        held = np.searchsorted(self.eeg_times, self.eeg_times[-1] - HOLD_SECONDS, 'left')
+        for times, _ in self.samples.values():
+            covered = np.searchsorted(self.eeg_times, times[-1], 'right') if len(times) else 0
+            ready = min(ready, max(covered, held))
+        for name, known in self.known.items():
+            ready = min(ready, max(known - self.row, 0))
+        return int(ready)
+
+    def _resample(self, times, values, t):
+        if len(times) == 0:
+            return np.full((len(t), values.shape[1]), np.nan)
+        if self.method == 'linear':
+            return np.column_stack([np.interp(t, times, values[:, c], left=np.nan) for c in range(values.shape[1])])
+        index = np.searchsorted(times, t, 'right') - 1
+        return np.where((index >= 0)[:, None], values[np.maximum(index, 0)], np.nan)
+
+    def take(self, final=False):
+        """ the aligned rows that are ready (rows x columns, float64). final: all pending rows (end of recording) """
+        ready = self._ready(final)
+        t = self.eeg_times[:ready]
+        table = [t[:, None], self.eeg[:ready]]
+        for name, (times, values) in self.samples.items():
+            table.append(self._resample(times, values, t))
+        rows = self.row + np.arange(ready)
+        for name, (change_rows, values) in self.changes.items():
+            index = np.searchsorted(change_rows, rows, 'right') - 1
+            table.append(np.where((index >= 0)[:, None], values[np.maximum(index, 0)], np.nan) if len(values)
+                         else np.full((ready, values.shape[1]), np.nan))
+
+        # the pending rows, and what the next rows are interpolated from / filled with
+        self.eeg_times = self.eeg_times[ready:]
+        self.eeg = self.eeg[ready:]
+        self.row += ready
+        if ready:
+            for name, (times, values) in self.samples.items():
+                keep = max(np.searchsorted(times, t[-1], 'right') - 1, 0)
+                self.samples[name] = (times[keep:], values[keep:])
+            for name, (change_rows, values) in self.changes.items():
+                keep = max(np.searchsorted(change_rows, self.row, 'right') - 1, 0)
+                self.changes[name] = (change_rows[keep:], values[keep:])
+        return np.hstack(table)
+
+
+def stream_times(arrays, meta, stream):
+    """ receive times of a stream (--add_time_column), or its nominal sampling rate from the first eeg sample on """
+    if f"{stream}_time" in arrays:
+        return np.asarray(arrays[f"{stream}_time"], dtype=np.float64)
+    rate = meta['streams'][stream].get('nominal_rate') or NOMINAL_RATES[stream]
+    return np.arange(len(arrays[stream])) / rate
+
+
+def align_recording(meta, arrays, lags=None, method='linear'):
+    """ (columns, table) of a recording read with lib/archive_reader.py """
+    streams = {name: meta['streams'][name]['columns'] for name in ('heart_rate', 'acc') if name in meta['streams']}
+    changes = {name: meta['streams'][name]['columns'] for name in ('signal_quality', 'ica', 'drlref') if name in meta['streams']}
+    aligner = Stream_Aligner(meta['streams']['eeg']['columns'], streams, changes, lags=lags, method=method)
+
+    aligner.add_eeg(np.asarray(arrays['eeg'], dtype=np.float64), stream_times(arrays, meta, 'eeg'))
+    for name in streams:
+        aligner.add_samples(name, np.asarray(arrays[name], dtype=np.float64), stream_times(arrays, meta, name))
+    for name in changes:
+        values = arrays[name]
+        # one row per change, or one row per eeg row (--expand_side_channels)
+        rows = arrays.get(f"{name}_eeg_row", np.arange(len(values)))
+        aligner.add_changes(name, rows, values, len(arrays['eeg']))
+    return aligner.columns, aligner.take(final=True)
@@ -0,0 +1,187 @@
+import io
+import itertools
+import json
+import os
+import re
+import zipfile
+
+import numpy as np
+
+from lib.binary_format import read_binary_bytes
+from lib.edf_format import read_edf_bytes
+
+
+# reads a recording (zip file of the recorder) into numpy arrays, without extracting it: the members are parsed
+# while they are decompressed (tools/zip_to_npz.py, tools/align_export.py)
+#
+# arrays: one per stream ('eeg', 'heart_rate', 'acc': float32 samples x columns), the receive times of
+# --add_time_column as '<stream>_time' (seconds since the first eeg sample). the side channels ('signal_quality',
+# 'ica', 'drlref') as float64 values, one row per change with the eeg row in '<side channel>_eeg_row' (or one row per
+# eeg row with --expand_side_channels). segments (--segment_minutes) are joined. the .edf / .bdf file of
+# --format edf / bdf holds eeg, heart_rate and acc (its annotations are in meta).
+#
+# meta: the columns, files and rows of every stream, manifest.json / recovery.json / notes.txt if the zip file has them
+
+# member name -> stream: eeg_2024.10.18_11.06_eeg.csv, .._accelerator_002.bin (segment 2)
+MEMBER = re.compile(r'_(eeg|heart_rate|accelerator|ica|signal_quality|drlref)(?:_(\d{3}))?\.(csv|bin|edf|bdf)$')
+STREAMS = {'accelerator': 'acc'}
+SIDE_STREAMS = ('ica', 'signal_quality', 'drlref')
+
+
+def is_number(text):
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+
+def read_csv_member(zip_in, name, dtype):
+    """ (rows, header row or None) of a csv member, parsed while it is decompressed """
+    with zip_in.open(name) as raw:
+        text = io.TextIOWrapper(raw, newline='')
+        first = text.readline()
+        if first == '':
+            return np.zeros((0, 0), dtype=dtype), None
+        delimiter = '\t' if '\t' in first else ','
+        cells = first.strip().split(delimiter)
+        header = None if is_number(cells[0]) else cells
+        lines = text if header is not None else itertools.chain([first], text)
+        rows = np.loadtxt(lines, delimiter=delimiter, dtype=dtype, ndmin=2)
+        if rows.size == 0:
+            rows = np.zeros((0, len(cells)), dtype=dtype)
+        return rows, header
+
+
+def read_json_member(zip_in, name):
+    if name not in zip_in.namelist():
+        return None
+    return json.loads(zip_in.read(name).decode('utf-8'))
+
+
+def stream_members(zip_in):
+    """ stream -> its member names in segment order """
+    members = {}
+    for name in zip_in.namelist():
+        match = MEMBER.search(name)
+        if match is None:
+            continue
+        stream = STREAMS.get(match.group(1), match.group(1))
+        members.setdefault(stream, []).append((int(match.group(2) or 0), name))
+    return {stream: [name for _, name in sorted(names)] for stream, names in members.items()}
+
+
+def read_stream(zip_in, stream, names, known_columns):
+    """ (arrays, info) of one stream from its members """
+    side = stream in SIDE_STREAMS
+    blocks = []
+    columns = known_columns
+    for name in names:
+        if name.endswith('.bin'):
+            header, rows = read_binary_bytes(zip_in.read(name))
+            columns = header['columns']
+        else:
+            rows, header = read_csv_member(zip_in, name, np.float64 if side else np.float32)
+            if header is not None:
+                columns = header
+        if rows.shape[1] > 0:
+            blocks.append(rows)
+
+    width = max((rows.shape[1] for rows in blocks), default=len(columns or []))
+    samples = np.concatenate(blocks) if blocks else np.zeros((0, width), dtype=np.float64 if side else np.float32)
+    if not columns or len(columns) not in (width, width - 1):
+        columns = [f"c{i}" for i in range(width)]
+
+    arrays = {}
+    # the first column is 'time' (--add_time_column) or 'eeg_row' (the changes of a side channel)
+    if len(columns) == width - 1 or columns[0] in ('time', 'eeg_row'):
+        first = 'eeg_row' if side else 'time'
+        arrays[f"{stream}_{first}"] = samples[:, 0].astype(np.int64) if side else samples[:, 0]
+        samples = samples[:, 1:]
+        columns = [c for c in columns if c not in ('time', 'eeg_row')]
+    arrays[stream] = samples
+    info = {'columns': list(columns), 'files': list(names), 'rows': len(samples)}
+    return arrays, info
+
+
+def read_recording(path):
+    """ (meta, arrays) of a zip file of the recorder """
+    with zipfile.ZipFile(path) as zip_in:
+        manifest = read_json_member(zip_in, 'manifest.json')
+        meta = {
+            'zip': os.path.basename(path),
+            'manifest': manifest,
+            'recovery': read_json_member(zip_in, 'recovery.json'),
+            'notes': zip_in.read('notes.txt').decode('utf-8') if 'notes.txt' in zip_in.namelist() else None,
+            'streams': {},
+        }
+        arrays = {}
+        for stream, names in stream_members(zip_in).items():
+            if names[0].endswith(('.edf', '.bdf')):
+                edf_streams, meta['annotations'] = read_edf_bytes(zip_in.read(names[0]))
+                for name, (columns, samples) in edf_streams.items():
+                    arrays[name] = samples
+                    meta['streams'][name] = {'columns': columns, 'files': names, 'rows': len(samples)}
+            else:
+                known = manifest['streams'].get(stream, {}).get('columns') if manifest else None
+                stream_arrays, meta['streams'][stream] = read_stream(zip_in, stream, names, known)
+                arrays.update(stream_arrays)
+        if manifest:
+            for stream, info in meta['streams'].items():
+                info['nominal_rate'] = manifest['streams'].get(stream, {}).get('nominal_rate')
+    return meta, arrays
+
+
+def load_recording(path):
+    """ (meta, arrays) of a zip file of the recorder or of its .npz file (tools/zip_to_npz.py) """
+    if path.endswith('.npz'):
+        with np.load(path) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+        return json.loads(str(arrays.pop('meta'))), arrays
+    return read_recording(path)
+
+
+def find_files(paths, extensions=('.zip',)):
+    """
+    (file, folder) of the files with one of the extensions. folders are searched with their subfolders, folder is
+    the subfolder of the searched folder the file is in ('' for a file that was given itself)
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, _, names in os.walk(path):
+                relative = os.path.relpath(folder, path)
+                files += [(os.path.join(folder, name), '' if relative == '.' else relative)
+                          for name in sorted(names) if name.endswith(extensions)]
+        elif path.endswith(extensions):
+            files.append((path, ''))
+        else:
+            print(f" {path}: not a {' / '.join(extensions)} file or folder, skipped")
+    return files
+
+
+def output_path(path, folder, out, name):
+    """ the file 'name' next to path, or with --out in the same subfolder of out as path in the searched folder """
+    if out is None:
+        return os.path.join(os.path.dirname(path), name)
+    return os.path.join(out, folder, name)
+
+
+def unique_outputs(jobs):
+    """
+    (path, out_path) of jobs whose out_path no other job writes. two zip files with the same name that were given
+    as files, or in folders given with --out, would overwrite each other
+    """
+    paths = {}
+    for path, out_path in jobs:
+        paths.setdefault(out_path, []).append(path)
+    for out_path, sources in paths.items():
+        if len(sources) > 1:
+            print(f" {out_path}: would be written by {len(sources)} files ({', '.join(sources)}), skipped. "
+                  f"convert them into different --out folders")
+    return [(path, out_path) for path, out_path in jobs if len(paths[out_path]) == 1]
+
+
+def is_up_to_date(path, out_path):
+    """ out_path was written from path after its last change """
+    return os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(path)
@@ -0,0 +1,88 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from pythonosc.osc_server import AsyncIOOSCUDPServer
+
+from lib.devices import Sender_Router
+from lib.feedback import feedback_task
+from lib.osc_server import create_dispatcher
+from lib.record_to_file import is_recording, next_write_delay, write_all_devices
+from lib.statistics import init_stats, get_process_cpu_usage, print_stats
+
+
+# alternative runtime (--runtime asyncio)
+#
+# the default runtime starts one thread per task (osc server(s), writer, stats, feedback) and every thread polls
+# with its own time.sleep(). here the osc servers and the periodic tasks share one asyncio loop:
+#   - osc: pythonosc's AsyncIOOSCUDPServer, one per port (or one with the Sender_Router for --split_by_sender)
+#   - writer: sleeps until the first eeg sample arrives, then writes every --max_latency seconds while recording
+#     (earlier if a buffer fills up, lib/writer_wakeup.py). the session timeout is checked right when it is due.
+#     the writing runs in an executor thread
+#   - stats: refreshes the status line every 'refresh_interval' seconds
+#   - feedback (--feedback, --band_power): the osc handlers wake it up when samples for the detectors arrive (lib/feedback.py)
+# web server and terminal input stay threads (they block in their own loops).
+# --osc_engine is ignored, the packets are always decoded by pythonosc.
+
+
+async def writer_task(data, executor):
+    loop = asyncio.get_running_loop()
+    wakeup = data['conf']['wakeup']
+    if data['conf']['use_tabseparator_for_csv']:
+        csv_delimiter = '\t'
+    else:
+        csv_delimiter = ','
+
+    while True:
+        # nothing open: the first eeg sample wakes it up
+        wakeup.idle = not is_recording(data)
+        await wakeup.wait_async(next_write_delay(data))
+        await loop.run_in_executor(executor, write_all_devices, data, csv_delimiter)
+
+
+async def stats_task(data):
+    init_stats(data)
+    get_process_cpu_usage(data, 0)      # first call only starts the measurement
+    # also checks once per refresh if the programm is exiting (gracefully_end() from the input thread)
+    while not data['conf']['shutdown'].is_set():
+        await asyncio.sleep(data['stats']['refresh_interval'])
+        data['stats']['cpu'] = get_process_cpu_usage(data, 0)
+        print_stats(data)
+
+
+async def run_async(data):
+    loop = asyncio.get_running_loop()
+    data['conf']['wakeup'].use_asyncio()
+    if data['conf']['feedback_wakeup'] is not None:
+        data['conf']['feedback_wakeup'].use_asyncio()
+    # one thread for writing / packing, so the files are never written by two threads at once
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    if data['conf']['split_by_sender']:
+        # one port, the headbands are told apart by their ip address
+        data['source'] = {'name': '', 'port': data['conf']['port'][0]}
+        receivers = [(data['conf']['port'][0], Sender_Router(data, data['conf']['port'][0]))]
+    else:
+        receivers = [(dev['source']['port'], create_dispatcher(dev)) for dev in data['devices']]
+
+    transports = []
+    for port, dispatcher in receivers:
+        server = AsyncIOOSCUDPServer((data['conf']['ip'], port), dispatcher, loop)
+        transport, protocol = await server.create_serve_endpoint()
+        transports.append(transport)
+        print(f"Listening on port {port} for OSC messages (asyncio)... ")
+
+    tasks = [asyncio.create_task(writer_task(data, executor)), asyncio.create_task(stats_task(data))]
+    if data['conf']['feedback_wakeup'] is not None:
+        tasks.append(asyncio.create_task(feedback_task(data)))
+
+    try:
+        # returns when the stats task ended (exiting), all other tasks run forever
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()       # raises the exception of a failed task
+    finally:
+        for task in tasks:
+            task.cancel()
+        for transport in transports:
+            transport.close()
+        executor.shutdown(wait=True)
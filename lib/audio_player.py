@@ -0,0 +1,277 @@
+import collections
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+from lib.play_sound_termux import play_sound
+
+
+# plays the feedback sounds (lib/feedback.py) with one long-lived player instead of a new mpv per sound
+#
+# starting mpv and opening the audio device took hundreds of ms per sound on termux, and overlapping cues started
+# several mpv at once. the mpv backend starts one mpv in idle mode at startup and controls it through its json ipc
+# socket (set the volume, loadfile), the reader thread gets its events: a sound started when mpv sends
+# 'playback-restart', it ended with 'end-file'. --audio_backend:
+#   mpv:   one mpv for all sounds (needs AF_UNIX sockets, falls back to spawn if mpv can't be started)
+#   spawn: one mpv per sound (lib/play_sound_termux.py, the old way)
+#   stub:  plays nothing, the sounds are only recorded (no audio hardware, eg. for tests)
+#
+# the sounds are loaded at startup (checked, their path resolved, read once so they are in the file cache).
+# cues go through a queue to the player thread, so the feedback engine never waits for the audio. a cue of a sound
+# that is queued already is merged with it, a cue of the sound that is playing only raises its volume.
+#
+# latency: cue -> sound started, and the receive time of the sample the cue is for ('since') -> sound started, which
+# is passed to the callback of the cue. a summary is printed when the player is closed.
+
+START_TIMEOUT = 5.0         # seconds mpv has to open its ipc socket
+PLAY_TIMEOUT = 2.0          # seconds a sound has to start
+REPO_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+Cue = collections.namedtuple('Cue', 'path volume requested since done')
+
+
+def resolve_sound(sound):
+    """ absolute path of a sound: relative to the working folder, or to the repo folder (audio/wolf.mp3) """
+    if os.path.isabs(sound) or os.path.exists(sound):
+        return os.path.abspath(sound)
+    return os.path.abspath(os.path.join(REPO_FOLDER, sound))
+
+
+class Stub_Backend:
+    """ plays nothing, played holds (path, volume, time.monotonic()) of every sound. a sound 'plays' for duration seconds """
+
+    name = 'stub'
+
+    def __init__(self, duration=0.0):
+        self.duration = duration
+        self.played = []
+        self.current = None
+        self.volume = 0
+
+    def play(self, path, volume):
+        """ starts a sound, True once it started """
+        self.current, self.volume = path, volume
+        self.played.append((path, volume, time.monotonic()))
+        return True
+
+    def playing(self):
+        """ the path of the sound that is playing, None if none """
+        if self.current is not None and time.monotonic() >= self.played[-1][2] + self.duration:
+            self.current = None
+        return self.current
+
+    def set_volume(self, volume):
+        self.volume = volume
+
+    def close(self):
+        pass
+
+
+class Spawn_Backend(Stub_Backend):
+    """ one mpv per sound, started is when mpv was started """
+
+    name = 'spawn'
+
+    def play(self, path, volume):
+        try:
+            play_sound(path, volume=volume)
+        except OSError as e:
+            print(f"\n  could not play {path}: {e}")
+            return False
+        return True
+
+    def playing(self):
+        return None
+
+
+class Mpv_Backend:
+    """ one mpv in idle mode, controlled through its json ipc socket """
+
+    name = 'mpv'
+
+    def __init__(self):
+        self.folder = tempfile.mkdtemp(prefix='mpv_')
+        self.ipc_path = os.path.join(self.folder, 'socket')
+        self.process = subprocess.Popen(['mpv', '--idle=yes', '--no-video', '--no-terminal', '--keep-open=no',
+                                         f'--input-ipc-server={self.ipc_path}'],
+                                        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            self.sock = self._connect()
+        except OSError:
+            self.process.kill()
+            shutil.rmtree(self.folder, ignore_errors=True)
+            raise
+        self.send_lock = threading.Lock()
+        self.request_id = 0
+        self.started = threading.Event()
+        self.failed = None          # request_id of a loadfile that failed
+        self.loading = None         # request_id of the last loadfile
+        self.loading_path = None    # its sound
+        self.current = None         # only set by the reader thread
+        self.volume = 0
+        self.reader = threading.Thread(target=self._read, name='mpv ipc', daemon=True)
+        self.reader.start()
+
+    def _connect(self):
+        end = time.monotonic() + START_TIMEOUT
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.ipc_path)
+                return sock
+            except OSError:
+                sock.close()
+                if self.process.poll() is not None or time.monotonic() > end:
+                    raise OSError('mpv did not open its ipc socket')
+                time.sleep(0.02)
+
+    def _send(self, *command):
+        with self.send_lock:
+            self.request_id += 1
+            self.sock.sendall(json.dumps({'command': list(command), 'request_id': self.request_id}).encode('utf-8') + b'\n')
+            return self.request_id
+
+    def _read(self):
+        buffer = b''
+        while True:
+            try:
+                chunk = self.sock.recv(4096)
+            except OSError:
+                break
+            if not chunk:
+                break
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                event = message.get('event')
+                if event == 'playback-restart':
+                    self.current = self.loading_path
+                    self.started.set()
+                elif event == 'end-file':
+                    self.current = None
+                    if message.get('reason') == 'error':
+                        self.failed = self.loading
+                        self.started.set()
+                elif message.get('request_id') == self.loading and message.get('error') != 'success':
+                    self.failed = self.loading
+                    self.started.set()
+
+    def play(self, path, volume):
+        self.started.clear()
+        self.set_volume(volume)
+        # set before sending, the reader can get the reply before _send() returns
+        self.loading = self.request_id + 1
+        self.loading_path = path
+        self._send('loadfile', path, 'replace')
+        if not self.started.wait(PLAY_TIMEOUT) or self.failed == self.loading:
+            print(f"\n  mpv could not play {path}")
+            return False
+        return True
+
+    def playing(self):
+        return self.current
+
+    def set_volume(self, volume):
+        self.volume = volume
+        self._send('set_property', 'volume', volume)
+
+    def close(self):
+        if self.process.poll() is None:
+            try:
+                self._send('quit')
+                self.process.wait(1)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.terminate()
+        self.sock.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def create_backend(name):
+    """ the backend of --audio_backend, spawn if mpv can't be started """
+    if name == 'stub':
+        return Stub_Backend()
+    if name == 'mpv':
+        try:
+            if not hasattr(socket, 'AF_UNIX'):
+                raise OSError('no unix sockets')
+            return Mpv_Backend()
+        except OSError as e:
+            print(f" audio: mpv could not be started ({e}), starting one mpv per sound")
+    return Spawn_Backend()
+
+
+class Audio_Player:
+    """ plays the cues of the feedback engine one after the other in its own thread """
+
+    def __init__(self, backend, sounds=()):
+        self.backend = backend
+        self.paths = {sound: self.load(sound) for sound in sounds}
+        self.pending = collections.OrderedDict()        # path -> Cue, in the order they were cued
+        self.condition = threading.Condition()
+        self.closed = False
+        self.latencies = []         # cue -> sound started (seconds)
+        self.merged = 0             # cues that were merged with one that was queued or playing
+        self.thread = threading.Thread(target=self._run, name='audio player', daemon=True)
+        self.thread.start()
+
+    def load(self, sound):
+        path = resolve_sound(sound)
+        try:
+            with open(path, 'rb') as f:
+                while f.read(1 << 16):
+                    pass
+        except OSError as e:
+            print(f" audio: {sound} can't be played ({e.strerror})")
+        return path
+
+    def cue(self, sound, volume=100, since=None, done=None):
+        """ plays a sound. since: time.monotonic() the cue is for, done(since -> started seconds) when it started """
+        path = self.paths.get(sound) or resolve_sound(sound)
+        now = time.monotonic()
+        with self.condition:
+            queued = self.pending.get(path)
+            if queued is not None:
+                self.merged += 1
+                self.pending[path] = queued._replace(volume=max(volume, queued.volume))
+                return
+            self.pending[path] = Cue(path, volume, now, now if since is None else since, done)
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                path, cue = self.pending.popitem(last=False)
+
+            if self.backend.playing() == path:
+                self.merged += 1
+                if cue.volume > self.backend.volume:
+                    self.backend.set_volume(cue.volume)
+                continue
+            if self.backend.play(cue.path, cue.volume):
+                started = time.monotonic()
+                self.latencies.append(started - cue.requested)
+                if cue.done is not None:
+                    cue.done(started - cue.since)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join(PLAY_TIMEOUT + 1)
+        self.backend.close()
+        if self.latencies:
+            print(f"\n audio ({self.backend.name}): {len(self.latencies)} sounds, {self.merged} merged cues, latency "
+                  f"{1000 * sum(self.latencies) / len(self.latencies):.0f}ms (max {1000 * max(self.latencies):.0f}ms)")
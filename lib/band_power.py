@@ -0,0 +1,103 @@
+import numpy as np
+
+
+# eeg band power while recording (--band_power, and the feedback detectors that need it, lib/feedback.py)
+#
+# welch estimate that is updated incrementally: the last SEGMENT samples of every channel are kept in a ring, every
+# HOP samples the segment is tapered (hann) and transformed (one rfft for all channels), its power is summed per band
+# with one matrix product and replaces the oldest of the last AVERAGE periodograms. the estimate is their mean
+# (256 samples with 64 hop and 8 segments: 1s segments, 4 estimates per second over the last 2.75s of eeg).
+# all buffers are allocated once (the rfft output too with numpy >= 2, older versions have no out= and allocate it
+# every hop), a segment with a nan sample (packet loss) is skipped.
+#
+# estimate: channels x bands (uV^2), in the order of BANDS
+
+BANDS = {'delta': (1, 4), 'theta': (4, 8), 'alpha': (8, 13), 'beta': (13, 30)}
+SEGMENT = 256
+HOP = 64
+AVERAGE = 8
+
+RFFT_OUT = np.lib.NumpyVersion(np.__version__) >= '2.0.0'
+
+THETA = list(BANDS).index('theta')
+ALPHA = list(BANDS).index('alpha')
+
+
+def theta_alpha(estimate):
+    """ theta / alpha power ratio of the mean over the channels """
+    mean = estimate.mean(axis=0)
+    return mean[THETA] / mean[ALPHA] if mean[ALPHA] > 0 else np.nan
+
+
+class Band_Power:
+
+    def __init__(self, channels, rate=256, segment=SEGMENT, hop=HOP, average=AVERAGE):
+        self.segment = segment
+        self.hop = hop
+        self.ring = np.zeros((channels, segment))
+        self.pos = 0            # next column of the ring
+        self.filled = 0         # samples in the ring (up to segment)
+        self.since = 0          # samples since the last estimate
+
+        self.frame = np.empty((channels, segment))
+        self.taper = np.hanning(segment)
+        spectrum_size = segment // 2 + 1
+        self.spectrum = np.empty((channels, spectrum_size), dtype=np.complex128)
+        self.psd = np.empty((channels, spectrum_size))
+        self.imag = np.empty((channels, spectrum_size))
+        # frequency bins x bands, scaled so the product is the band power (one sided psd * bin width)
+        freqs = np.fft.rfftfreq(segment, 1 / rate)
+        self.bands = np.zeros((spectrum_size, len(BANDS)))
+        for b, (low, high) in enumerate(BANDS.values()):
+            self.bands[(freqs >= low) & (freqs < high), b] = 2 / (segment * np.sum(self.taper ** 2))
+
+        self.history = np.zeros((average, channels, len(BANDS)))
+        self.segments = 0       # periodograms computed
+        self.estimate = np.zeros((channels, len(BANDS)))
+
+    def _store(self, rows):
+        n = len(rows)
+        first = min(n, self.segment - self.pos)
+        self.ring[:, self.pos:self.pos + first] = rows[:first].T
+        self.ring[:, :n - first] = rows[first:].T
+        self.pos = (self.pos + n) % self.segment
+        self.filled = min(self.filled + n, self.segment)
+
+    def _update(self):
+        """ adds the periodogram of the current segment, False if it has a nan """
+        end = self.segment - self.pos
+        self.frame[:, :end] = self.ring[:, self.pos:]
+        self.frame[:, end:] = self.ring[:, :self.pos]
+        self.frame -= self.frame.mean(axis=1, keepdims=True)
+        if not np.isfinite(self.frame).all():
+            return False
+        self.frame *= self.taper
+
+        if RFFT_OUT:
+            spectrum = np.fft.rfft(self.frame, axis=1, out=self.spectrum)
+        else:
+            spectrum = np.fft.rfft(self.frame, axis=1)
+        np.square(spectrum.real, out=self.psd)
+        np.square(spectrum.imag, out=self.imag)
+        self.psd += self.imag
+        np.matmul(self.psd, self.bands, out=self.history[self.segments % len(self.history)])
+        self.segments += 1
+        np.mean(self.history[:min(self.segments, len(self.history))], axis=0, out=self.estimate)
+        return True
+
+    def add(self, rows, times):
+        """ eeg rows (samples x channels) with their receive times. returns (times, estimates) of the new estimates """
+        estimates = []
+        estimate_times = []
+        i = 0
+        while i < len(rows):
+            n = min(self.hop - self.since, len(rows) - i)
+            self._store(rows[i:i + n])
+            i += n
+            self.since += n
+            if self.since == self.hop:
+                self.since = 0
+                if self.filled == self.segment and self._update():
+                    estimates.append(self.estimate.copy())
+                    estimate_times.append(times[i - 1])
+        return np.array(estimate_times), np.array(estimates).reshape(-1, *self.estimate.shape)
@@ -0,0 +1,144 @@
+import json
+import time
+
+import numpy as np
+
+
+# binary recording format (--format binary) for the sample streams (eeg, heart_rate, acc)
+#
+# one .bin file per stream: a json header padded with spaces to HEADER_BYTES (ends with a newline), followed by
+# the samples as little endian float32, one row per sample (row major, like the csv file):
+#
+#   {"format": "muse_osc_binary", "version": 1, "dtype": "<f4", "header_bytes": 4096,
+#    "columns": ["tp9", "af7", "af8", "tp10"], "nominal_rate": 256, "start_time": 1729245600.0, "samples": 76800, ..}
+#
+# start_time is the unix time of the first eeg sample of the recording.
+#
+# the recorder appends whole blocks into a preallocated memory map (grown by chunk_rows at a time), so recording
+# is a copy of the ring buffer block. the header is rewritten (same size) on every flush, so a crashed recording
+# can still be read up to the last flush. loading is one np.memmap() call (read_binary()), export_csv() writes
+# the same csv as --format csv (tools/binary_to_csv.py).
+#
+# with --add_time_column the first column ('time') is the receive time in seconds since the first eeg sample
+# (float32, about 0.5ms resolution after one hour).
+
+FORMAT_NAME = 'muse_osc_binary'
+HEADER_BYTES = 4096
+DTYPE = '<f4'
+
+
+def encode_header(header):
+    text = json.dumps(header)
+    if len(text) > HEADER_BYTES - 1:
+        raise ValueError(f'binary header is too long ({len(text)} bytes)')
+    return (text + ' ' * (HEADER_BYTES - 1 - len(text)) + '\n').encode('ascii')
+
+
+class Binary_File:
+    """ one stream of a recording, used like the open csv file (write_to_file(), flush_file(), close) """
+
+    sample_bytes = 4
+
+    def __init__(self, path, columns, nominal_rate, chunk_rows, time_column=False, start_time=None):
+        self.path = path
+        self.width = len(columns)
+        self.chunk_rows = max(int(chunk_rows), 1)
+        self.rows = 0
+        self.capacity = 0
+        self.map = None
+        self.header = {
+            'format': FORMAT_NAME,
+            'version': 1,
+            'dtype': DTYPE,
+            'header_bytes': HEADER_BYTES,
+            'columns': list(columns),
+            'time_column': time_column,
+            'nominal_rate': nominal_rate,
+            'start_time': time.time() if start_time is None else start_time,
+            'samples': 0,
+        }
+
+        self.file = open(path, 'w+b')
+        self.write_header()
+        self._grow(self.chunk_rows)
+
+    def _grow(self, rows):
+        """ makes room for at least 'rows' more samples """
+        self.capacity = self.rows + max(rows, self.chunk_rows)
+        self.map = None         # the old map has to be released before the file is resized (windows)
+        self.file.truncate(HEADER_BYTES + self.capacity * self.width * 4)
+        self.map = np.memmap(self.file, dtype=DTYPE, mode='r+', offset=HEADER_BYTES, shape=(self.capacity, self.width))
+
+    def append(self, rows):
+        n = len(rows)
+        if self.rows + n > self.capacity:
+            self._grow(n)
+        self.map[self.rows:self.rows + n] = rows
+        self.rows += n
+
+    def write_header(self):
+        self.header['samples'] = self.rows
+        self.file.seek(0)
+        self.file.write(encode_header(self.header))
+        self.file.flush()
+
+    def flush(self):
+        # the samples are in the page cache as soon as they are copied, only the sample count is missing
+        self.write_header()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        if self.file.closed:
+            return
+        if self.map is not None:
+            self.map.flush()
+            self.map = None
+        self.file.truncate(HEADER_BYTES + self.rows * self.width * 4)
+        self.write_header()
+        self.file.close()
+
+
+def read_header(raw):
+    header = json.loads(raw[:HEADER_BYTES].decode('ascii'))
+    if header.get('format') != FORMAT_NAME:
+        raise ValueError('not a binary recording file')
+    return header
+
+
+def read_binary(path):
+    """ returns (header, samples) of a .bin file, samples is a read only np.memmap (samples x columns) """
+    with open(path, 'rb') as f:
+        header = read_header(f.read(HEADER_BYTES))
+    if header['samples'] == 0:
+        return header, np.zeros((0, len(header['columns'])), dtype=header['dtype'])
+    samples = np.memmap(path, dtype=header['dtype'], mode='r', offset=header['header_bytes'],
+                        shape=(header['samples'], len(header['columns'])))
+    return header, samples
+
+
+def read_binary_bytes(raw):
+    """ like read_binary() for the content of a .bin file (eg. read from a zip file) """
+    header = read_header(raw)
+    width = len(header['columns'])
+    samples = np.frombuffer(raw, dtype=header['dtype'], count=header['samples'] * width, offset=header['header_bytes'])
+    return header, samples.reshape(-1, width)
+
+
+def export_csv(header, samples, file_out, csv_delimiter=',', add_header_row=False, decimals=None, chunk_rows=65536):
+    """ writes the samples in the csv layout of --format csv (same values and line endings, decimals: --csv_decimals) """
+    if add_header_row:
+        file_out.write(csv_delimiter.join(header['columns']) + '\r\n')
+
+    cells = ['%r'] * len(header['columns']) if decimals is None else [f"%.{decimals}f"] * len(header['columns'])
+    if header['time_column']:
+        cells[0] = '%r'
+    row_format = csv_delimiter.join(cells) + '\r\n'
+    for first in range(0, len(samples), chunk_rows):
+        block = np.asarray(samples[first:first + chunk_rows], dtype=np.float32).tolist()
+        if header['time_column']:
+            # the csv writer rounds the seconds to 4 decimals
+            for row in block:
+                row[0] = round(row[0], 4)
+        file_out.write(''.join([row_format % tuple(row) for row in block]))
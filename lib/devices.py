@@ -0,0 +1,126 @@
+import threading
+
+from lib.init_config import init_streams
+from lib.osc_batch_receiver import Osc_Batch_Decoder, osc_batch_start
+from lib.osc_server import create_dispatcher, create_block_handlers, osc_start
+from lib.shared_data import Shared_Data
+
+
+# several headbands recorded by one process.
+#
+# every device gets its own Shared_Data with its own buffers, signal quality, stream state (muse app),
+# session folder and zip. conf and columns are shared with the main data, and so are the writer thread,
+# stats line and web server. the devices are listed in data['devices']:
+#   - one port, no --split_by_sender: the main data itself is the only device (same as before)
+#   - several ports (--port 5000 5001): one device per port, each port gets its own receiver thread
+#     (its own receiver process with --runtime multiprocess, see lib/multiprocess_runtime.py)
+#   - --split_by_sender: one port, a device is created for every new sender ip address (max --max_devices)
+
+
+def create_device(data, name, port, streams=None):
+    # streams: buffers and gate of a device that already exists in the other process (--runtime multiprocess)
+    dev = Shared_Data()
+    dev['conf'] = data['conf']
+    dev['columns'] = data['columns']
+    dev['source'] = {'name': name, 'port': port}
+    dev['folder']['prefix'] = f"{data['conf']['file_name_prefix']}{name}_"
+    dev['folder']['note'] = data['folder']['note']      # notes entered in the terminal go to all recordings
+    init_streams(dev, streams)
+    return dev
+
+
+def init_devices(data):
+    ports = data['conf']['port']
+
+    if len(ports) == 1 and not data['conf']['split_by_sender']:
+        data['source'] = {'name': '', 'port': ports[0]}
+        data['folder']['prefix'] = data['conf']['file_name_prefix']
+        data['devices'].append(data)
+
+    elif not data['conf']['split_by_sender']:
+        for port in ports:
+            data['devices'].append(create_device(data, f"p{port}", port))
+
+    # with --split_by_sender the devices are created by the Sender_Router when the first packet arrives
+
+
+class Sender_Router:
+    """
+    Receives the packets of one port and passes them on to the device of the sender ip address.
+    Can be used as the dispatcher of a pythonosc server (call_handlers_for_packet) and as the decoder of the
+    batch receiver (process).
+    """
+
+    def __init__(self, data, port, on_new_device=None):
+        self.data = data
+        self.port = port
+        self.on_new_device = on_new_device      # called with every new device before it is recorded
+        self.devices = {}       # sender ip -> device
+        self.dispatchers = {}
+        self.decoders = {}
+        self.ignored = set()
+        self._lock = threading.Lock()
+
+    def device(self, ip):
+        dev = self.devices.get(ip)
+        if dev is not None:
+            return dev
+
+        with self._lock:
+            if len(self.data['devices']) >= self.data['conf']['max_devices']:
+                if ip not in self.ignored:
+                    self.ignored.add(ip)
+                    print(f"\n  ignoring osc stream from {ip} (--max_devices {self.data['conf']['max_devices']} reached)")
+                return None
+
+            dev = create_device(self.data, ip.replace('.', '-'), self.port)
+            if self.on_new_device is not None:
+                self.on_new_device(dev)
+            self.devices[ip] = dev
+            self.data['devices'].append(dev)
+            print(f"\n  new headband: {ip} ")
+            return dev
+
+    def call_handlers_for_packet(self, dgram, client_address):
+        ip = client_address[0]
+        disp = self.dispatchers.get(ip)
+        if disp is None:
+            dev = self.device(ip)
+            if dev is None:
+                return []
+            disp = self.dispatchers[ip] = create_dispatcher(dev)
+        return disp.call_handlers_for_packet(dgram, client_address)
+
+    def process(self, batch):
+        # keep the receive order per sender
+        by_sender = {}
+        for item in batch:
+            by_sender.setdefault(item[1][0], []).append(item)
+
+        for ip, items in by_sender.items():
+            decoder = self.decoders.get(ip)
+            if decoder is None:
+                dev = self.device(ip)
+                if dev is None:
+                    continue
+                decoder = self.decoders[ip] = Osc_Batch_Decoder(create_block_handlers(dev), create_dispatcher(dev))
+            decoder.process(items)
+
+
+def start_osc_threads(data, on_new_device=None):
+    # one receiver thread per port / headband (or one for all headbands with --split_by_sender)
+    if data['conf']['osc_engine'] == 'batch':
+        osc_target = osc_batch_start
+    else:
+        osc_target = osc_start
+
+    if data['conf']['split_by_sender']:
+        # one port, the headbands are told apart by their ip address
+        data['source'] = {'name': '', 'port': data['conf']['port'][0]}
+        router = Sender_Router(data, data['conf']['port'][0], on_new_device)
+        osc_thread = threading.Thread(target=osc_target, args=(data, router), daemon=True)
+        osc_thread.start()
+    else:
+        for dev in data['devices']:
+            osc_thread = threading.Thread(target=osc_target, args=(dev,), daemon=True)
+            osc_thread.start()
@@ -0,0 +1,365 @@
+import math
+import os
+import time
+
+import numpy as np
+
+
+# EDF+ / BDF+ recording format (--format edf / bdf) for the sample streams (eeg, heart_rate, acc)
+#
+# one file per recording ({recording}_eeg.edf / .bdf) that EEGLAB, MNE, EDFbrowser.. open with the sampling rates,
+# channel names and units, no channel locations or rates have to be set by hand. EDF+ stores 16 bit samples,
+# BDF+ 24 bit (the full resolution of the muse eeg).
+#
+# the header (256 bytes + 256 per signal) is followed by data records of RECORD_SECONDS. a record holds the samples
+# of all signals one signal after the other: every eeg channel (256 samples), heart rate (64), acc x, y, z (52) and
+# the annotation signal (ANNOTATION_BYTES of text: the record onset, signal quality changes and notes).
+#
+# the eeg drives the records: a record is written as soon as its eeg samples are there and the other streams
+# delivered theirs too. a stream that falls more than MAX_BACKLOG_RECORDS behind the eeg (stopped, or slower than
+# its nominal rate) is padded with its last value, of a stream that runs ahead by more than that the oldest samples
+# are dropped. the padded / dropped samples are annotated at the end of the file. the samples are mapped
+# linearly from the physical range of their stream (PHYSICAL, clipped) to the digital range, nan is the digital
+# minimum. the last record is padded at the end (the annotation 'recording end' marks the real end).
+#
+# the number of records in the header is rewritten on every flush, so a crashed file can be read up to the last
+# flush. the recovery (lib/recovery.py) cuts it to its complete records (repair_edf()).
+
+RECORD_SECONDS = 1
+ANNOTATION_BYTES = 384      # divisible by 2 and 3 (edf / bdf samples)
+MAX_BACKLOG_RECORDS = 2
+
+# physical minimum, maximum and unit of the streams (the muse sends the eeg as 0..1682.815 uV)
+PHYSICAL = {
+    'eeg': (0.0, 1682.815, 'uV'),
+    'heart_rate': (0.0, 4194304.0, ''),     # raw ppg values (22 bit)
+    'acc': (-8.0, 8.0, 'g'),
+}
+LABELS = {'eeg': 'EEG {}', 'heart_rate': 'PPG {}', 'acc': 'Acc {}'}
+TRANSDUCERS = {'eeg': 'dry electrode', 'heart_rate': 'PPG sensor', 'acc': 'accelerometer'}
+
+FORMATS = {
+    'edf': {'version': b'0       ', 'reserved': 'EDF+C', 'annotations': 'EDF Annotations', 'sample_bytes': 2,
+            'digital': (-32768, 32767)},
+    'bdf': {'version': b'\xffBIOSEMI', 'reserved': 'BDF+C', 'annotations': 'BDF Annotations', 'sample_bytes': 3,
+            'digital': (-8388608, 8388607)},
+}
+
+MONTHS = ('JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC')
+
+
+def number(x):
+    """ a number in an 8 character header field """
+    for decimals in range(6, -1, -1):
+        text = f"{x:.{decimals}f}"
+        if '.' in text:
+            text = text.rstrip('0').rstrip('.')
+        if len(text) <= 8:
+            return text
+    raise ValueError(f'{x} does not fit into an edf header field')
+
+
+def field(text, width):
+    return str(text)[:width].ljust(width).encode('ascii', 'replace')
+
+
+def onset_text(seconds):
+    return '+' + number(seconds) if seconds < 1e7 else f"+{seconds:.3f}"
+
+
+def tal(onset, text='', duration=None):
+    """ time-stamped annotation list: +onset[\\x15duration]\\x14text\\x14\\x00 """
+    tal = onset_text(onset).encode('ascii')
+    if duration is not None:
+        tal += b'\x15' + number(duration).encode('ascii')
+    return tal + b'\x14' + text.encode('utf-8') + b'\x14\x00'
+
+
+class Edf_Stream:
+    """ one stream of the edf file, used like the open csv / .bin file (write_to_file(), flush_file(), close) """
+
+    def __init__(self, edf, name, columns, rate):
+        self.edf = edf
+        self.name = name
+        self.columns = list(columns)
+        self.width = len(self.columns)
+        self.n = int(round(rate * RECORD_SECONDS))      # samples per record
+        self.sample_bytes = edf.format['sample_bytes']
+        self.pending = []
+        self.rows = 0               # pending samples
+        self.last = np.full(self.width, np.nan)
+        self.padded = 0
+        self.dropped = 0
+        self.closed = False
+
+        pmin, pmax, self.unit = PHYSICAL[name]
+        # the numbers as they are in the header, so readers get the same values back
+        self.physical = (float(number(pmin)), float(number(pmax)))
+        dmin, dmax = edf.format['digital']
+        self.scale = (dmax - dmin) / (self.physical[1] - self.physical[0])
+
+    def append(self, rows):
+        self.edf.append(self, rows)
+
+    def take(self, records, pad):
+        """ the samples of the next 'records' records (padded with the last value if pad), as digital values """
+        need = records * self.n
+        block = np.concatenate(self.pending) if self.pending else np.zeros((0, self.width))
+        rest = block[need:]
+        block = block[:need]
+        if len(block) < need:
+            if not pad:
+                raise ValueError(f'{self.name}: not enough samples for {records} records')
+            self.padded += need - len(block)
+            last = block[-1] if len(block) else self.last
+            block = np.vstack((block, np.tile(last, (need - len(block), 1))))
+        if need:
+            self.last = block[-1]
+        self.pending = [rest] if len(rest) else []
+        self.rows = len(rest)
+
+        dmin, dmax = self.edf.format['digital']
+        digital = (block - self.physical[0]) * self.scale + dmin
+        digital = np.clip(np.rint(np.where(np.isnan(digital), dmin, digital)), dmin, dmax).astype(np.int32)
+        # one signal (column) after the other in every record
+        return digital.reshape(records, self.n, self.width).transpose(0, 2, 1).reshape(records, -1)
+
+    def trim(self, records):
+        """ a stream that runs ahead of the eeg ('records' complete eeg records) by more than MAX_BACKLOG_RECORDS """
+        excess = self.rows - (records + MAX_BACKLOG_RECORDS) * self.n
+        if excess > 0:
+            block = np.concatenate(self.pending)[excess:]
+            self.pending = [block]
+            self.rows = len(block)
+            self.dropped += excess
+
+    def flush(self):
+        self.edf.flush()
+
+    def fileno(self):
+        return self.edf.fileno()
+
+    def close(self):
+        # the file is closed with its last stream
+        self.closed = True
+        if all(stream.closed for stream in self.edf.streams.values()):
+            self.edf.close()
+
+
+class Edf_File:
+    """
+    streams: (name, columns, sampling rate), the first one (eeg) drives the records. kind: 'edf' or 'bdf'.
+    start_time: unix time of the first eeg sample
+    """
+
+    def __init__(self, path, streams, start_time=None, kind='edf', equipment='Muse'):
+        self.path = path
+        self.format = FORMATS[kind]
+        self.start_time = time.time() if start_time is None else start_time
+        # the header has whole seconds, the first record starts 'offset' seconds later (its time keeping annotation)
+        self.offset = round(self.start_time % 1, 3)
+        self.equipment = equipment.replace(' ', '_') or 'X'
+        self.streams = {name: Edf_Stream(self, name, columns, rate) for name, columns, rate in streams}
+        self.driver = next(iter(self.streams.values()))
+        self.records = 0
+        self.annotations = []
+        self.file = open(path, 'w+b')
+        self.write_header()
+
+    def signals(self):
+        """ (label, transducer, unit, physical min, physical max, digital min, digital max, samples per record) """
+        dmin, dmax = self.format['digital']
+        signals = []
+        for stream in self.streams.values():
+            for column in stream.columns:
+                signals.append((LABELS[stream.name].format(column.upper() if stream.name == 'eeg' else column),
+                                TRANSDUCERS[stream.name], stream.unit) + stream.physical + (dmin, dmax, stream.n))
+        signals.append((self.format['annotations'], '', '', -1, 1, dmin, dmax,
+                        ANNOTATION_BYTES // self.format['sample_bytes']))
+        return signals
+
+    def header(self):
+        signals = self.signals()
+        start = time.localtime(self.start_time)
+        header = self.format['version']
+        header += field('X X X X', 80)         # patient: code, sex, birthdate, name unknown
+        header += field(f"Startdate {start.tm_mday:02d}-{MONTHS[start.tm_mon - 1]}-{start.tm_year} X X {self.equipment}", 80)
+        header += field(time.strftime('%d.%m.%y', start), 8) + field(time.strftime('%H.%M.%S', start), 8)
+        header += field(256 * (len(signals) + 1), 8) + field(self.format['reserved'], 44)
+        header += field(self.records, 8) + field(RECORD_SECONDS, 8) + field(len(signals), 4)
+        for i, width in enumerate((16, 80, 8, 8, 8, 8, 8)):
+            header += b''.join(field(number(s[i]) if i >= 3 else s[i], width) for s in signals)
+        header += b''.join(field('', 80) for s in signals)     # prefiltering
+        header += b''.join(field(s[7], 8) for s in signals)
+        header += b''.join(field('', 32) for s in signals)
+        return header
+
+    def write_header(self):
+        self.file.seek(0)
+        self.file.write(self.header())
+        self.file.seek(0, os.SEEK_END)
+        self.file.flush()
+
+    def annotate(self, onset, text, duration=None):
+        """ an annotation 'onset' seconds after the first eeg sample (written with the next record) """
+        text = ' '.join(text.replace('\x14', ' ').replace('\x15', ' ').replace('\x00', ' ').split())
+        # the text has to fit into one record next to its time keeping annotation
+        room = ANNOTATION_BYTES - len(tal(self.offset + onset + 1e6)) - len(tal(self.offset + onset, '', duration))
+        text = text.encode('utf-8')[:room].decode('utf-8', 'ignore')
+        self.annotations.append(tal(self.offset + onset, text, duration))
+
+    def _annotation_records(self, records):
+        out = np.zeros((records, ANNOTATION_BYTES), dtype=np.uint8)
+        for i in range(records):
+            text = tal(self.offset + (self.records + i) * RECORD_SECONDS)
+            while self.annotations and len(text) + len(self.annotations[0]) <= ANNOTATION_BYTES:
+                text += self.annotations.pop(0)
+            out[i, :len(text)] = np.frombuffer(text, dtype=np.uint8)
+        return out
+
+    def _write_records(self, records, pad=False):
+        if records <= 0:
+            return
+        blocks = []
+        for stream in self.streams.values():
+            digital = stream.take(records, pad)
+            if self.format['sample_bytes'] == 2:
+                blocks.append(digital.astype('<i2').view(np.uint8).reshape(records, -1))
+            else:
+                # 24 bit little endian: the lower 3 bytes of every int32
+                blocks.append(digital.astype('<i4').view(np.uint8).reshape(records, -1, 4)[:, :, :3].reshape(records, -1))
+        blocks.append(self._annotation_records(records))
+        self.file.write(np.hstack(blocks).tobytes())
+        self.records += records
+
+    def append(self, stream, rows):
+        if stream is self.driver:
+            # a stream that is more than MAX_BACKLOG_RECORDS behind the eeg (stopped) is padded
+            self._write_records(self.driver.rows // self.driver.n - MAX_BACKLOG_RECORDS, pad=True)
+        if len(rows):
+            stream.pending.append(np.asarray(rows, dtype=np.float64))
+            stream.rows += len(rows)
+        if stream is not self.driver:
+            stream.trim(self.driver.rows // self.driver.n)
+        self._write_records(min(s.rows // s.n for s in self.streams.values()))
+
+    def flush(self):
+        if not self.file.closed:
+            self.write_header()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        if self.file.closed:
+            return
+        # the last record is padded
+        end = (self.records + self.driver.rows / self.driver.n) * RECORD_SECONDS
+        records = math.ceil(self.driver.rows / self.driver.n)
+        if (self.records + records) * RECORD_SECONDS > end:
+            self.annotate(end, 'recording end', (self.records + records) * RECORD_SECONDS - end)
+        for stream in self.streams.values():
+            # with the padding of the last records (counted by take()) and the samples after them
+            padded = stream.padded + max(records * stream.n - stream.rows, 0)
+            dropped = stream.dropped + max(stream.rows - records * stream.n, 0)
+            if padded or dropped:
+                self.annotate(end, f"{stream.name}: {padded} samples padded, {dropped} dropped")
+        self._write_records(records, pad=True)
+        self.write_header()
+        self.file.close()
+
+
+def read_edf_header(raw):
+    """ the fields of an edf / bdf header that are needed to find its records """
+    header_bytes = int(raw[184:192])
+    signals = int(raw[252:256])
+    offset = 256 + signals * 216
+    samples = [int(raw[offset + 8 * i:offset + 8 * i + 8]) for i in range(signals)]
+    return {'header_bytes': header_bytes, 'records': int(raw[236:244]), 'signals': signals, 'samples': samples,
+            'sample_bytes': 3 if raw[:1] == b'\xff' else 2}
+
+
+def read_edf_bytes(raw):
+    """
+    the content of an edf / bdf file of the recorder: (streams, annotations). streams: name -> (columns, samples
+    (float32 physical values, samples x columns)), annotations: (onset seconds since the first eeg sample, duration, text)
+    """
+    header = read_edf_header(raw[:int(raw[184:192])])
+    signals = header['signals']
+    fields = {}
+    offset = 256
+    for name, width in (('label', 16), ('transducer', 80), ('unit', 8), ('pmin', 8), ('pmax', 8), ('dmin', 8), ('dmax', 8)):
+        fields[name] = [raw[offset + width * i:offset + width * (i + 1)].decode('latin-1').strip() for i in range(signals)]
+        offset += width * signals
+
+    width = header['sample_bytes']
+    record_bytes = sum(header['samples']) * width
+    records = min(header['records'], (len(raw) - header['header_bytes']) // record_bytes)
+    if records < 0:
+        records = (len(raw) - header['header_bytes']) // record_bytes
+    data = np.frombuffer(raw, dtype=np.uint8, count=records * record_bytes, offset=header['header_bytes'])
+    data = data.reshape(records, record_bytes)
+
+    prefixes = {label.split(' ')[0]: name for name, label in LABELS.items()}
+    streams = {}
+    annotations = []
+    start = 0
+    for i, n in enumerate(header['samples']):
+        block = data[:, start:start + n * width]
+        start += n * width
+        label = fields['label'][i]
+        if label.endswith('Annotations'):
+            annotations += read_annotations(block.tobytes())
+            continue
+        if width == 2:
+            digital = block.copy().view('<i2').astype(np.int32).ravel()
+        else:
+            digital = np.zeros((records * n, 4), dtype=np.uint8)
+            digital[:, :3] = block.reshape(-1, 3)
+            digital = digital.view('<i4').ravel()
+            digital = np.where(digital >= 1 << 23, digital - (1 << 24), digital)
+        pmin, pmax, dmin, dmax = (float(fields[key][i]) for key in ('pmin', 'pmax', 'dmin', 'dmax'))
+        values = ((digital - dmin) * ((pmax - pmin) / (dmax - dmin)) + pmin).astype(np.float32)
+        prefix, _, column = label.partition(' ')
+        stream = prefixes.get(prefix, label)
+        columns, samples = streams.setdefault(stream, ([], []))
+        columns.append(column.lower() if stream == 'eeg' else column or label)
+        samples.append(values)
+    streams = {name: (columns, np.column_stack(samples)) for name, (columns, samples) in streams.items()}
+
+    # the onsets are relative to the first eeg sample (the time keeping annotation of the first record)
+    first = annotations[0][0] if annotations and annotations[0][2] == '' else 0.0
+    annotations = [(round(onset - first, 6), duration, text) for onset, duration, text in annotations if text != '']
+    return streams, annotations
+
+
+def read_annotations(raw):
+    """ (onset, duration, text) of the annotations of an annotation signal ('' for the time keeping annotations) """
+    annotations = []
+    for tal in raw.split(b'\x00'):
+        if not tal:
+            continue
+        parts = tal.decode('utf-8', 'replace').split('\x14')
+        onset, _, duration = parts[0].partition('\x15')
+        texts = [text for text in parts[1:] if text != ''] or ['']
+        for text in texts:
+            annotations.append((float(onset), float(duration) if duration else None, text))
+    return annotations
+
+
+def repair_edf(path):
+    """
+    cuts a crashed edf / bdf file to its complete records and writes their number into the header.
+    returns (removed bytes, samples of the first signal)
+    """
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as f:
+        header_bytes = int(f.read(256)[184:192])
+        f.seek(0)
+        header = read_edf_header(f.read(header_bytes))
+        record_bytes = sum(header['samples']) * header['sample_bytes']
+        records = max(size - header['header_bytes'], 0) // record_bytes
+        f.truncate(header['header_bytes'] + records * record_bytes)
+        f.seek(236)
+        f.write(field(records, 8))
+    return size - header['header_bytes'] - records * record_bytes, records * header['samples'][0]
@@ -1,129 +1,442 @@
-import time
-
-
-
-
 import collections
+import functools
+import json
+import time
 
-from lib.play_sound_termux import play_sound
-
-
-def feedback_acc_start(data):
-
-
-    # To store the history of movements
-    movement_history = collections.deque(maxlen=data['conf']['nod_length'])  # Adjust the length as needed
-
-    last_play_time = 0  # Timestamp of the last time play_sound was called
-    cooldown = 60  # Cooldown period in seconds
-    cooldown_nod = 120  # Cooldown period in seconds
-
-    # start_time = time.time()
-    begin_after = 60   #minimum time before play in s
-
-
-
-    while True:
-
-        if not data['feedback']['acc'].empty():
-            prev_x, prev_y, prev_z = None, None, None
-            current_movement = {'dx': 0, 'dy': 0, 'dz': 0}
-
-            # Retrieve and process all items in the queue
-            while not data['feedback']['acc'].empty():
-                acc = data['feedback']['acc'].get()  # Get and remove an item from the queue
-                x, y, z = acc['x'], acc['y'], acc['z']
-
-                if prev_x is not None:
-                    current_movement['dx'] += x - prev_x
-                    current_movement['dy'] += y - prev_y
-                    current_movement['dz'] += z - prev_z
-                prev_x, prev_y, prev_z = x, y, z
-
-            # Add the current movement to history
-            movement_history.append(current_movement)
-            # print(current_movement)
-
-            # Analyze the movement history for patterns like nodding or shaking
-            moved = analyze_movement(movement_history, data['conf']['nod_threshold_magnitude'])
-            current_time = time.time()
-
-            if moved > 0 and current_time > data['stats']['rec_start_time'] + begin_after:
-
-                play = ''
-                vol = 100
-
-                if current_time - last_play_time >= cooldown:
-
-                    data['stats']['moved_sum'] += 1
-
-                    if data['stats']['moved_continuous'] == 5:
-                        play = "audio/biohazard-alarm.mp3"
-                        vol = 30
-                    elif data['stats']['moved_continuous'] == 6:
-                        play = "audio/biohazard-alarm.mp3"
-                        vol = 60
-                    elif data['stats']['moved_continuous'] > 6:
-                        play = "audio/biohazard-alarm.mp3"
-                        vol = 100
-                    else:
-                        play = 'audio/wolf.mp3'
-                    last_play_time = current_time
-
-                    if current_time - last_play_time <= cooldown_nod:
-                        data['stats']['moved_continuous'] += 1
-
-                if play != '':
-                    #play_sound(play, volume=vol, background=False)  # boreal_owl.mp3
-                    play_sound(play, volume=vol)  # boreal_owl.mp3
-
+import numpy as np
+
+from lib.audio_player import Audio_Player, create_backend
+from lib.band_power import Band_Power, theta_alpha
+
+
+# biofeedback: detectors watch the streams of every headband and play a sound when their condition is met
+# (--feedback nod stillness signal_loss drowsiness, --feedback_acc is the same as --feedback nod)
+#
+# the osc handlers copy the samples the detectors need into small ring buffers (data['feedback'][stream],
+# lib/osc_server.py) and wake up the engine (conf 'feedback_wakeup', a lib/writer_wakeup.py) as soon as WAKE_SECONDS
+# of a stream arrived. the engine reads the new samples, feeds them to the detectors of their stream and evaluates
+# them right away. a detector that fires when data is missing (signal_loss) also has a deadline the engine wakes
+# up for. --runtime multiprocess: the buffers are checked whenever the receiver sends its state (every 0.25s).
+#
+# every detector has its rule (Feedback_Rule): it only plays begin_after seconds after the recording started and at
+# most once per cooldown. the escalation ladder chooses the sound and volume by the number of cues in a row
+# (reset when the detector did not fire for reset_after seconds). the settings of a detector (its DEFAULTS) can be
+# changed with --feedback_config, a json file: {"nod": {"cooldown": 30, "threshold": 0.08}, "stillness": {..}}
+#
+# a new detector: a subclass of Detector with its name, streams and DEFAULTS, added to DETECTORS.
+#
+# derived streams (SOURCES) are computed by the engine from a feedback buffer: 'band_power' from the eeg
+# (lib/band_power.py, also with --band_power alone for the status line), one row per estimate (channels x bands).
+#
+# the sounds are played by one long-lived player (lib/audio_player.py, --audio_backend), the engine only queues them.
+# latency: receive time of the sample that completed the detection -> sound started ('cue' in the status line),
+# and the time from the newest sample to its evaluation ('fb' in the status line)
+
+WAKE_SECONDS = 0.02         # the engine is woken up once this much of a stream arrived (at least one sample)
+MAX_WAIT = 1.0              # longest sleep of the engine without data or deadline
+CONSISTENCY_THRESHOLD = 0.6     # 60% of movements should be in the same direction for a nod
+
+
+class Nod_Window:
+    """
+    The movements of the last 'length' steps. a nod is a window with significant movements (> threshold) that mostly
+    (CONSISTENCY_THRESHOLD) go in one direction on an axis. the movements above / below every threshold are counted
+    when they enter and leave the window, so a step costs the same for any length and several thresholds are
+    evaluated at once.
+    """
+
+    def __init__(self, length, thresholds):
+        self.length = length
+        self.thresholds = np.asarray(thresholds, dtype=np.float64).reshape(-1, 1)     # thresholds x axes
+        self.history = collections.deque()
+        self.positive = np.zeros((len(self.thresholds), 3), dtype=np.int64)
+        self.negative = np.zeros((len(self.thresholds), 3), dtype=np.int64)
+
+    def add(self, movement):
+        """ the movement (dx, dy, dz) of one step """
+        positive = movement > self.thresholds
+        negative = movement < -self.thresholds
+        self.history.append((positive, negative))
+        self.positive += positive
+        self.negative += negative
+        if len(self.history) > self.length:
+            positive, negative = self.history.popleft()
+            self.positive -= positive
+            self.negative -= negative
+
+    def moved(self):
+        """ one bool per threshold: a nod (or shake) in the window """
+        significant = self.positive + self.negative
+        dominant = np.maximum(self.positive, self.negative)
+        return ((significant > 0) & (dominant > CONSISTENCY_THRESHOLD * significant)).any(axis=1)
+
+
+class Step_Movement:
+    """ splits the acc samples into steps of 'step' seconds (receive time), the movement of a step is its last - first sample """
+
+    def __init__(self, step):
+        self.step = step
+        self.first = None       # first sample of the current step
+        self.start = 0.0
+
+    def add(self, rows, times):
+        """ [(movement, receive time of its last sample)] of the steps that ended with these samples """
+        steps = []
+        i = 0
+        while i < len(rows):
+            if self.first is None:
+                self.first = rows[i]
+                self.start = times[i]
+            end = int(np.searchsorted(times, self.start + self.step, 'left'))
+            if end >= len(rows):
+                break
+            steps.append((rows[end] - self.first, times[end]))
+            self.first = None
+            i = end + 1
+        return steps
+
+
+class Detector:
+    """
+    Base class of the detectors. streams: the feedback buffers it reads, DEFAULTS: its settings, including its rule.
+    add() gets the new samples of its streams, poll() is called at every evaluation (also without new samples).
+    both return the receive time (time.monotonic()) of the sample that fulfilled the condition, or None.
+    """
+
+    name = ''
+    streams = ()
+    DEFAULTS = {
+        'begin_after': 60,          # seconds after the start of the recording before the first sound
+        'cooldown': 60,             # min seconds between two sounds
+        'reset_after': 120,         # the ladder starts again when it did not fire for this long
+        # [cues in a row, sound, volume]: the last step that is reached is played
+        'ladder': [[0, 'audio/wolf.mp3', 100]],
+    }
+
+    def __init__(self, dev, settings):
+        self.dev = dev
+        self.settings = settings
+
+    def add(self, stream, rows, times):
+        return None
+
+    def poll(self, now):
+        return None
+
+    def deadline(self):
+        """ time.monotonic() when poll() can fire without new samples, None if it can't """
+        return None
+
+
+class Nod_Detector(Detector):
+    """ the head nods (or shakes): the movements of the last 'length' steps of 'step' seconds in a Nod_Window """
+
+    name = 'nod'
+    streams = ('acc',)
+    DEFAULTS = dict(Detector.DEFAULTS, step=0.5, length=None, threshold=None, ladder=[
+        [0, 'audio/wolf.mp3', 100],
+        [5, 'audio/biohazard-alarm.mp3', 30],
+        [6, 'audio/biohazard-alarm.mp3', 60],
+        [7, 'audio/biohazard-alarm.mp3', 100],
+    ])
+
+    def __init__(self, dev, settings):
+        super().__init__(dev, settings)
+        # default: conf nod_length and nod_threshold_magnitude (lib/init_config.py)
+        length = settings['length'] or dev['conf']['nod_length']
+        threshold = settings['threshold'] or dev['conf']['nod_threshold_magnitude']
+        self.window = Nod_Window(length, [threshold])
+        self.steps = Step_Movement(settings['step'])
+
+    def add(self, stream, rows, times):
+        fired = None
+        for movement, t in self.steps.add(rows, times):
+            self.window.add(movement)
+            if self.window.moved()[0]:
+                fired = t
+        return fired
+
+
+class Stillness_Detector(Detector):
+    """ no movement above 'threshold' in any step of 'step' seconds for 'window' seconds (fell asleep lying still) """
+
+    name = 'stillness'
+    streams = ('acc',)
+    DEFAULTS = dict(Detector.DEFAULTS, step=0.5, threshold=0.02, window=180, cooldown=120, reset_after=300,
+                    ladder=[[0, 'audio/boreal_owl.mp3', 50], [2, 'audio/boreal_owl.mp3', 100]])
+
+    def __init__(self, dev, settings):
+        super().__init__(dev, settings)
+        self.steps = Step_Movement(settings['step'])
+        self.moving = None      # receive time of the last step with movement (or of the first step)
+
+    def add(self, stream, rows, times):
+        fired = None
+        for movement, t in self.steps.add(rows, times):
+            if self.moving is None or np.abs(movement).max() > self.settings['threshold']:
+                self.moving = t
+            elif t - self.moving >= self.settings['window']:
+                fired = t
+        return fired
+
+
+class Signal_Loss_Detector(Detector):
+    """
+    The eeg is lost while recording: no eeg sample for 'window' seconds, or all channels flat (peak to peak below
+    'flat' uV in every 'check' seconds) for 'window' seconds (headband off). missing samples only count while the
+    muse app records (mind monitor has no recording state: stopping its stream is a loss too).
+    """
+
+    name = 'signal_loss'
+    streams = ('eeg',)
+    DEFAULTS = dict(Detector.DEFAULTS, window=10, flat=1.0, check=0.25, begin_after=0, cooldown=30, reset_after=60,
+                    ladder=[[0, 'audio/alarm-clock-short.mp3', 60], [3, 'audio/fx-loud-emergency-alarm.mp3', 80]])
+
+    def __init__(self, dev, settings):
+        super().__init__(dev, settings)
+        self.last = None            # receive time of the last eeg sample, None after a loss was detected
+        self.signal = None          # end of the last check with signal on a channel
+        self.low = self.high = None     # min / max per channel since check_start
+        self.check_start = 0.0
+
+    def add(self, stream, rows, times):
+        self.last = times[-1]
+        if self.low is None:
+            self.low, self.high, self.check_start = rows.min(axis=0), rows.max(axis=0), times[0]
+        else:
+            np.minimum(self.low, rows.min(axis=0), out=self.low)
+            np.maximum(self.high, rows.max(axis=0), out=self.high)
+        if times[-1] - self.check_start < self.settings['check']:
+            return None
+
+        if self.signal is None or (self.high - self.low).max() >= self.settings['flat']:
+            self.signal = times[-1]
+        self.low = self.high = None
+        return times[-1] if times[-1] - self.signal >= self.settings['window'] else None
+
+    def poll(self, now):
+        due = self.deadline()
+        if due is None or now < due:
+            return None
+        stream = self.dev['stream']
+        self.last = self.signal = self.low = self.high = None
+        if self.dev['folder']['tmp'] == '' or (stream['from_muse_app'] and stream['rec'] == 0 and stream['calibrate'] == 0):
+            return None
+        return due
+
+    def deadline(self):
+        return self.last + self.settings['window'] if self.last is not None else None
+
+
+class Drowsiness_Detector(Detector):
+    """
+    The theta / alpha ratio of the eeg band power (mean over the channels) stays above 'factor' times its mean over
+    the first 'baseline' seconds of the recording for 'window' seconds.
+    """
+
+    name = 'drowsiness'
+    streams = ('band_power',)
+    DEFAULTS = dict(Detector.DEFAULTS, baseline=60, factor=1.5, window=20, begin_after=90,
+                    ladder=[[0, 'audio/boreal_owl.mp3', 60], [3, 'audio/biohazard-alarm.mp3', 60]])
+
+    def __init__(self, dev, settings):
+        super().__init__(dev, settings)
+        self.recording = None       # rec_start_time of the recording the baseline belongs to
+        self.start = None           # receive time of the first estimate of the baseline
+        self.total = 0.0            # sum and number of the ratios of the baseline
+        self.count = 0
+        self.above = None           # receive time since the ratio is above the threshold
+
+    def add(self, stream, rows, times):
+        if self.dev['stats']['rec_start_time'] != self.recording:
+            self.recording = self.dev['stats']['rec_start_time']
+            self.start = self.above = None
+            self.total, self.count = 0.0, 0
+
+        fired = None
+        for estimate, t in zip(rows, times):
+            ratio = theta_alpha(estimate)
+            if not np.isfinite(ratio):
+                continue
+            if self.start is None:
+                self.start = t
+            if t - self.start < self.settings['baseline'] or self.count == 0:
+                self.total += ratio
+                self.count += 1
+            elif ratio > self.settings['factor'] * self.total / self.count:
+                if self.above is None:
+                    self.above = t
+                if t - self.above >= self.settings['window']:
+                    fired = t
             else:
-                if current_time >= last_play_time + cooldown_nod:
-                    data['stats']['moved_continuous'] = 0
-                    pass
-
-
-
-            #data['stats']['moved'] = f"{moved}"
-
-        time.sleep(0.5)  # Adjust sleep time as necessary
-
-
-def analyze_movement(history, nod_threshold_magnitude):
-    # Parameters for nod detection 
-    # nod_threshold_magnitude: 0.8 seems best for me (very sensitiv), 0.09 probably good for people who move more like kRob,  1.0 relaxed
-    # x+y was also good..
-    THRESHOLD_MAGNITUDE = nod_threshold_magnitude  # Minimum movement to be considered significant
-    CONSISTENCY_THRESHOLD = 0.6  # 60% of movements should be in the same direction for a nod
-
-    moved = {'dx':0,'dy':0,'dz':0}
-
-    # Analyze x and y movements for nodding patterns
-    for axis in ['dx', 'dy', 'dz']:
-        # Count movements in both directions
-        positive_movements = sum(1 for move in history if move[axis] > THRESHOLD_MAGNITUDE)
-        negative_movements = sum(1 for move in history if move[axis] < -THRESHOLD_MAGNITUDE)
-
-        total_significant_movements = positive_movements + negative_movements
-
-        # Check if there's a dominant direction, suggesting a nod or shake
-        if total_significant_movements > 0:
-            direction_ratio = max(positive_movements, negative_movements) / total_significant_movements
-
-            if direction_ratio > CONSISTENCY_THRESHOLD:
-
-               return True
-
-                # # Determine the type of movement based on which axis and direction is dominant
-                # if axis == 'dx' and positive_movements > negative_movements:
-                #     print("Forward nod detected!")
-                # elif axis == 'dx':
-                #     print("Backward nod detected!")
-                # elif axis == 'dy' and positive_movements > negative_movements:
-                #     print("Right shake detected!")
-                # elif axis == 'dy':
-                #     print("Left shake detected!")
-
-    return False
-    # Additional check for circular or more complex movements could be implemented here
-    # For instance, checking if movements alternate between axes in a pattern
+                self.above = None
+        return fired
+
+
+DETECTORS = {detector.name: detector for detector in (Nod_Detector, Stillness_Detector, Signal_Loss_Detector,
+                                                      Drowsiness_Detector)}
+SOURCES = {'band_power': 'eeg'}
+
+
+def feedback_streams(conf):
+    """ the streams that get a feedback buffer: the ones the detectors need, the eeg for --band_power """
+    streams = {stream for name in conf['feedback'] for stream in DETECTORS[name].streams}
+    if conf['band_power']:
+        streams.add('band_power')
+    return {SOURCES.get(stream, stream) for stream in streams}
+
+
+def load_feedback_config(path):
+    """ detector name -> settings (--feedback_config) """
+    if path is None:
+        return {}
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    for name, settings in config.items():
+        if name not in DETECTORS:
+            raise ValueError(f"unknown detector '{name}' ({', '.join(DETECTORS)})")
+        unknown = set(settings) - set(DETECTORS[name].DEFAULTS)
+        if unknown:
+            raise ValueError(f"unknown settings for {name}: {', '.join(sorted(unknown))}")
+    return config
+
+
+class Feedback_Rule:
+    """ if a detector that fired plays a sound now, and which. the counters are in dev['stats']['feedback'][name] """
+
+    def __init__(self, settings, counters):
+        self.begin_after = settings['begin_after']
+        self.cooldown = settings['cooldown']
+        self.reset_after = settings['reset_after']
+        self.ladder = sorted(settings['ladder'])
+        self.counters = counters        # fired: cues of this recording, continuous: cues in a row
+        self.last_play = float('-inf')  # time.monotonic() of the last cue
+
+    def update(self, fired, rec_start_time):
+        """ (sound, volume) to play, or None """
+        now = time.monotonic()
+        if fired and time.time() > rec_start_time + self.begin_after:
+            if now - self.last_play < self.cooldown:
+                return None
+            cue = [(sound, volume) for count, sound, volume in self.ladder if count <= self.counters['continuous']]
+            self.counters['fired'] += 1
+            self.counters['continuous'] += 1
+            self.last_play = now
+            return cue[-1] if cue else None
+
+        if now >= self.last_play + self.reset_after:
+            self.counters['continuous'] = 0
+        return None
+
+
+class Feedback_Engine:
+    """ the detectors of --feedback (and the band power) for every device, evaluated in step() """
+
+    def __init__(self, data):
+        self.data = data
+        self.names = data['conf']['feedback']
+        config = data['conf']['feedback_config']
+        self.settings = {name: dict(DETECTORS[name].DEFAULTS, **config.get(name, {})) for name in self.names}
+        self.devices = {}       # id(dev) -> [(detector, rule)]
+        self.band_power = {}    # id(dev) -> Band_Power (--band_power)
+        self.player = None
+        if self.names:
+            sounds = {sound for settings in self.settings.values() for count, sound, volume in settings['ladder']}
+            self.player = Audio_Player(create_backend(data['conf']['audio_backend']), sorted(sounds))
+
+    def _detectors(self, dev):
+        if id(dev) not in self.devices:
+            detectors = []
+            for name in self.names:
+                counters = dev['stats']['feedback'].setdefault(name, {'fired': 0, 'continuous': 0})
+                detectors.append((DETECTORS[name](dev, self.settings[name]), Feedback_Rule(self.settings[name], counters)))
+            self.devices[id(dev)] = detectors
+            if self.data['conf']['band_power']:
+                self.band_power[id(dev)] = Band_Power(dev['feedback']['eeg'].width, self.data['conf']['sampling_rate']['eeg'])
+        return self.devices[id(dev)]
+
+    @staticmethod
+    def _feed(detectors, fired, stream, rows, times):
+        for detector, rule in detectors:
+            if stream in detector.streams:
+                t = detector.add(stream, rows, times)
+                if t is not None:
+                    fired[detector.name] = t
+
+    def step(self):
+        """ feeds the new samples of all devices to their detectors and plays the cues """
+        for dev in list(self.data['devices']):
+            detectors = self._detectors(dev)
+            fired = {}
+            for stream, buffer in dev['feedback'].items():
+                if buffer is None:
+                    continue
+                while not buffer.empty():
+                    start, rows, times = buffer.read()
+                    rows = np.array(rows, dtype=np.float64)
+                    times = np.array(times)
+                    buffer.advance(len(rows))
+                    if len(rows) == 0:
+                        continue
+                    self._feed(detectors, fired, stream, rows, times)
+                    if stream == 'eeg' and id(dev) in self.band_power:
+                        estimate_times, estimates = self.band_power[id(dev)].add(rows, times)
+                        if len(estimates):
+                            dev['stats']['band_power'] = estimates[-1]
+                            self._feed(detectors, fired, 'band_power', estimates, estimate_times)
+                    dev['stats']['feedback_delay'] = time.monotonic() - times[-1]
+
+            now = time.monotonic()
+            for detector, rule in detectors:
+                t = fired.get(detector.name)
+                if t is None:
+                    t = detector.poll(now)
+                cue = rule.update(t is not None, dev['stats']['rec_start_time'])
+                if cue is not None:
+                    sound, volume = cue
+                    latency = functools.partial(dev['stats'].__setitem__, 'feedback_latency')
+                    self.player.cue(sound, volume, since=t, done=latency)
+
+    def close(self):
+        if self.player is not None:
+            self.player.close()
+
+    def next_delay(self):
+        """ seconds until the next deadline of a detector (at most MAX_WAIT) """
+        deadlines = [detector.deadline() for detectors in self.devices.values() for detector, rule in detectors]
+        deadlines = [due for due in deadlines if due is not None]
+        if not deadlines:
+            return MAX_WAIT
+        return min(max(min(deadlines) - time.monotonic(), 0.0), MAX_WAIT)
+
+
+# threads and multiprocess runtime: runs in the main thread until the programm is exiting (gracefully_end())
+def feedback_start(data):
+
+    shutdown = data['conf']['shutdown']
+    wakeup = data['conf']['feedback_wakeup']
+    if wakeup is None:
+        # no --feedback or --band_power
+        while not shutdown.wait(MAX_WAIT):
+            pass
+        return
+
+    engine = Feedback_Engine(data)
+    try:
+        while not shutdown.is_set():
+            wakeup.wait(engine.next_delay())
+            engine.step()
+    finally:
+        engine.close()
+
+
+# asyncio runtime (lib/async_runtime.py), feedback_wakeup.use_asyncio() was called in the loop
+async def feedback_task(data):
+
+    engine = Feedback_Engine(data)
+    try:
+        while True:
+            await data['conf']['feedback_wakeup'].wait_async(engine.next_delay())
+            engine.step()
+    finally:
+        engine.close()
@@ -1,4 +1,17 @@
 import argparse
+import os
+import threading
+
+import numpy as np
+
+from lib.feedback import DETECTORS, WAKE_SECONDS, feedback_streams, load_feedback_config
+from lib.rate_monitor import Rate_Monitor
+from lib.ring_buffer import Ring_Buffer
+from lib.runtime_state import Config
+from lib.shared_ring_buffer import Shared_Ring_Buffer
+from lib.side_channels import SIDE_CHANNELS, Side_Channel
+from lib.signal_gate import Signal_Gate
+from lib.writer_wakeup import Writer_Wakeup
 
 
 
@@ -18,29 +31,79 @@ def parse_arguments():
     parser.add_argument('--no_acc_file', action='store_true',
                         help='Disables accelerator (gryoscope) file.')
     parser.add_argument('--no_signal_quality_file', action='store_true',
-                        help='Disables Signal Quality file. (tp9,af7,af8,tp10 sensors). 1 = good connection, 2 = mediocre connection, 4 = poor connection. same row count as the eeg signal.')
+                        help='Disables Signal Quality file. (tp9,af7,af8,tp10 sensors). 1 = good connection, 2 = mediocre connection, 4 = poor connection. one line per change: eeg_row,tp9,af7,af8,tp10 (the value is valid from this row of the eeg file on), see --expand_side_channels.')
     parser.add_argument('--no_ica_file', action='store_true',
-                        help='Disables ICA file. 1 = signal is without artifacts, 0 = artifacts (blink, muscle contract). same row count as the eeg signal, but is 1s behind the eeg signal. eg: line 456 of the eeg file corresbonds to line 200 of the ica file.')
+                        help='Disables ICA file. 1 = signal is without artifacts, 0 = artifacts (blink, muscle contract). one line per change: eeg_row,ica, but is 1s behind the eeg signal.')
     parser.add_argument('--no_drlref_file', action='store_true',
-                        help='Disables file for Muse DRL and REF sensors. The units of both values are in microvolts. (used as reference electrodes to see incongruities between sensors)')
+                        help='Disables file for Muse DRL and REF sensors. The units of both values are in microvolts. (used as reference electrodes to see incongruities between sensors). one line per change: eeg_row,drl,ref')
+    parser.add_argument('--expand_side_channels', action='store_true',
+                        help='Write signal_quality, ica and drlref with one row per eeg row into the zip file (same row count as the eeg file, eg. for EegLab). Default disabled: one line per change (much smaller).')
     parser.add_argument('--add_aux_columns', action='store_true',
                         help='Add auxiliary signal columns (aux0 and aux1) for recording eeg signals. Default: disabled because you need to connect a external electrode to the muse (most people dont use it).')
     parser.add_argument('--use_tabseparator_for_csv', action='store_true',
                         help='Use tab as separator in CSV. Default is comma separator.')
     parser.add_argument('--add_header_row', action='store_true',
                         help='Add header row (eg tp9,af7,af8,tp10 for the eeg data). Default disabled because EegLab doesnt accept a header row.')
-    parser.add_argument('--port', type=int, default=5000,
-                        help='Default 5000. Port number for the server.')
+    parser.add_argument('--port', type=int, nargs='+', default=[5000],
+                        help='Default 5000. Port number for the server. Several ports record several headbands at once (eg. --port 5000 5001), each gets its own files and its own receiver (a process with --runtime multiprocess).')
+    parser.add_argument('--split_by_sender', action='store_true',
+                        help='Record several headbands that stream to the same port: every sender ip address gets its own files. Default disabled.')
+    parser.add_argument('--max_devices', type=int, default=4,
+                        help='Default 4. Max number of headbands recorded at the same time with --split_by_sender (packets from more senders are ignored).')
     parser.add_argument('--ip', type=str, default='0.0.0.0',
                         help='Default "0.0.0.0". IP address for the server to listen to. "0.0.0.0" listens to all ip addresses.')
     parser.add_argument('--file_name_prefix', type=str, default='eeg_',
                         help='Default "eeg_". File name prefix for output files.')
     parser.add_argument('--feedback_acc', action='store_true',
-                        help='Use the Accelerometer data to find sleepiness. Default: disabled')
+                        help='Use the Accelerometer data to find sleepiness (same as --feedback nod). Default: disabled')
+    parser.add_argument('--feedback', type=str, nargs='+', default=[], choices=list(DETECTORS),
+                        help='Default none. Biofeedback detectors that play a sound: "nod" (the head nods when you get sleepy), "stillness" (no movement for minutes), "signal_loss" (no eeg or all channels flat while recording), "drowsiness" (the theta / alpha ratio of the eeg rises above the start of the recording). Several can be used at once (eg. --feedback nod signal_loss).')
+    parser.add_argument('--audio_backend', type=str, default='mpv', choices=['mpv', 'spawn', 'stub'],
+                        help='Default "mpv". How the feedback sounds are played: "mpv" one mpv that runs all the time (fast, needs mpv), "spawn" a new mpv for every sound, "stub" no sound (for tests without audio).')
+    parser.add_argument('--band_power', action='store_true',
+                        help='Compute the eeg band power (delta, theta, alpha, beta) while recording and show the theta / alpha ratio in the status line. Default: disabled (on with --feedback drowsiness).')
+    parser.add_argument('--feedback_config', type=str, default=None,
+                        help='Json file with the settings of the feedback detectors: window, thresholds, cooldown, begin_after, reset_after and the escalation ladder ([cues in a row, sound, volume] steps), eg. {"nod": {"cooldown": 30, "ladder": [[0, "audio/wolf.mp3", 80]]}}. See the DEFAULTS in lib/feedback.py.')
     parser.add_argument('--wait_before_starting_new_rec', type=int, default=15,
                         help='Default 15. Time in seconds to wait when the osc stream stopped until closing the file and starting a new one.')
     parser.add_argument('--graphs_folder', type=str, default='cache',
                         help='folder where the generated images are stored and the http server is started in. defautl: cache')
+    parser.add_argument('--add_time_column', action='store_true',
+                        help='Add a first column with the receive time of each sample (seconds since the start of the recording). Default disabled because EegLab would read it as an extra channel.')
+    parser.add_argument('--fill_gaps_with_nan', action='store_true',
+                        help='If udp packets got lost (the stream fell behind the nominal sampling rate), insert NaN rows for the missing samples, so the row number stays aligned with the time. Default disabled (gaps are only counted and listed in gaps.csv).')
+    parser.add_argument('--osc_engine', type=str, default='pythonosc', choices=['pythonosc', 'batch'],
+                        help='Default "pythonosc". "batch" reads all waiting udp packets at once and decodes the /eeg, /muse/eeg, /acc and /ppg messages directly (less cpu usage on phones). All other osc addresses are still handled by pythonosc.')
+    parser.add_argument('--buffer_seconds', type=int, default=120,
+                        help='Default 120. How many seconds of data the buffer of every stream can hold until the file writer writes them (it stops while the files are zipped).')
+    parser.add_argument('--buffer_policy', type=str, default='drop_oldest', choices=['drop_oldest', 'drop_newest', 'spill'],
+                        help='Default "drop_oldest". What happens if a buffer is full: overwrite the oldest samples, ignore the new samples, or write the new samples to a temporary file until the writer caught up (nothing is lost). The fill level (high-water mark), dropped samples and spilled bytes are shown in the status line and saved in buffers.csv in the zip file.')
+    parser.add_argument('--format', type=str, default='csv', choices=['csv', 'binary', 'edf', 'bdf'],
+                        help='Default "csv". "binary" writes eeg, heart rate and acc as float32 .bin files with a json header (4x smaller, almost no cpu usage while recording, loads with one numpy call). Convert them to the csv files with tools/binary_to_csv.py. "edf" / "bdf" write them into one EDF+ (16 bit) / BDF+ (24 bit) file per recording with the signal quality changes and notes as annotations, it opens in EEGLAB, MNE, EDFbrowser.. with rates and channel names.')
+    parser.add_argument('--compress_while_recording', action='store_true',
+                        help='Write the csv files directly into the zip file while recording (no tmp folder, no packing pause when a recording ends). Not possible with --format binary, edf and bdf.')
+    parser.add_argument('--zip_workers', type=int, default=0,
+                        help='Default 0: one per cpu core. Number of processes that compress the files of a finished recording into the zip file (1: no extra process).')
+    parser.add_argument('--zip_level', type=int, default=6, choices=range(1, 10), metavar='1-9',
+                        help='Default 6. Compression level of the zip files, 1 is the fastest, 9 the smallest.')
+    parser.add_argument('--segment_minutes', type=float, default=0,
+                        help='Split the eeg, heart rate and acc files of a recording into numbered files of exactly this many minutes of samples (eg. 5, that is 5*60*256 eeg rows). Every closed file is listed with its checksum in segments.csv. Default 0: one file per stream. Not possible with --compress_while_recording and --format edf / bdf.')
+    parser.add_argument('--flush_policy', type=str, default='seconds', choices=['seconds', 'samples', 'rotation'],
+                        help='Default "seconds". When the written rows are flushed from python to the files: every --flush_every seconds, every --flush_every rows of a file, or only when the recording is zipped (fewest writes, but a crash loses the whole recording).')
+    parser.add_argument('--flush_every', type=float, default=10,
+                        help='Default 10. Seconds or rows between two flushes (see --flush_policy).')
+    parser.add_argument('--max_latency', type=float, default=10,
+                        help='Default 10. Max seconds between receiving a sample and writing it to its file. The writer sleeps until then (or until a buffer is a quarter full), a stopped stream is noticed right when --wait_before_starting_new_rec is over. Eg. 0.25 with --flush_every 0.25 for the least data lost in a crash.')
+    parser.add_argument('--fsync', action='store_true',
+                        help='Also force every flush (and the zip file) to the disk with fsync. Safer if the phone turns off, but more writes to the flash memory.')
+    parser.add_argument('--csv_decimals', type=int, default=None,
+                        help='Write the values with this number of decimals (eg. 3). Default: full precision, as received.')
+    parser.add_argument('--aligned_file', action='store_true',
+                        help='Also write an aligned csv file while recording: one row per eeg row with the time, eeg, heart rate and acc (interpolated to the eeg row by their receive times), signal quality, ica and drlref. Convert old recordings with tools/align_export.py.')
+    parser.add_argument('--ica_lag', type=float, default=1.0,
+                        help='Default 1.0. Seconds the ica values arrive after the eeg they belong to, the aligned file moves them back by this (see --aligned_file).')
+    parser.add_argument('--runtime', type=str, default='threads', choices=['threads', 'asyncio', 'multiprocess'],
+                        help='Default "threads". "asyncio" runs the osc server, file writer, stats and feedback in one asyncio loop that only wakes up when data arrives or a task is due (fewer wakeups on battery powered devices). --osc_engine is ignored with "asyncio". "multiprocess" receives the osc stream in its own process (shared memory buffers), so writing and zipping the files cannot slow down the receiving (no lost udp packets on slow phones).')
 
     return parser.parse_args()
 
@@ -50,8 +113,8 @@ def init_conf(data):
 
     args = parse_arguments()
 
-    # Create a configuration dictionary with the parsed arguments
-    data['conf'] = {
+    # Create the configuration with the parsed arguments (lib/runtime_state.py)
+    data['conf'] = Config({
         'only_record_if_signal_is_good': args.only_record_if_signal_is_good,
         'if_signal_is_not_good_set_signal_to': args.if_signal_is_not_good_set_signal_to,
         'no_heart_rate_file': args.no_heart_rate_file,
@@ -59,17 +122,39 @@ def init_conf(data):
         'no_signal_quality_file': args.no_signal_quality_file,
         'no_ica_file': args.no_ica_file,
         'no_drlref_file': args.no_drlref_file,
+        'expand_side_channels': args.expand_side_channels,
         'add_aux_columns': args.add_aux_columns,
         'use_tabseparator_for_csv': args.use_tabseparator_for_csv,
-        # 'add_time_column': args.add_time_column,
+        'add_time_column': args.add_time_column,
+        'fill_gaps_with_nan': args.fill_gaps_with_nan,
         'add_header_row': args.add_header_row,
         'port': args.port,
+        'split_by_sender': args.split_by_sender,
+        'max_devices': args.max_devices,
         'ip': args.ip,
         'file_name_prefix': args.file_name_prefix,
-        'feedback_acc': args.feedback_acc,
+        'feedback': sorted(set(args.feedback + (['nod'] if args.feedback_acc else []))),
+        'band_power': args.band_power,
+        'audio_backend': args.audio_backend,
         'wait_before_starting_new_rec': args.wait_before_starting_new_rec,
         'graphs_folder': args.graphs_folder,
-    }
+        'osc_engine': args.osc_engine,
+        'runtime': args.runtime,
+        'buffer_seconds': args.buffer_seconds,
+        'buffer_policy': args.buffer_policy,
+        'format': args.format,
+        'compress_while_recording': args.compress_while_recording,
+        'segment_minutes': args.segment_minutes,
+        'zip_workers': args.zip_workers or os.cpu_count() or 1,
+        'zip_level': args.zip_level,
+        'flush_policy': args.flush_policy,
+        'flush_every': args.flush_every,
+        'max_latency': args.max_latency,
+        'fsync': args.fsync,
+        'csv_decimals': args.csv_decimals,
+        'aligned_file': args.aligned_file,
+        'ica_lag': args.ica_lag,
+    })
 
 
     # Define the CSV column names based on OSC addresses
@@ -83,15 +168,71 @@ def init_conf(data):
     if data['conf']['add_aux_columns']:
         data['columns']['eeg'].extend(['aux0', 'aux1'])
 
+    # how many seconds of data the ring buffers between osc server and file writer can hold (--buffer_seconds).
+    # the writer empties them every --max_latency seconds, if it falls behind more than that --buffer_policy decides
+    # what is lost
+    if data['conf']['runtime'] == 'multiprocess' and data['conf']['buffer_policy'] == 'spill':
+        print(' --buffer_policy spill is not possible with --runtime multiprocess, using drop_newest')
+        data['conf']['buffer_policy'] = 'drop_newest'
+
+    if data['conf']['compress_while_recording'] and data['conf']['format'] != 'csv':
+        print(f" --compress_while_recording is not possible with --format {data['conf']['format']}, the files are zipped at the end")
+        data['conf']['compress_while_recording'] = False
+
+    if data['conf']['format'] in ('edf', 'bdf'):
+        # the time of a sample is its position in the edf file, one file per recording (the header is rewritten)
+        if data['conf']['add_time_column']:
+            print(f" --add_time_column is not possible with --format {data['conf']['format']}, the records have the times")
+            data['conf']['add_time_column'] = False
+        if data['conf']['segment_minutes']:
+            print(f" --segment_minutes is not possible with --format {data['conf']['format']}, the file is not split")
+            data['conf']['segment_minutes'] = 0
+
+    if data['conf']['segment_minutes'] and data['conf']['compress_while_recording']:
+        print(' --segment_minutes is not possible with --compress_while_recording, the files are not split')
+        data['conf']['segment_minutes'] = 0
+
+    # settings of the feedback detectors (--feedback_config, lib/feedback.py)
+    try:
+        data['conf']['feedback_config'] = load_feedback_config(args.feedback_config)
+    except (OSError, ValueError) as e:
+        raise SystemExit(f" --feedback_config {args.feedback_config}: {e}")
+    if data['conf']['no_acc_file'] and 'acc' in feedback_streams(data['conf']):
+        print(' --feedback nod / stillness need the acc data, they get nothing with --no_acc_file')
+    # the eeg band power (lib/band_power.py) is computed by the feedback engine
+    if any('band_power' in DETECTORS[name].streams for name in data['conf']['feedback']):
+        data['conf']['band_power'] = True
+
+    # seconds of data kept for the feedback detectors (read as soon as they arrive, the oldest are dropped if it stalls)
+    data['conf']['feedback_seconds'] = 10
+    # the osc handlers wake up the feedback engine when new samples arrive (lib/feedback.py)
+    data['conf']['feedback_wakeup'] = Writer_Wakeup() if data['conf']['feedback'] or data['conf']['band_power'] else None
+
+    # max changes per second of signal_quality, ica and drlref the buffers are sized for (/hsi and /is_good
+    # are sent with about 10Hz)
+    data['conf']['side_channel_rate'] = 64
+
+    # the file writer sleeps until --max_latency is over, a recording times out, or a buffer is filled up to
+    # wake_fill of its capacity (lib/writer_wakeup.py)
+    data['conf']['wake_fill'] = 0.25
+    data['conf']['wakeup'] = Writer_Wakeup()
+
 
 
 
     data['conf']['exiting'] = False # marker for threads that the programm is exiting
+    data['conf']['shutdown'] = threading.Event()    # set when exiting starts: the loops of the threads stop
+    data['conf']['ended'] = threading.Event()       # set when all files are packed
 
     # muse s and muse 2 have the same specs for eeg, ppg (heart_rate), and acc (gryoscope)
     #  (signal_quality has the same sampling rate as eeg)
     data['conf']['sampling_rate'] = {'eeg': 256, 'heart_rate': 64, 'acc': 52, 'signal_quality':256, 'ica': 10, 'drlref':256}
 
+    # packet loss detection: a gap is counted if a stream falls more than gap_seconds behind its nominal sampling rate.
+    # gaps longer than pause_seconds are a pause of the stream (muse app paused, new session) and not counted
+    data['conf']['gap_seconds'] = 0.25
+    data['conf']['pause_seconds'] = 5
+
 
     # nod_threshold_magnitude: how sensitive the nodding recognition is.
     # good values are between 0.10 and 0.08 (0.08 beeing more sensitive and 0.10 less so)
@@ -101,7 +242,58 @@ def init_conf(data):
     # how slow do you nodd? each increase in number adds 0.5s to the recognised nod length (20 -> 10s nod is recognised)
     data['conf']['nod_length'] = 20
 
+    # max number of udp packets the batch receiver (--osc_engine batch) reads from the socket before processing them
+    data['conf']['osc_batch_size'] = 256
+
     # the time the script waits while no osc data arrives, before assuming its a new recording session and starts a new file
     # data['conf']['wait_before_starting_new_rec'] = 15        # now set through arg parse
 
+    init_streams(data)
+
+
+def init_streams(data, streams=None):
+    # buffers, packet loss detection and signal quality state of one device (headband).
+    # called for the main data in init_conf() and for every additional device (lib/devices.py)
+    # streams: buffers and gate that already exist in shared memory (receiver process, lib/multiprocess_runtime.py)
+
+    if streams is not None:
+        data['buffer'].update(streams['buffer'])
+        data['side'].update(streams['side'])
+        data['feedback'].update(streams['feedback'])
+        data['gate'] = streams['gate']
+
+    else:
+        # one fixed size buffer per stream, sized for its sampling rate
+        buffer_class = Shared_Ring_Buffer if data['conf']['runtime'] == 'multiprocess' else Ring_Buffer
+        for name in data['buffer']:
+            capacity = data['conf']['buffer_seconds'] * data['conf']['sampling_rate'][name]
+            data['buffer'][name] = buffer_class(data['columns'][name], capacity, timestamps=True,
+                                                policy=data['conf']['buffer_policy'])
+
+        # samples for the feedback detectors (lib/feedback.py), only the streams they need. eeg without aux columns
+        for name in feedback_streams(data['conf']):
+            data['feedback'][name] = buffer_class(data['columns'][name][:4], data['conf']['feedback_seconds'] * data['conf']['sampling_rate'][name],
+                                                  timestamps=True)
+
+        # signal_quality, ica and drlref: only the changes. signal quality (1,2,4) and ica (0,1) are written as integers
+        capacity = data['conf']['buffer_seconds'] * data['conf']['side_channel_rate']
+        dtypes = {'signal_quality': np.int8, 'ica': np.int8}
+        for name, key in SIDE_CHANNELS.items():
+            data['side'][name] = Side_Channel(data['columns'][name], data['buffer']['eeg'], data['signal'][key], capacity,
+                                              dtype=dtypes.get(name, np.float32), buffer_class=buffer_class)
+
+        # signal quality state over the eeg sample index (for --only_record_if_signal_is_good)
+        data['gate'] = Signal_Gate(data['buffer']['eeg'], buffer_class=buffer_class)
+
+    # the producer wakes up the file writer (not set in the receiver process, the main process checks the buffers)
+    if data['conf']['wakeup'] is not None:
+        for name, buffer in data['buffer'].items():
+            buffer.wake_writer(data['conf']['wakeup'], buffer.capacity * data['conf']['wake_fill'], when_idle=(name == 'eeg'))
+    if data['conf']['feedback_wakeup'] is not None:
+        for name, buffer in data['feedback'].items():
+            if buffer is not None:
+                buffer.wake_writer(data['conf']['feedback_wakeup'], data['conf']['sampling_rate'][name] * WAKE_SECONDS)
 
+    for name in data['rate']:
+        data['rate'][name] = Rate_Monitor(name, data['conf']['sampling_rate'][name], gap_seconds=data['conf']['gap_seconds'],
+                                          pause_seconds=data['conf']['pause_seconds'], fill=data['conf']['fill_gaps_with_nan'])
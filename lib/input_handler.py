@@ -12,7 +12,7 @@ def start_input(data):
 
     # user_input = input(" Exit: x (+Enter) | new rec: n | reset nod: n0 \n")
     # print(" \n to interact with the script press the Command + ENTER (sometimes needs 2 presses :-)")
-    print("\n Commands: x = Exit | r = rec new file | 0 = reset ∞nod \n")
+    print("\n Commands: x = Exit | r = rec new file | 0 = reset ∞feedback \n")
 
     time.sleep(3)       # needs to wait shortly (pycharm sends the input to record_to_file.py thread otherwise..)
 
@@ -25,7 +25,10 @@ def start_input(data):
 
 
         if user_input == '0':
-            data['stats']['moved_continuous'] = 0
+            # the escalation ladders of the feedback detectors start again (lib/feedback.py)
+            for dev in data['devices']:
+                for counters in dev['stats']['feedback'].values():
+                    counters['continuous'] = 0
 
 
         if user_input == 'x':
@@ -33,11 +36,13 @@ def start_input(data):
 
 
         if user_input == 'r':
-            if data['folder']['tmp'] == '':
+            recording = [dev for dev in data['devices'] if dev['folder']['tmp'] != '']
+            if len(recording) == 0:
                 print('nothing is recorded right now. returning to normal programm')
             else:
                 # print('not yet working.')
-                close_and_zip_files(data)
+                for dev in recording:
+                    close_and_zip_files(dev)
 
 
         if user_input == 'n':
@@ -0,0 +1,108 @@
+import json
+import time
+
+
+# manifest.json in every zip file: what the recording contains, from the counters the writer keeps while
+# recording (lib/throughput.py, lib/rate_monitor.py, lib/ring_buffer.py), so closing a recording doesn't need to
+# read the files again and tools can read one small file instead of unpacking the eeg file.
+
+MANIFEST_VERSION = 2
+
+# side channels with a histogram of their values (in eeg rows) in the manifest
+HISTOGRAM_CHANNELS = ('signal_quality',)
+
+
+class Value_Histogram:
+    """ number of eeg rows per value and column of a side channel, fed with the written changes """
+
+    def __init__(self, columns, value, row=0):
+        self.columns = list(columns)
+        self.counts = {column: {} for column in self.columns}
+        self.value = value
+        self.row = row
+
+    def _add(self, rows):
+        for column, v in zip(self.columns, self.value):
+            key = f"{v:g}"
+            self.counts[column][key] = self.counts[column].get(key, 0) + rows
+
+    def change(self, row, value):
+        """ value is valid from eeg row 'row' on """
+        self._add(row - self.row)
+        self.value = value
+        self.row = row
+
+    def result(self, end_row):
+        """ the counts up to eeg row end_row (not included) """
+        counts = {column: dict(values) for column, values in self.counts.items()}
+        for column, v in zip(self.columns, self.value):
+            key = f"{v:g}"
+            counts[column][key] = counts[column].get(key, 0) + max(end_row - self.row, 0)
+        return counts
+
+
+def iso_time(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(t)) if t is not None else None
+
+
+def source_app(data):
+    # from_mindmonitor_app is only set after a switch from the muse app (lib/osc_server.py stream_is_recording())
+    return 'muse' if data['stream']['from_muse_app'] == 1 else 'mind_monitor'
+
+
+def recording_manifest(data, zip_file_name):
+    """ the manifest of the current recording of a device (called before the counters are reset) """
+    first_time = data['file']['first_time']
+    start_time = data['file']['start_time']
+
+    streams = {}
+    for name, counter in data['file']['throughput'].items():
+        stream = {
+            # the members of the zip file in segment order, [] if the file was empty (filled in by the packer)
+            'files': [],
+            'columns': data['columns'][name],
+            'rows': counter.rows,
+            'bytes': counter.bytes,
+        }
+        if name in data['buffer']:
+            buffer = data['buffer'][name]
+            rate = data['rate'][name]
+            stream.update({
+                'nominal_rate': data['conf']['sampling_rate'][name],
+                # receive times in seconds since the first eeg sample
+                'first_time': round(counter.first_time - first_time, 4) if counter.first_time is not None else None,
+                'last_time': round(counter.last_time - first_time, 4) if counter.last_time is not None else None,
+                'nan_rows': counter.nan_rows,
+                'dropped_samples': rate.dropped,
+                'gaps': rate.gaps,
+                'buffer_lost': buffer.lost,
+                'buffer_high_water': buffer.high_water,
+            })
+        streams[name] = stream
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'zip': zip_file_name,
+        'source': {'app': source_app(data), 'device': data['source']['name'], 'port': data['source']['port']},
+        'start': iso_time(start_time),
+        'end': iso_time(start_time + data['file']['last_time'] - first_time),
+        'start_time': start_time,
+        'duration_seconds': round(data['file']['last_time'] - first_time, 3),
+        'eeg_rows': data['file']['rows'],
+        'settings': {name: data['conf'][name] for name in (
+            'format', 'use_tabseparator_for_csv', 'add_header_row', 'add_time_column', 'csv_decimals',
+            'only_record_if_signal_is_good', 'if_signal_is_not_good_set_signal_to', 'fill_gaps_with_nan',
+            'expand_side_channels', 'buffer_policy', 'segment_minutes')},
+        'streams': streams,
+        # --segment_minutes: the closed files of the sample streams (also in segments.csv)
+        'segments': list(data['file']['parts']),
+        'histogram': {name: histogram.result(data['file']['rows']) for name, histogram in data['file']['histogram'].items()},
+        'notes': list(data['folder']['note']),
+        # filled in by the packer (lib/record_to_file.py pack_recording())
+        'packing': None,
+    }
+    return manifest
+
+
+def manifest_json(manifest):
+    return json.dumps(manifest, indent=2) + '\n'
@@ -0,0 +1,140 @@
+import multiprocessing
+import signal
+import threading
+
+from lib.devices import create_device, start_osc_threads
+from lib.runtime_state import Config
+from lib.shared_data import Shared_Data
+
+
+# --runtime multiprocess
+#
+# in one process the csv formatting and the zip packing compete with the udp receiving for the GIL, on slow phones
+# the socket buffer overflows while packing. here minimal receiver processes run the osc servers and write the
+# samples into the ring buffers in shared memory (lib/shared_ring_buffer.py). the main process reads them and
+# does everything else (writing, packing, stats, feedback, web server, input).
+# every port gets its own receiver process, so several headbands (--port 5000 5001) are received on several cores.
+# --split_by_sender receives all headbands on one port, that is one receiver process.
+#
+# the small state that the main process needs besides the samples is sent through a queue (one for all receivers)
+# every SYNC_INTERVAL: stream state (muse app recording on/off), signal quality and detected gaps
+# (lib/rate_monitor.py). with --split_by_sender the receiver also sends every new device (headband).
+#
+# shutdown: gracefully_end() calls stop(), the receivers send their last state and end, then the files are packed
+# and the shared memory is released.
+
+SYNC_INTERVAL = 0.25
+
+# conf entries that only belong to the main process (threading.Event can't be passed to another process)
+MAIN_PROCESS_CONF = ('shutdown', 'ended', 'wakeup', 'feedback_wakeup')
+
+
+def device_streams(dev):
+    return {'buffer': dict(dev['buffer']), 'side': dict(dev['side']), 'feedback': dict(dev['feedback']), 'gate': dev['gate']}
+
+
+def send_state(data, queue):
+    for dev in list(data['devices']):
+        rates = {name: (rate.take_events(), rate.rate) for name, rate in dev['rate'].items()}
+        queue.put(('state', dev['source']['name'], dev['stream'].snapshot(), dev['signal'].snapshot(), rates))
+
+
+def receiver_main(conf, columns, specs, queue, stop):
+    # runs in the receiver process. ctrl+c is handled by the main process, which stops the receiver with 'stop'
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    data = Shared_Data()
+    data['conf'] = Config(conf, shutdown=stop)
+    data['columns'] = columns
+    for name, port, streams in specs:
+        data['devices'].append(create_device(data, name, port, streams))
+
+    def on_new_device(dev):
+        queue.put(('device', dev['source']['name'], dev['source']['port'], device_streams(dev)))
+
+    start_osc_threads(data, on_new_device)
+
+    while not stop.wait(SYNC_INTERVAL):
+        send_state(data, queue)
+    send_state(data, queue)
+    queue.put(None)
+
+
+class Receiver_Process:
+
+    def __init__(self, data):
+        self.data = data
+        self.queue = multiprocessing.Queue()
+        self.stop_event = multiprocessing.Event()
+        self.processes = []
+        self.sync_thread = None
+
+    def start(self):
+        conf = {key: value for key, value in self.data['conf'].items() if key not in MAIN_PROCESS_CONF}
+        if self.data['conf']['split_by_sender']:
+            # one port, the receiver creates the devices
+            groups = [(self.data['conf']['port'][0], [])]
+        else:
+            groups = [(dev['source']['port'], [(dev['source']['name'], dev['source']['port'], device_streams(dev))])
+                      for dev in self.data['devices']]
+        for port, specs in groups:
+            process = multiprocessing.Process(target=receiver_main, name=f'osc receiver {port}', daemon=True,
+                                              args=(conf, self.data['columns'], specs, self.queue, self.stop_event))
+            process.start()
+            self.processes.append(process)
+
+        self.sync_thread = threading.Thread(target=self.sync, daemon=True)
+        self.sync_thread.start()
+
+    def sync(self):
+        # applies the state sent by the receiver processes to the devices of the main process
+        running = len(self.processes)
+        while running:
+            message = self.queue.get()
+            if message is None:
+                running -= 1
+                continue
+
+            if message[0] == 'device':
+                name, port, streams = message[1:]
+                self.data['devices'].append(create_device(self.data, name, port, streams))
+                continue
+
+            name, stream, signal_state, rates = message[1:]
+            dev = next((dev for dev in self.data['devices'] if dev['source']['name'] == name), None)
+            if dev is None:
+                continue
+            with dev['stream'].changing():
+                dev['stream'].update(stream)
+            with dev['signal'].changing():
+                dev['signal'].update(signal_state)
+            for rate_name, (events, rate) in rates.items():
+                dev['rate'][rate_name].merge(events, rate)
+            # the receiver can't wake up the writer and the feedback engine itself
+            self.data['conf']['wakeup'].check(dev['buffer'].values())
+            if self.data['conf']['feedback_wakeup'] is not None:
+                self.data['conf']['feedback_wakeup'].check(buffer for buffer in dev['feedback'].values() if buffer is not None)
+
+    def stop(self, timeout=5):
+        """ stops the receiver processes after they sent their last state """
+        self.stop_event.set()
+        self.sync_thread.join(timeout)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+    def release(self):
+        """ removes the shared memory of all devices (after stop(), once the files are packed) """
+        devices = list(self.data['devices'])
+        if self.data not in devices:
+            devices.append(self.data)      # main data still has its own buffers with several headbands
+        for dev in devices:
+            for buffer in dev['buffer'].values():
+                buffer.release()
+            for side in dev['side'].values():
+                side.events.release()
+            for buffer in dev['feedback'].values():
+                if buffer is not None:
+                    buffer.release()
+            dev['gate'].events.release()
@@ -0,0 +1,150 @@
+import select
+import socket
+import struct
+import time
+
+import numpy as np
+
+from lib.osc_server import create_dispatcher, create_block_handlers
+
+
+# alternative to pythonosc's BlockingOSCUDPServer (--osc_engine batch)
+#
+# the pythonosc server parses the type tags, builds an args tuple and calls the handler (a functools.partial)
+# for every single datagram. at 256Hz (more with aux columns) this is the biggest cpu cost on a phone.
+# this receiver drains all datagrams that are waiting in the socket at once, decodes the fixed
+# float32 layouts of /eeg, /muse/eeg, /acc, /ppg with precompiled struct formats and hands them over
+# as a numpy block. everything else (/muse_metrics, /hsi, bundles, ..) still goes through the dispatcher.
+
+
+def _pad4(n):
+    # osc strings are null terminated and padded to a multiple of 4 bytes
+    return (n + 4) & ~3
+
+
+def compile_layout(dgram, address_end):
+    """
+    Parse the osc header (address + type tags) of a datagram once and return (header, struct) for
+    messages that only contain float32 arguments. Returns None for any other message.
+    """
+    tags_start = _pad4(address_end)
+    if dgram[tags_start:tags_start + 1] != b',':
+        return None
+    tags_end = dgram.find(b'\0', tags_start)
+    if tags_end == -1:
+        return None
+    tags = dgram[tags_start + 1:tags_end]
+    if len(tags) == 0 or tags.strip(b'f') != b'':
+        return None
+    header = dgram[:_pad4(tags_end)]
+    layout = struct.Struct(f'>{len(tags)}f')
+    if len(dgram) != len(header) + layout.size:
+        return None
+    return header, layout
+
+
+class Osc_Batch_Decoder:
+
+    def __init__(self, block_handlers, dispatcher):
+        self.block_handlers = block_handlers     # address -> handler(address, rows, times)
+        self.dispatcher = dispatcher             # fallback for all other addresses
+        self.layouts = {}                        # address -> (header bytes, struct.Struct)
+
+        # consecutive datagrams of the same address are collected and handed over as one block
+        self.run_address = None
+        self.run_rows = []
+        self.run_times = []
+
+    def flush(self):
+        if self.run_rows:
+            rows = np.array(self.run_rows, dtype=np.float32)
+            times = np.array(self.run_times, dtype=np.float64)
+            self.block_handlers[self.run_address](self.run_address, rows, times)
+            self.run_rows = []
+            self.run_times = []
+        self.run_address = None
+
+    def decode(self, dgram):
+        """ returns the decoded float values if the datagram has a known fixed layout, otherwise None """
+        address_end = dgram.find(b'\0')
+        if address_end <= 0:
+            return None
+        address = dgram[:address_end].decode('ascii', 'replace')
+        if address not in self.block_handlers:
+            return None
+
+        layout = self.layouts.get(address)
+        if layout is None or not dgram.startswith(layout[0]) or len(dgram) != len(layout[0]) + layout[1].size:
+            # first message of this address, or the number of arguments changed (eg. aux columns switched on)
+            layout = compile_layout(dgram, address_end)
+            if layout is None:
+                return None
+            self.layouts[address] = layout
+
+        return address, layout[1].unpack_from(dgram, len(layout[0]))
+
+    def process(self, batch):
+        """ batch: list of (datagram, client_address, receive time) in the order they were received """
+        for dgram, client_address, t in batch:
+            decoded = self.decode(dgram)
+
+            if decoded is None:
+                # keep the order between the fast path and the dispatcher (eg. /muse_metrics switches recording on/off)
+                self.flush()
+                self.dispatcher.call_handlers_for_packet(dgram, client_address)
+                continue
+
+            address, values = decoded
+            if address != self.run_address or len(self.run_rows) > 0 and len(self.run_rows[0]) != len(values):
+                self.flush()
+                self.run_address = address
+            self.run_rows.append(values)
+            self.run_times.append(t)
+
+        self.flush()
+
+
+def receive_batch(sock, batch_size):
+    """ blocks until at least one datagram is available, then reads everything that is waiting (max batch_size) """
+    ready, _, _ = select.select([sock], [], [], 1.0)
+    if not ready:
+        return []
+
+    batch = []
+    while len(batch) < batch_size:
+        try:
+            dgram, client_address = sock.recvfrom(65535)
+        except BlockingIOError:
+            break
+        batch.append((dgram, client_address, time.monotonic()))
+    return batch
+
+
+def osc_batch_start(data, decoder=None):
+    # data: the device to record (lib/devices.py), decoder: other decoder (eg. Sender_Router for --split_by_sender)
+
+    if decoder is None:
+        decoder = Osc_Batch_Decoder(create_block_handlers(data), create_dispatcher(data))
+    port = data['source']['port']
+    batch_size = data['conf']['osc_batch_size']
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # a bigger receive buffer survives short cpu stalls (eg. while zipping) without dropping packets
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+    except OSError:
+        pass
+    sock.bind((data['conf']['ip'], port))
+    sock.setblocking(False)
+
+    print(f"Listening on port {port} for OSC messages (batch receiver)... ")
+
+    try:
+        while True:
+            batch = receive_batch(sock, batch_size)
+            if batch:
+                decoder.process(batch)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
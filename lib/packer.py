@@ -0,0 +1,38 @@
+import queue
+import threading
+
+
+# zips the closed recordings in the background (lib/record_to_file.py close_and_zip_files())
+#
+# closing a recording only closes its files and hands them over, the writer goes on with the next recording
+# right away. the recordings are packed one after the other in the order they were closed, close requests
+# from several threads (writer, input 'r', gracefully_end()) just queue up.
+
+class Packer:
+
+    def __init__(self, pack):
+        self.pack = pack                # pack(job), runs in the packer thread
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, job):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        self.queue.put(job)
+
+    def wait(self):
+        """ blocks until all submitted recordings are packed """
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                self.pack(job)
+            except Exception as e:
+                print(' Warning: recording could not be packed.. \n', e)
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,84 @@
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import zlib
+
+
+# packs the files of a closed recording with several processes (--zip_workers, --zip_level)
+#
+# zipfile deflates one file after the other on one core. here every file is cut into CHUNK_BYTES pieces that
+# the worker processes deflate independently (like pigz, without the shared dictionary: the zip file gets
+# about 1% bigger). every piece ends with a sync flush, so the pieces just follow each other in the zip member
+# (lib/zip_stream.py write_deflated()) and the member ends with an empty last block. the pieces of all files are
+# in one queue, so small files are deflated at the same time too. the packer thread reads the pieces again for
+# the crc while the workers compress, at most 2 pieces per worker are waiting (memory).
+#
+# the pool is started with the first recording and kept until exiting (shutdown()). 'spawn': the packer is one
+# of many threads, forking it could copy locks held by the others. with one worker no process is started.
+
+CHUNK_BYTES = 8 * 1024 * 1024
+
+
+def deflate_chunk(path, offset, length, level):
+    """ runs in a worker process """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        raw = f.read(length)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(raw) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class Parallel_Zip:
+
+    def __init__(self):
+        self.pool = None
+        self.workers = 1
+
+    def _submit(self, workers, *args):
+        if workers <= 1:
+            future = concurrent.futures.Future()
+            future.set_result(deflate_chunk(*args))
+            return future
+        if self.pool is None or self.workers != workers:
+            self.shutdown()
+            self.pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+            self.workers = workers
+        return self.pool.submit(deflate_chunk, *args)
+
+    def add_files(self, zip_stream, files, workers=1, level=zlib.Z_DEFAULT_COMPRESSION):
+        """ files: (name in the zip file, path). the pieces of all files are deflated by 'workers' processes """
+        pieces = []
+        for name, path in files:
+            size = os.path.getsize(path)
+            pieces += [(name, path, offset, min(CHUNK_BYTES, size - offset)) for offset in range(0, max(size, 1), CHUNK_BYTES)]
+
+        waiting = collections.deque()
+        member = None
+        for piece in pieces:
+            waiting.append((piece, self._submit(workers, *piece[1:], level)))
+            if len(waiting) >= 2 * workers:
+                member = self._write(zip_stream, member, *waiting.popleft())
+        while waiting:
+            member = self._write(zip_stream, member, *waiting.popleft())
+        if member is not None:
+            member.close()
+
+    def _write(self, zip_stream, member, piece, future):
+        """ adds the next piece in order, returns its member """
+        name, path, offset, length = piece
+        if member is None or member.name != name:
+            if member is not None:
+                member.close()
+            member = zip_stream.open_member(name, direct=True)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            raw = f.read(length)
+        member.write_deflated(future.result(), raw)
+        return member
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
@@ -1,47 +1,68 @@
+import json
 import os
+import socket
 import subprocess
 import time
 
+
+# one mpv per sound (--audio_backend spawn). the feedback uses the long-lived player of lib/audio_player.py by
+# default, this is the fallback where it can't run
+
+def mpv_command(ipc_path, *command):
+    """ sends one command to the json ipc server of a running mpv, returns its reply (dict) """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(2)
+        sock.connect(ipc_path)
+        sock.sendall(json.dumps({'command': list(command)}).encode('utf-8') + b'\n')
+        reply = b''
+        while not reply.endswith(b'\n'):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            reply += chunk
+    # the first line that is a reply (events can come before it)
+    for line in reply.splitlines():
+        message = json.loads(line)
+        if 'error' in message:
+            return message
+    return {}
+
+
 def change_volume(volume, ipc_path):
     """
     Change the volume of the audio playback using mpv's IPC server.
 
     Parameters:
     - volume (int): The desired volume level (0 to 100).
-    - ipc_socket (str): The path to the IPC socket used by mpv.
+    - ipc_path (str): The path to the IPC socket used by mpv.
     """
     # Ensure the volume is within the valid range
     if not (0 <= volume <= 100):
         raise ValueError("Volume must be between 0 and 100.")
 
-    # JSON command to set the volume
-    command = f'{{"command": ["set_property", "volume", {volume}]}}'
-
-    # Use socat to send the command to the mpv IPC server
     try:
-        subprocess.run(
-            f'echo \'{command}\' | socat - {ipc_path}',
-            shell=True,
-            check=True
-        )
-        print(f"Volume set to {volume}.")
-    except subprocess.CalledProcessError as e:
+        reply = mpv_command(ipc_path, 'set_property', 'volume', volume)
+    except (OSError, ValueError) as e:
         print(f"Failed to change volume: {e}")
+        return
+    if reply.get('error') == 'success':
+        print(f"Volume set to {volume}.")
+    else:
+        print(f"Failed to change volume: {reply.get('error', 'no reply from mpv')}")
+
 
 def play_sound(filename, volume=50):
     """
-    Play sound using mpv with the option to run in the background.
+    Play sound using mpv in the background.
 
     Parameters:
     - filename (str): The path to the audio file to play.
     """
     ipc_path = os.path.expanduser("~/mpv_socket")
 
-    # Command to play the sound using mpv with an IPC server
-    cmd = f"mpv --no-video --volume={volume} --input-ipc-server={ipc_path} --idle=no \"{filename}\""
-
-    # Start mpv in a subprocess
-    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # Start mpv with an IPC server in a subprocess (no shell, the file name is passed as it is)
+    cmd = ['mpv', '--no-video', f'--volume={volume}', f'--input-ipc-server={ipc_path}', '--idle=no', filename]
+    subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
     # Return the IPC path for further interactions
     return ipc_path
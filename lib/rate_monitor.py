@@ -0,0 +1,107 @@
+# packet loss / gap detection for one stream (eeg, acc, heart_rate)
+#
+# every packet is stamped with time.monotonic() when it is received. the monitor compares the number of received
+# samples with the number of samples that should have arrived at the nominal sampling rate (256/52/64Hz) since an
+# anchor point. if the stream falls behind by more than gap_seconds worth of samples, the missing samples are
+# counted as dropped and a gap event is recorded (and optionally filled with NaN rows by the osc handler, so the
+# sample index stays aligned to the wall clock).
+#
+# the muse headband sends its data in bursts (12 eeg samples per bluetooth packet), so single late packets are
+# normal and stay below the gap threshold. a slow drift between the headband clock and the phone clock is
+# followed by moving the anchor a little every few seconds.
+
+class Rate_Monitor:
+
+    def __init__(self, name, nominal_rate, gap_seconds=0.25, pause_seconds=5.0, fill=False):
+        self.name = name
+        self.nominal_rate = nominal_rate
+        self.tolerance = gap_seconds * nominal_rate      # in samples
+        self.pause_seconds = pause_seconds               # longer gaps are a pause of the stream, not packet loss
+        self.fill = fill                                 # --fill_gaps_with_nan
+
+        self.count = 0              # samples received (+ filled samples)
+        self.last_time = None
+        self.gap_start = 0.0        # receive time of the packet before the last detected gap
+        self.anchor_time = 0.0
+        self.anchor_count = 0
+        self.drift_time = 0.0
+
+        # observed sampling rate, updated about once per second
+        self.rate = 0.0
+        self.window_time = 0.0
+        self.window_count = 0
+
+        # counters of the current recording session (reset by reset_counters())
+        self.dropped = 0
+        self.gaps = 0
+        self.events = []            # (receive time, sample index, dropped samples, gap length in s)
+
+    def _anchor(self, t):
+        self.anchor_time = t
+        self.anchor_count = self.count
+        self.drift_time = t
+
+    def observe(self, t, n=1):
+        """
+        Called by the osc handler before n new samples received at time t are appended.
+        Returns the number of samples that should be filled with NaN before them (0 if there was no gap or
+        filling is disabled).
+        """
+        missing = 0
+
+        if self.last_time is None or t - self.last_time > self.pause_seconds:
+            # first packet or the stream was paused (muse app pause, new recording session)
+            self._anchor(t)
+            self.window_time = t
+            self.window_count = self.count
+
+        else:
+            lag = (t - self.anchor_time) * self.nominal_rate - (self.count - self.anchor_count)
+
+            if lag > self.tolerance:
+                dropped = int(round(lag))
+                self.dropped += dropped
+                self.gaps += 1
+                self.events.append((t, self.count, dropped, t - self.last_time))
+                self.gap_start = self.last_time
+                if self.fill:
+                    missing = dropped
+                    self.count += dropped
+                self._anchor(t)
+
+            elif lag < -self.tolerance:
+                # a burst arrived faster than the nominal rate (eg. after a short stall of the phone)
+                self._anchor(t)
+
+            elif t - self.drift_time > 10:
+                # follow slow clock drift between headband and phone: move the anchor by half of the current lag
+                self.anchor_time += lag / self.nominal_rate / 2
+                self.drift_time = t
+
+        self.count += n
+        self.last_time = t
+
+        if t - self.window_time >= 1.0:
+            self.rate = (self.count - self.window_count) / (t - self.window_time)
+            self.window_time = t
+            self.window_count = self.count
+
+        return missing
+
+    def take_events(self):
+        """ returns and removes all gap events recorded so far """
+        n = len(self.events)
+        events = self.events[:n]
+        del self.events[:n]
+        return events
+
+    def merge(self, events, rate):
+        """ adds the gap events of the Rate_Monitor in the receiver process (--runtime multiprocess) """
+        self.events.extend(events)
+        self.dropped += sum(event[2] for event in events)
+        self.gaps += len(events)
+        self.rate = rate
+
+    def reset_counters(self):
+        self.dropped = 0
+        self.gaps = 0
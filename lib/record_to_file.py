@@ -1,281 +1,1003 @@
 
 
 import csv
+import glob
+import io
 import os
 
 import sys
+import threading
 import time
-import zipfile
-
-from queue import Queue
 
+import numpy as np
+
+from lib.alignment import Stream_Aligner
+from lib.binary_format import Binary_File
+from lib.edf_format import Edf_File
+from lib.packer import Packer
+from lib.parallel_zip import Parallel_Zip
+from lib.manifest import HISTOGRAM_CHANNELS, Value_Histogram, manifest_json, recording_manifest
+from lib.recovery import SEGMENTS_FILE, RECOVERY_FILE, find_orphans, lock_folder, record_segment, recover_folder, \
+    salvage_zip_part, try_lock, unlock_folder
+from lib.side_channels import SIDE_CHANNELS, expand_side_channel
+from lib.throughput import Throughput_Counter
 from lib.util import create_folder
+from lib.zip_stream import Zip_Stream
 
 
-def open_file(name, data, csv_delimiter=','):
-
-    data['file']['open'][name] = open(f"{data['folder']['out']}/{data['folder']['tmp']}/{data['file']['name'][name]}", "w", newline="")
-    data['file']['csv_writer'][name] = csv.DictWriter(data['file']['open'][name], fieldnames=data['columns'][name], delimiter=csv_delimiter)
-    if data['conf']['add_header_row']:
-        data['file']['csv_writer'][name].writeheader()
-
-
-
-def write_to_file(name, data):
-
-
-    current_timestamp = 0
-
-    try:
-
-        sr = data['conf']['sampling_rate'][name]
-
-        # Retrieve and process all items in the queue
-        while not data['buffer'][name].empty():
-            b = data['buffer'][name].get()  # Get an item from the queue
-
-            data['file']['csv_writer'][name].writerow(b)
-            data['file']['open'][name].flush()
-
-            # Mark the task as done
-            data['buffer'][name].task_done()
-
+# streams that are written as float32 .bin files with --format binary (lib/binary_format.py), or together into one
+# .edf / .bdf file with --format edf / bdf (lib/edf_format.py). the side channels stay csv files (only the changes)
+BINARY_STREAMS = ('eeg', 'heart_rate', 'acc')
 
+# --aligned_file: one row per eeg row with all streams (lib/alignment.py)
+ALIGNED = 'aligned'
 
-    except Exception as e:
-        if data['conf']['exiting'] != True:
-            print(f'    !! 10s of *{name}* data lost !!  ')
-
+# --format edf / bdf: side channels whose changes are also edf annotations (the notes are too)
+EDF_ANNOTATED_CHANNELS = ('signal_quality',)
 
+# --format binary: the .bin files grow by this many seconds of samples at a time
+BINARY_CHUNK_SECONDS = 60
 
+# streams that are split into files of --segment_minutes (the side channel files only hold the changes)
+SEGMENT_STREAMS = ('eeg', 'heart_rate', 'acc')
 
 
-# Function to write buffered data to a file every 10 seconds
-def process_buffers(data):
-
+def is_binary(name, data):
+    return data['conf']['format'] != 'csv' and name in BINARY_STREAMS
 
-    time.sleep(1)
 
-    last_received_time = None
+def is_edf(data):
+    return data['conf']['format'] in ('edf', 'bdf')
 
 
-
-    if data['conf']['use_tabseparator_for_csv']:
-        csv_delimiter = '\t'
+def open_edf_file(name, data):
+    """ --format edf / bdf: the eeg opens the file with all recorded sample streams, the others are its streams """
+    if name == 'eeg':
+        streams = [(s, data['columns'][s], data['conf']['sampling_rate'][s]) for s in BINARY_STREAMS
+                   if s == 'eeg' or not data['conf'][f'no_{s}_file']]
+        edf = Edf_File(f"{data['folder']['out']}/{data['folder']['tmp']}/{data['file']['name'][name]}", streams,
+                       start_time=data['file']['start_time'], kind=data['conf']['format'],
+                       equipment=data['source']['name'] or 'Muse')
+        data['file']['open'][name] = edf.streams[name]
     else:
-        csv_delimiter = ','
+        data['file']['open'][name] = data['file']['open']['eeg'].edf.streams[name]
+    if name not in data['file']['throughput']:
+        data['file']['throughput'][name] = Throughput_Counter(data['file']['first_time'])
 
-    while True:
-        # print(heart_rate)
-
-        now = time.time()
-        # print(status_isGood)
-        # print(status_electrodeFit)
-        if not data['file']['packing']:
 
+def open_file(name, data, csv_delimiter=','):
 
-            if not data['buffer']['eeg'].empty():
+    if is_binary(name, data) and is_edf(data):
+        open_edf_file(name, data)
+        return
+
+    if is_binary(name, data):
+        columns = data['columns'][name]
+        if data['conf']['add_time_column']:
+            columns = ['time'] + columns
+        rate = data['conf']['sampling_rate'][name]
+        data['file']['open'][name] = Binary_File(f"{data['folder']['out']}/{data['folder']['tmp']}/{data['file']['name'][name]}",
+                                                 columns, rate, BINARY_CHUNK_SECONDS * rate,
+                                                 time_column=data['conf']['add_time_column'],
+                                                 start_time=data['file']['start_time'])
+        if name not in data['file']['throughput']:
+            data['file']['throughput'][name] = Throughput_Counter(data['file']['first_time'])
+        return
+
+    if data['file']['zip'] is not None:
+        # --compress_while_recording: the eeg file is deflated straight into the zip file, the others are collected
+        data['file']['open'][name] = data['file']['zip'].open_member(data['file']['name'][name], direct=(name == 'eeg'))
+    else:
+        data['file']['open'][name] = open(f"{data['folder']['out']}/{data['folder']['tmp']}/{data['file']['name'][name]}", "w", newline="")
+    data['file']['csv_writer'][name] = csv.writer(data['file']['open'][name], delimiter=csv_delimiter)
+    if name not in data['file']['throughput']:
+        # the counter goes on over all segments of a stream (--segment_minutes)
+        data['file']['throughput'][name] = Throughput_Counter(data['file']['first_time'])
+
+    # the rows are formatted with one '%' format per row (same output as the csv writer: repr() of the values, \r\n)
+    columns = data['columns'][name]
+    if name in SIDE_CHANNELS:
+        columns = ['eeg_row'] + columns
+        cells = ['%r'] * len(columns)
+    elif name == ALIGNED:
+        # float64 rows, the values had float32 precision (7 digits)
+        cells = ['%r'] + (['%.7g'] * (len(columns) - 1) if data['conf']['csv_decimals'] is None else
+                          [f"%.{data['conf']['csv_decimals']}f"] * (len(columns) - 1))
+    else:
+        cells = ['%r'] * len(columns) if data['conf']['csv_decimals'] is None else [f"%.{data['conf']['csv_decimals']}f"] * len(columns)
+        if data['conf']['add_time_column']:
+            columns = ['time'] + columns
+            cells = ['%r'] + cells
+    data['file']['row_format'][name] = csv_delimiter.join(cells) + '\r\n'
 
-                if data['folder']['tmp'] == '':         # create new tmp folder and eeg files
-                    current_timestamp_str = time.strftime("%Y.%m.%d_%H.%M")
-                    data['folder']['tmp'] = f"{data['conf']['file_name_prefix']}{current_timestamp_str}"
-                    data['file']['name']['eeg'] = f"{data['conf']['file_name_prefix']}{current_timestamp_str}_eeg.csv"
-                    data['file']['name']['heart_rate'] = f"{data['conf']['file_name_prefix']}{current_timestamp_str}_heart_rate.csv"
-                    data['file']['name']['acc'] = f"{data['conf']['file_name_prefix']}{current_timestamp_str}_accelerator.csv"
-                    data['file']['name']['ica'] = f"{data['conf']['file_name_prefix']}{current_timestamp_str}_ica.csv"
-                    data['file']['name']['signal_quality'] = f"{data['conf']['file_name_prefix']}{current_timestamp_str}_signal_quality.csv"
-                    data['file']['name']['drlref'] = f"{data['conf']['file_name_prefix']}{current_timestamp_str}_drlref.csv"
-                    create_folder(data['folder']['out'])
-                    create_folder(f"{data['folder']['out']}/{data['folder']['tmp']}")
+    if data['conf']['add_header_row']:
+        data['file']['csv_writer'][name].writerow(columns)
+
+
+def write_lines(name, data, rows):
+    """ formats a block of rows (lists / tuples of values) in one pass and writes it with a single write() """
+    start = time.perf_counter()
+    row_format = data['file']['row_format'][name]
+    chunk = ''.join([row_format % tuple(row) for row in rows])
+    data['file']['open'][name].write(chunk)
+    data['file']['throughput'][name].add(len(rows), len(chunk), time.perf_counter() - start)
+
+
+def write_block(name, data, rows, times):
+    """ --format binary: copies a block of samples into the memory mapped .bin file (edf / bdf: into its records) """
+    start = time.perf_counter()
+    if data['conf']['add_time_column']:
+        seconds = (times - data['file']['first_time']).astype(np.float32)
+        rows = np.column_stack((seconds, rows))
+    data['file']['open'][name].append(rows)
+    data['file']['throughput'][name].add(len(rows), len(rows) * rows.shape[1] * data['file']['open'][name].sample_bytes,
+                                         time.perf_counter() - start)
+
+
+def flush_file(name, data, force=False):
+    """ flushes (and with --fsync syncs) a file when --flush_policy says so, or always with force=True """
+    counter = data['file']['throughput'][name]
+    if not force and not counter.flush_due(data['conf']['flush_policy'], data['conf']['flush_every']):
+        return
+    data['file']['open'][name].flush()
+    if data['conf']['fsync']:
+        os.fsync(data['file']['open'][name].fileno())
+    counter.flushed()
+
+
+def fsync_path(path):
+    """ makes sure a finished file (the zip file) is on the disk (--fsync) """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass            # eg. windows can't fsync a read only file descriptor
+
+
+
+# streams that get the --if_signal_is_not_good_set_signal_to substitution
+NAN_SUBSTITUTION_STREAMS = ('eeg', 'heart_rate')
+
+# streams dropped by --only_record_if_signal_is_good (the side channels follow the written eeg rows)
+GATED_STREAMS = ('eeg',)
+
+
+def prepare_rows(name, start, rows, times, data):
+    """
+    nan substitution and signal quality gate for a whole block of samples (start = sample index of rows[0]).
+    returns (rows, times)
+    """
+
+    substitute = data['conf']['if_signal_is_not_good_set_signal_to']
+    if name in NAN_SUBSTITUTION_STREAMS and substitute != 'record_received_signal' and not np.isnan(float(substitute)):
+        rows = np.where(np.isnan(rows), np.float32(substitute), rows)
+
+    if name in GATED_STREAMS and data['conf']['only_record_if_signal_is_good']:
+        mask = data['gate'].mask(start, len(rows))
+        rows = rows[mask]
+        times = times[mask]
+
+    return rows, times
+
+
+def write_rows(name, data, start, rows, times):
+    """ writes a block of samples from the ring buffer (start = sample index of rows[0]) """
+
+    if name == 'eeg':
+        # to find the eeg row of a side channel change (eeg_row())
+        data['file']['segments'].append((start, len(rows), data['file']['rows']))
+    rows, times = prepare_rows(name, start, rows, times, data)
+    if len(rows) == 0:
+        return
+
+    if name == 'eeg':
+        data['file']['last_time'] = float(times[-1])
+        data['file']['rows'] += len(rows)
+
+    # --segment_minutes: the block is split where the segment file is full
+    part = data['file']['part']
+    while part is not None and name in SEGMENT_STREAMS:
+        room = max(0, part['size'][name] - (data['file']['throughput'][name].rows - part['rows'][name]))
+        if len(rows) < room:
+            break
+        if room:
+            write_prepared(name, data, rows[:room], times[:room])
+        next_part(name, data)
+        rows, times = rows[room:], times[room:]
+    if len(rows):
+        write_prepared(name, data, rows, times)
+
+
+def write_prepared(name, data, rows, times):
+    """ writes rows (after prepare_rows()) to the open file of the stream """
+    data['file']['throughput'][name].samples(times, int(np.isnan(rows).any(axis=1).sum()))
+
+    if data['file']['aligner'] is not None:
+        align_block(name, data, rows, times)
+
+    if is_binary(name, data):
+        write_block(name, data, rows, times)
+    elif data['conf']['add_time_column']:
+        # seconds since the first eeg sample of the recording
+        seconds = np.round(times - data['file']['first_time'], 4).tolist()
+        write_lines(name, data, [[t] + r for t, r in zip(seconds, rows.tolist())])
+    else:
+        write_lines(name, data, rows.tolist())
 
-                    open_file('eeg', data, csv_delimiter=csv_delimiter)
 
-                    if not data['conf']['no_heart_rate_file']:
-                        open_file('heart_rate', data, csv_delimiter=csv_delimiter)
+def write_to_file(name, data):
 
-                    if not data['conf']['no_acc_file']:
-                        open_file('acc', data, csv_delimiter=csv_delimiter)
+    buffer = data['buffer'][name]
+    if name == 'eeg':
+        data['file']['segments'] = []
 
-                    if not data['conf']['no_ica_file']:
-                        open_file('ica', data, csv_delimiter=csv_delimiter)
+    try:
 
-                    if not data['conf']['no_signal_quality_file']:
-                        open_file('signal_quality', data, csv_delimiter=csv_delimiter)
+        # Retrieve and process all samples in the ring buffer (one contiguous block at a time)
+        while not buffer.empty():
+            start, rows, times = buffer.read()
+            try:
+                write_rows(name, data, start, rows, times)
+            finally:
+                # the producer may only reuse the rows once they are written
+                buffer.advance(len(rows))
 
-                    if not data['conf']['no_drlref_file']:
-                        open_file('drlref', data, csv_delimiter=csv_delimiter)
+        flush_file(name, data)
+
+    except Exception as e:
+        if data['conf']['exiting'] != True:
+            print(f'    !! unwritten *{name}* data lost !!  ')
+
+    # overflows of the ring buffer (--buffer_policy drop_oldest / drop_newest), counted since the last report
+    reported = data['file']['lost'].get(name, 0)
+    if buffer.lost > reported:
+        print(f'    !! {buffer.lost - reported} samples of *{name}* data lost (buffer full, --buffer_policy {buffer.policy}) !!  ')
+        data['file']['lost'][name] = buffer.lost
+
+
+
+
+def eeg_row(data, sample):
+    """ row of the eeg file the eeg sample was written to (the next written row if it was not recorded) """
+    for start, n, row in data['file']['segments']:
+        if sample < start:
+            return row
+        if sample < start + n:
+            if data['conf']['only_record_if_signal_is_good']:
+                return row + int(data['gate'].mask(start, sample - start).sum())
+            return row + sample - start
+    return data['file']['rows']
+
+
+def write_side_channel(name, data, end):
+    """ writes the changes of a side channel up to the eeg sample 'end' (all eeg samples before it are written) """
+    side = data['side'][name]
+
+    lines = []
+    for sample, value in side.changes(data['file']['side_from'], end):
+        row = eeg_row(data, sample)
+        if lines and lines[-1][0] == row:
+            lines.pop()         # several changes before the same eeg row: only the last one counts
+        lines.append((row, value))
+
+    last = data['file']['side_last'][name]
+    histogram = data['file']['histogram'].get(name)
+    changed = []
+    for row, value in lines:
+        if value != last:
+            changed.append((row,) + value)
+            last = value
+            if histogram is not None:
+                histogram.change(row, value)
+    data['file']['side_last'][name] = last
+
+    if name in EDF_ANNOTATED_CHANNELS and is_edf(data):
+        for change in changed:
+            annotate_change(name, data, change[0], change[1:])
+    if data['file']['aligner'] is not None:
+        # the changes before the next eeg row are complete
+        data['file']['aligner'].add_changes(name, [change[0] for change in changed], [change[1:] for change in changed],
+                                            data['file']['rows'])
+    write_lines(name, data, changed)
+    flush_file(name, data)
+
+
+def new_aligner(data):
+    """ --aligned_file: aligns the recorded streams, its columns are the columns of the aligned file """
+    streams = {name: data['columns'][name] for name in ('heart_rate', 'acc') if not data['conf'][f'no_{name}_file']}
+    changes = {name: data['columns'][name] for name in SIDE_CHANNELS if not data['conf'][f'no_{name}_file']}
+    aligner = Stream_Aligner(data['columns']['eeg'], streams, changes, eeg_rate=data['conf']['sampling_rate']['eeg'],
+                             lags={'ica': data['conf']['ica_lag']})
+    data['columns'][ALIGNED] = aligner.columns
+    return aligner
+
+
+def align_block(name, data, rows, times):
+    """ --aligned_file: a written block of samples, with its receive times in seconds since the first eeg sample """
+    seconds = times - data['file']['first_time']
+    if name == 'eeg':
+        data['file']['aligner'].add_eeg(rows, seconds)
+    else:
+        data['file']['aligner'].add_samples(name, rows, seconds)
+
+
+def write_aligned(data, final=False):
+    """ --aligned_file: writes the aligned rows that are ready (all with final=True) """
+    rows = data['file']['aligner'].take(final)
+    rows[:, 0] = np.round(rows[:, 0], 4)
+    write_lines(ALIGNED, data, rows.tolist())
+    flush_file(ALIGNED, data)
+
+
+def annotate(data, row, text):
+    """ --format edf / bdf: an annotation at eeg row 'row' of the edf file """
+    data['file']['open']['eeg'].edf.annotate(row / data['conf']['sampling_rate']['eeg'], text)
+
+
+def annotate_change(name, data, row, value):
+    annotate(data, row, f"{name} " + ' '.join(f"{column}={v:g}" for column, v in zip(data['columns'][name], value)))
+
+
+def annotate_notes(data):
+    """ --format edf / bdf: the notes entered since the last write, at the last written eeg row """
+    notes = data['folder']['note']
+    for note in notes[data['file']['notes_annotated']:]:
+        annotate(data, data['file']['rows'], f"note: {note}")
+    data['file']['notes_annotated'] = len(notes)
+
+
+def part_name(name, index):
+    """ file name of a segment: eeg_2024.10.18_11.06_eeg.csv -> eeg_2024.10.18_11.06_eeg_002.csv """
+    root, ext = os.path.splitext(name)
+    return f"{root}_{index:03d}{ext}"
+
+
+def new_part(data, csv_delimiter):
+    """ --segment_minutes: every sample stream is split into segments of exactly segment_minutes of rows """
+    part = {'base': {}, 'index': {}, 'rows': {}, 'size': {}, 'csv_delimiter': csv_delimiter}
+    for name in SEGMENT_STREAMS:
+        part['base'][name] = data['file']['name'][name]
+        part['size'][name] = max(1, round(data['conf']['segment_minutes'] * 60 * data['conf']['sampling_rate'][name]))
+    return part
+
+
+def start_part(name, data, index):
+    """ name of the next segment file of a stream, starting after its last written row """
+    part = data['file']['part']
+    part['index'][name] = index
+    data['file']['name'][name] = part_name(part['base'][name], index)
+    counter = data['file']['throughput'].get(name)
+    part['rows'][name] = counter.rows if counter is not None else 0
+
+
+def close_part(data, names=SEGMENT_STREAMS):
+    """ closes the segment files and adds them with their size and checksum to segments.csv, returns their streams """
+    part = data['file']['part']
+    folder = f"{data['folder']['out']}/{data['folder']['tmp']}"
+    closed = []
+    for name in names:
+        if name not in data['file']['open']:
+            continue
+        flush_file(name, data, force=True)
+        data['file']['open'].pop(name).close()
+        first_row = part['rows'][name]
+        rows = data['file']['throughput'][name].rows - first_row
+        if os.path.getsize(f"{folder}/{data['file']['name'][name]}") == 0:
+            # empty files are not packed, so the segment is not listed either
+            os.remove(f"{folder}/{data['file']['name'][name]}")
+            closed.append(name)
+            continue
+        data['file']['parts'].append(record_segment(folder, data['file']['name'][name], name, first_row, rows,
+                                                    fsync=data['conf']['fsync']))
+        closed.append(name)
+    return closed
+
+
+def next_part(name, data):
+    """ the segment of a stream is full: closes it and opens the next one """
+    closed = close_part(data, (name,))
+    start_part(name, data, data['file']['part']['index'][name] + 1)
+    if closed:
+        open_file(name, data, csv_delimiter=data['file']['part']['csv_delimiter'])
+
+
+def new_recording_name(data):
+    """
+    prefix + start minute of a new recording. the previous recording can still be packed (or was started in the same
+    minute), so a number is added if its tmp folder or zip file already exists
+    """
+    name = f"{data['folder']['prefix']}{time.strftime('%Y.%m.%d_%H.%M')}"
+    recording = name
+    n = 1
+    while (os.path.exists(f"{data['folder']['out']}/{recording}") or os.path.exists(f"{data['folder']['out']}/{recording}.zip.part")
+           or glob.glob(f"{glob.escape(data['folder']['out'])}/{glob.escape(recording)}_*min.zip")):
+        n += 1
+        recording = f"{name}_{n}"
+    return recording
+
+
+# writes the buffered data of one device (headband) to its files, creates the files of a new recording and
+# hands them to the packer when the stream stopped
+def write_buffers(data, csv_delimiter):
+
+    now = time.time()
+    # print(status_isGood)
+    # print(status_electrodeFit)
+
+
+    if not data['buffer']['eeg'].empty():
+
+        if data['folder']['tmp'] == '':         # create new tmp folder and eeg files
+            create_folder(data['folder']['out'])
+            recording = new_recording_name(data)
+            data['folder']['tmp'] = recording
+            ext = {'csv': 'csv', 'binary': 'bin'}.get(data['conf']['format'], data['conf']['format'])
+            data['file']['name']['eeg'] = f"{recording}_eeg.{ext}"
+            data['file']['name']['heart_rate'] = f"{recording}_heart_rate.{ext}"
+            data['file']['name']['acc'] = f"{recording}_accelerator.{ext}"
+            if is_edf(data):
+                # one file for all sample streams
+                data['file']['name']['heart_rate'] = data['file']['name']['acc'] = data['file']['name']['eeg']
+            data['file']['name']['ica'] = f"{recording}_ica.csv"
+            data['file']['name']['signal_quality'] = f"{recording}_signal_quality.csv"
+            data['file']['name']['drlref'] = f"{recording}_drlref.csv"
+            # the lock tells the recovery at startup (lib/recovery.py) that the recording is not orphaned
+            if data['conf']['compress_while_recording']:
+                # no tmp folder, the files are written into the zip file (renamed when the recording ends)
+                data['file']['zip'] = Zip_Stream(f"{data['folder']['out']}/{data['folder']['tmp']}.zip.part",
+                                                 level=data['conf']['zip_level'])
+                try_lock(data['file']['zip'].file)
+            else:
+                create_folder(f"{data['folder']['out']}/{data['folder']['tmp']}")
+                data['file']['lock'] = lock_folder(f"{data['folder']['out']}/{data['folder']['tmp']}")
+            data['file']['first_time'] = data['buffer']['eeg'].next_time()
+            data['file']['last_time'] = data['file']['first_time']
+
+            # --segment_minutes: the sample streams are written in numbered segments
+            if data['conf']['segment_minutes']:
+                data['file']['part'] = new_part(data, csv_delimiter)
+                for name in SEGMENT_STREAMS:
+                    start_part(name, data, 1)
+            # wall clock time of the first eeg sample (first_time is time.monotonic())
+            data['file']['start_time'] = time.time() - (time.monotonic() - data['file']['first_time'])
+
+            open_file('eeg', data, csv_delimiter=csv_delimiter)
+
+            if not data['conf']['no_heart_rate_file']:
+                open_file('heart_rate', data, csv_delimiter=csv_delimiter)
+
+            if not data['conf']['no_acc_file']:
+                open_file('acc', data, csv_delimiter=csv_delimiter)
+
+            if not data['conf']['no_ica_file']:
+                open_file('ica', data, csv_delimiter=csv_delimiter)
+
+            if not data['conf']['no_signal_quality_file']:
+                open_file('signal_quality', data, csv_delimiter=csv_delimiter)
+
+            if not data['conf']['no_drlref_file']:
+                open_file('drlref', data, csv_delimiter=csv_delimiter)
+
+            if data['conf']['aligned_file']:
+                data['file']['aligner'] = new_aligner(data)
+                data['file']['name'][ALIGNED] = f"{recording}_aligned.csv"
+                open_file(ALIGNED, data, csv_delimiter=csv_delimiter)
+
+
+            data['stats']['rec_start_time'] = time.time()
+
+            # side channels start with their value at the first eeg sample (row 0)
+            first = data['buffer']['eeg'].next_index()
+            data['file']['rows'] = 0
+            data['file']['side_from'] = first
+            for name in SIDE_CHANNELS:
+                if not data['conf'][f'no_{name}_file']:
+                    data['file']['side_last'][name] = data['side'][name].value_at(first)
+                    if name in HISTOGRAM_CHANNELS:
+                        data['file']['histogram'][name] = Value_Histogram(data['columns'][name], data['side'][name].value_at(first))
+                    if name in EDF_ANNOTATED_CHANNELS and is_edf(data):
+                        annotate_change(name, data, 0, data['side'][name].value_at(first))
+                    if data['file']['aligner'] is not None:
+                        data['file']['aligner'].add_changes(name, [0], [data['side'][name].value_at(first)], 0)
+                    write_lines(name, data, [(0,) + data['side'][name].value_at(first)])
+
+            # print('new file created:')
+            # print(f" {data['folder']['tmp']} created")
+            sys.stdout.write(f"\r {data['folder']['tmp']} created.                     \n")
+            sys.stdout.flush()
+
+            # last_timestamp = {'eeg': 0, 'heart_rate': 0, 'acc': 0, 'ica': 0, 'signal_quality': 0, 'drlref': 0}
+
+
+
+
+        write_streams(data)
+
+    # zip file after 'wait_before_starting_new_rec' seconds of inactivity and remove plain csv
+    # only do so if there is a data['folder']['tmp'] created
+    # (inactivity is measured from the receive time of the last eeg sample)
+    else:                                           # if streaming from mindmonitor
+        if data['folder']['tmp'] != '' and data['buffer']['eeg'].last_time() + data['conf']['wait_before_starting_new_rec'] < time.monotonic():
+            try:
+                close_and_zip_files(data)
+            except Exception as e:
+                print(' Warning: recoded file not found.. ')
+
+
+    if data['stream']['from_muse_app'] == 1:        # if streaming from muse_app
+        # and no /muse_metrics is received in the last second (= no feedback going on) -> close file
+        if data['folder']['tmp'] != '' and data['stream']['last_data_received'] + 1 < now:
+            try:
+                close_and_zip_files(data)
+            except Exception as e:
+                print(' Warning: recoded file not found.. ')
+
+
+
+
+# the file writer, the input thread (r) and gracefully_end() must not write / pack the same files at the same time.
+# reentrant: write_buffers() closes recordings (close_and_zip_files()) while holding it
+write_lock = threading.RLock()
 
 
-                    data['stats']['rec_start_time'] = time.time()
+# writes the buffers of all devices once (used by the writer thread and the asyncio runtime)
+def write_all_devices(data, csv_delimiter):
+    with write_lock:
+        # devices can be added while recording (--split_by_sender)
+        for dev in list(data['devices']):
+            if data['conf']['shutdown'].is_set():
+                break
+            write_buffers(dev, csv_delimiter)
 
-                    # print('new file created:')
-                    # print(f" {data['folder']['tmp']} created")
-                    sys.stdout.write(f"\r {data['folder']['tmp']} created.                     \n")
-                    sys.stdout.flush()
 
-                    # last_timestamp = {'eeg': 0, 'heart_rate': 0, 'acc': 0, 'ica': 0, 'signal_quality': 0, 'drlref': 0}
+def is_recording(data):
+    return any(dev['folder']['tmp'] != '' for dev in list(data['devices']))
 
 
+def next_write_delay(data):
+    """
+    seconds until the writer is due again: --max_latency, or earlier when a recording times out (the stream
+    stopped, see write_buffers()). the buffers wake it up before that (lib/writer_wakeup.py)
+    """
+    delay = data['conf']['max_latency']
+    for dev in list(data['devices']):
+        if dev['folder']['tmp'] == '':
+            continue
+        timeout_due = dev['buffer']['eeg'].last_time() + data['conf']['wait_before_starting_new_rec'] - time.monotonic()
+        if dev['stream']['from_muse_app'] == 1:
+            timeout_due = min(timeout_due, dev['stream']['last_data_received'] + 1 - time.time())
+        delay = min(delay, timeout_due + 0.05)
+    return max(delay, 0.05)
 
 
-                write_to_file('eeg', data)
+# writes the buffered data to the files whenever the writer is woken up (lib/writer_wakeup.py)
+# one thread for all devices (data['devices'], see lib/devices.py)
+def process_buffers(data):
 
-                if not data['conf']['no_heart_rate_file']:
-                    write_to_file('heart_rate', data)
+    shutdown = data['conf']['shutdown']
+    wakeup = data['conf']['wakeup']
+    if shutdown.wait(1):
+        return
 
-                if not data['conf']['no_acc_file']:
-                    write_to_file('acc', data)
+    if data['conf']['use_tabseparator_for_csv']:
+        csv_delimiter = '\t'
+    else:
+        csv_delimiter = ','
 
-                if not data['conf']['no_ica_file']:
-                    write_to_file('ica', data)
+    while not shutdown.is_set():
+        # print(heart_rate)
 
-                if not data['conf']['no_signal_quality_file']:
-                    write_to_file('signal_quality', data)
+        write_all_devices(data, csv_delimiter)
 
-                if not data['conf']['no_drlref_file']:
-                    write_to_file('drlref', data)
+        #print_stats()
+        wakeup.idle = not is_recording(data)
+        wakeup.wait(next_write_delay(data))
+
+
+def gap_events_csv(data):
+    """ all gaps (lost udp packets) of the current recording, one line per gap """
+    lines = []
+    for name, rate in data['rate'].items():
+        for t, sample, dropped, gap in rate.take_events():
+            if t >= data['file']['first_time']:
+                lines.append((t - data['file']['first_time'], name, sample, dropped, gap))
+    if len(lines) == 0:
+        return ''
+
+    lines.sort()
+    csv_lines = ['time,stream,sample_index,dropped_samples,gap_seconds']
+    csv_lines += [f"{t:.3f},{name},{sample},{dropped},{gap:.3f}" for t, name, sample, dropped, gap in lines]
+    return '\n'.join(csv_lines) + '\n'
+
+
+# writes everything that is in the buffers of a device to its open files
+def write_streams(data):
+
+    write_to_file('eeg', data)
+
+    if not data['conf']['no_heart_rate_file']:
+        write_to_file('heart_rate', data)
+
+    if not data['conf']['no_acc_file']:
+        write_to_file('acc', data)
+
+    # side channel changes up to the last written eeg sample
+    end = data['buffer']['eeg'].read_index
+    for name in SIDE_CHANNELS:
+        if not data['conf'][f'no_{name}_file']:
+            write_side_channel(name, data, end)
+    data['file']['side_from'] = end - 1
+    if is_edf(data):
+        annotate_notes(data)
+    if data['file']['aligner'] is not None:
+        write_aligned(data)
+
+    # signal quality events older than the oldest unwritten sample are not needed anymore
+    data['gate'].prune(min(data['buffer'][name].read_index for name in GATED_STREAMS))
+    for side in data['side'].values():
+        side.prune(data['file']['side_from'])
+
+
+def buffers_csv(data):
+    """ fill level and overflows of the ring buffers during the current recording (--buffer_policy) """
+    csv_lines = ['stream,capacity,policy,high_water,dropped_samples,spilled_bytes']
+    for name, buffer in data['buffer'].items():
+        csv_lines.append(f"{name},{buffer.capacity},{buffer.policy},{buffer.high_water},{buffer.lost},{buffer.spilled_bytes}")
+    return '\n'.join(csv_lines) + '\n'
+
+
+def throughput_csv(data):
+    """ rows and bytes written per file of the current recording (lib/throughput.py) """
+    csv_lines = ['stream,rows,bytes,seconds,rows_per_second,bytes_per_second,write_seconds']
+    for name, counter in data['file']['throughput'].items():
+        csv_lines.append(f"{name},{counter.rows},{counter.bytes},{counter.elapsed():.1f},{counter.rows_per_second():.1f},"
+                         f"{counter.bytes_per_second():.0f},{counter.write_seconds:.3f}")
+    return '\n'.join(csv_lines) + '\n'
+
+
+def zip_extras(data, zip_file_name):
+    """ the small files that are added to every zip file after manifest.json: (name, content) """
+    extras = []
+    ch_loc = "TP9   -80.0   -50.0   0.0\nAF7   -70.0   70.0   0.0\nAF8    70.0   70.0   0.0\nTP10   80.0   -50.0   0.0"
+    extras.append(('channel_locations_for_eeglab.sfp', ch_loc))
+    if len(data['folder']['note']) > 0:
+        notes = "\n\n\n---------\n\n".join(data['folder']['note'])
+        extras.append(('notes.txt', notes))
+
+    gaps = gap_events_csv(data)
+    if gaps != '':
+        extras.append(('gaps.csv', gaps))
+    extras.append(('buffers.csv', buffers_csv(data)))
+    extras.append(('throughput.csv', throughput_csv(data)))
+    return extras
+
+
+# a closed recording is packed from a job (dict) that holds everything it needs, the device (data) already
+# records the next one:
+#   data, out, tmp, zip_file_name, names ((stream, file name) of the closed files, a file can be listed for several
+#   streams), zip (lib/zip_stream.py),
+#   members (stream -> closed zip member), rows (eeg rows), parts ((first row, rows) of the eeg segments),
+#   expand, csv_delimiter, add_header_row, fsync, manifest (lib/manifest.py, the packing time is added),
+#   extras (the other small files, zip_extras()), zip_workers, zip_level, lock (of the tmp folder),
+#   recover / zip_part (an orphaned recording, recover_orphans())
+
+def write_extras(zip_stream, job, start, workers, packed):
+    """
+    manifest.json (with the time it took to pack the files since 'start' and the packed members of every stream,
+    packed: stream -> [member names] in segment order) and the other small files
+    """
+    seconds = time.monotonic() - start
+    job['data']['file']['pack_seconds'] = seconds
+    if job['manifest'] is not None:
+        job['manifest']['packing'] = {'seconds': round(seconds, 2), 'workers': workers, 'level': job['zip_level']}
+        for name, stream in job['manifest']['streams'].items():
+            stream['files'] = packed.get(name, [])
+        zip_stream.write_member('manifest.json', manifest_json(job['manifest']))
+    for name, content in job['extras']:
+        zip_stream.write_member(name, content)
+
+
+def zip_tmp_folder(job):
+    """ packs the closed files of the tmp folder into the zip file (deflated by the zip workers) and removes the tmp folder """
+    start = time.monotonic()
+    folder = f"{job['out']}/{job['tmp']}"
+    ff = []
+    files = []
+    packed = {}         # stream -> member names
+    members = {}        # file name -> member names (--format edf / bdf writes all sample streams into one file)
+    # pack all created files that are > 0 Bytes
+    for f, name in job['names']:
+        if name in members:
+            packed.setdefault(f, []).extend(members[name])
+            continue
+        members[name] = []
+        file_name = f"{folder}/{name}"
+        ff.append(file_name)
+        #print(file_name)
+        if os.path.getsize(file_name) == 0:
+            continue
+        if f in SIDE_CHANNELS and job['expand']:
+            # one row per eeg row instead of the changes (one file per eeg segment with --segment_minutes),
+            # written into the tmp folder first to be deflated like the other files
+            pieces = [(name, 0, job['rows'])]
+            if job['parts']:
+                pieces = [(part_name(name, i + 1), first_row, rows) for i, (first_row, rows) in enumerate(job['parts'])]
+            for arcname, first_row, rows in pieces:
+                expanded = f"{folder}/{arcname}.expanded"
+                with open(file_name, newline='') as file_in, open(expanded, 'w', newline='') as file_out:
+                    expand_side_channel(file_in, file_out, rows, csv_delimiter=job['csv_delimiter'],
+                                        header=job['add_header_row'], first_row=first_row)
+                ff.append(expanded)
+                files.append((arcname, expanded))
+                members[name].append(arcname)
+        else:
+            files.append((name, file_name))
+            members[name].append(name)
+        packed.setdefault(f, []).extend(members[name])
+
+    zip_stream = Zip_Stream(f"{job['out']}/{job['zip_file_name']}", level=job['zip_level'])
+    zipper.add_files(zip_stream, files, workers=job['zip_workers'], level=job['zip_level'])
+    write_extras(zip_stream, job, start, job['zip_workers'], packed)
+    zip_stream.close()
+
+    # Delete the original files
+    for f in ff:
+        os.remove(f)
+    if job['lock'] is not None:
+        unlock_folder(f"{job['out']}/{job['tmp']}", job['lock'])
+    # remove tmp folder
+    os.rmdir(f"{job['out']}/{job['tmp']}")
+
+
+def finish_zip_stream(job):
+    """ --compress_while_recording: adds the collected files and the extras to the zip file and renames it """
+    start = time.monotonic()
+    zip_stream = job['zip']
+    for f, member in job['members'].items():
+        if f in SIDE_CHANNELS and job['expand']:
+            # the change files are small, the expanded file (one row per eeg row) is deflated now
+            changes = member.text()
+            member.discard()
+            file_out = zip_stream.open_member(member.name, direct=True)
+            expand_side_channel(io.StringIO(changes, newline=''), file_out, job['rows'],
+                                csv_delimiter=job['csv_delimiter'], header=job['add_header_row'])
+            file_out.close()
+
+    write_extras(zip_stream, job, start, 1, {f: [member.name] for f, member in job['members'].items()})
+    zip_stream.close()
+
+    os.replace(zip_stream.path, f"{job['out']}/{job['zip_file_name']}")
+
+
+def recover_recording(job):
+    """ repairs an orphaned recording and fills in its job (lib/recovery.py). False if there is nothing to pack """
+    folder = f"{job['out']}/{job['tmp']}"
+    if job['zip_part'] is not None:
+        # --compress_while_recording: the eeg file is decompressed into a tmp folder first
+        create_folder(folder)
+        job['lock'] = lock_folder(folder)
+        if salvage_zip_part(job['zip_part'].name, folder) is None:
+            print(f" Warning: nothing could be read from {job['zip_part'].name}..")
+            job['zip_part'].close()
+            unlock_folder(folder, job['lock'])
+            os.rmdir(folder)
+            return False
+
+    report = recover_folder(folder, header_row=job['add_header_row'])
+    minutes = int(round(report['eeg_rows'] / job['data']['conf']['sampling_rate']['eeg'] / 60))
+    zip_file_name = f"{job['tmp']}_recovered_{minutes}min.zip"
+    n = 1
+    while os.path.exists(f"{job['out']}/{zip_file_name}"):
+        n += 1
+        zip_file_name = f"{job['tmp']}_recovered_{n}_{minutes}min.zip"
+    job['zip_file_name'] = zip_file_name
+    # recovery.json and segments.csv are packed like the recorded files
+    job['names'] = [(name, name) for name in sorted(os.listdir(folder)) if not name.startswith('.')]
+    if report['bad_segments']:
+        print(f" Warning: {job['tmp']}: {', '.join(report['bad_segments'])} don't match their checksum (see {RECOVERY_FILE})")
+    return True
 
-                last_received_time = time.time()
 
-            # zip file after 'wait_before_starting_new_rec' seconds of inactivity and remove plain csv
-            # only do so if there is a data['folder']['tmp'] created
-            else:                                           # if streaming from mindmonitor
-                if data['folder']['tmp'] != '' and last_received_time + data['conf']['wait_before_starting_new_rec'] < now:
-                    try:
-                        close_and_zip_files(data)
-                    except Exception as e:
-                        print(' Warning: recoded file not found.. ')
+def pack_recording(job):
+    """ runs in the packer thread """
+    data = job['data']
+    try:
+        if job['recover'] and not recover_recording(job):
+            return
 
+        if job['zip'] is not None:
+            finish_zip_stream(job)
+        else:
+            # Create a ZIP file with normal compression
+            zip_tmp_folder(job)
 
-            if data['stream']['from_muse_app'] == 1:        # if streaming from muse_app
-                # and no /muse_metrics is received in the last second (= no feedback going on) -> close file
-                if data['folder']['tmp'] != '' and data['stream']['last_data_received'] + 1 < now:
-                    try:
-                        close_and_zip_files(data)
-                    except Exception as e:
-                        print(' Warning: recoded file not found.. ')
+        if job['zip_part'] is not None:
+            # the eeg file of the unfinished zip file is saved
+            job['zip_part'].close()
+            os.remove(job['zip_part'].name)
 
+        if job['fsync']:
+            fsync_path(f"{job['out']}/{job['zip_file_name']}")
 
-        #print_stats()
-        time.sleep(10)
+        sys.stdout.write(f"\r+{job['zip_file_name']} saved.                     \n")
+        sys.stdout.flush()
 
+    finally:
+        with packer.lock:
+            data['file']['packing'] -= 1
+
+
+# closed recordings are zipped one after the other in a background thread, the files are deflated by a pool
+# of processes (--zip_workers)
+packer = Packer(pack_recording)
+zipper = Parallel_Zip()
+
+
+def recover_orphans(data):
+    """ packs the recordings a killed recorder left behind (lib/recovery.py) in the background """
+    for kind, name, lock in find_orphans(data['folder']['out']):
+        print(f" {name}: unfinished recording found, it is packed in the background..")
+        job = {
+            'data': data,
+            'out': data['folder']['out'],
+            'tmp': name[:-len('.zip.part')] if kind == 'zip_part' else name,
+            'zip_file_name': '',
+            'names': [],
+            'zip': None,
+            'members': {},
+            'rows': 0,
+            'parts': [],
+            'expand': False,        # the number of eeg rows is not known for sure
+            'csv_delimiter': '\t' if data['conf']['use_tabseparator_for_csv'] else ',',
+            'add_header_row': data['conf']['add_header_row'],
+            'fsync': data['conf']['fsync'],
+            'manifest': None,       # recovery.json instead
+            'extras': [],
+            'zip_workers': data['conf']['zip_workers'],
+            'zip_level': data['conf']['zip_level'],
+            'lock': lock if kind == 'folder' else None,
+            'recover': True,
+            'zip_part': lock if kind == 'zip_part' else None,
+        }
+        with packer.lock:
+            data['file']['packing'] += 1
+        packer.submit(job)
 
-def count_lines_in_file(filename):
-    try:
-        with open(filename, 'r') as file:
-            # Read all lines and count them
-            line_count = sum(1 for line in file)
-        return line_count
-    except FileNotFoundError:
-        print(f"Sorry, the file {filename} does not exist.")
-        return 0
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        return 0
 
 def close_and_zip_files(data):
+    with write_lock:
+        return _close_and_zip_files(data)
 
-    # if another function already packs the files, wait until it is finished and then return
-    if data['file']['packing']:
-        print('please wait shortly. packing eeg data (1h of eeg data takes about half a minute to pack)..')
-        while True:
-            if not data['file']['packing']:
-                break
-            time.sleep(1)
-        return False
+
+def _close_and_zip_files(data):
+    # rotation: closes the files of the current recording and hands them to the packer. the next write starts a
+    # new recording right away, nothing that arrives meanwhile is lost
 
     # only continue if there are files to pack
     if data['folder']['tmp'] == '':
         return False
 
-    data['file']['packing'] = True      # block creation / writing of new eeg files (will interfere with packing if packing is slow)
-
+    job = None
     try:
+        # the samples received since the last write still belong to this recording
+        write_streams(data)
+        if data['file']['aligner'] is not None:
+            write_aligned(data, final=True)
+
+        if data['file']['part'] is not None:
+            close_part(data)            # the last segments get their checksum
         for f in data['file']['open']:
+            flush_file(f, data, force=True)         # --flush_policy rotation: the only flush
             data['file']['open'][f].close()
 
         #sys.stdout.write(f"\r  files are beeing compressed. please wait a short while..                   ")
         #sys.stdout.flush()
         
-        # recording lenght
-        # rec_lenght = int( round( (time.time() - data['stats']['rec_start_time']) / 60, 0) )
-        lines_in_eeg_csv = count_lines_in_file( f"{data['folder']['out']}/{data['folder']['tmp']}/{data['file']['name']['eeg']}")
-        rec_lenght = int( round( lines_in_eeg_csv / data['conf']['sampling_rate']['eeg'] / 60 ) )
+        # recording lenght (from the receive time of the first and last eeg sample, lost packets don't shorten it)
+        rec_lenght = int( round( (data['file']['last_time'] - data['file']['first_time']) / 60 ) )
 
-        # Create a ZIP file with normal compression
         zip_file_name = f"{data['folder']['tmp']}_{rec_lenght}min.zip"
-        ff = []
-        with zipfile.ZipFile(f"{data['folder']['out']}/{zip_file_name}", 'w', zipfile.ZIP_DEFLATED) as zipf:
-            # pack all created files that are > 0 Bytes
-            for f in data['file']['name']:
-                file_name = f"{data['folder']['out']}/{data['folder']['tmp']}/{data['file']['name'][f]}"
-                ff.append(file_name)
-                #print(file_name)
-                if os.path.getsize(file_name) > 0:
-                    zipf.write(file_name, arcname=os.path.basename(file_name))
-
-            # Add the string content directly to the zip file
-            ch_loc = "TP9   -80.0   -50.0   0.0\nAF7   -70.0   70.0   0.0\nAF8    70.0   70.0   0.0\nTP10   80.0   -50.0   0.0"
-            zipf.writestr('channel_locations_for_eeglab.sfp', ch_loc)
-            if len(data['folder']['note']) > 0:
-                notes = "\n\n\n---------\n\n".join(data['folder']['note'])
-                zipf.writestr('notes.txt', notes)
-
-        # Delete the original files
-        for f in ff:
-            os.remove(f)
-        # remove tmp folder
-        os.rmdir(f"{data['folder']['out']}/{data['folder']['tmp']}")
-
-        # clear file list and tmp folder name
-        for f in data['file']['name']:
-            data['file']['name'][f] = ''
-        data['folder']['tmp'] = ''
-
-        # make sure all queues are empty
-        for b in data['buffer']:
-            while not data['buffer'][b].empty():
-                x = data['buffer'][b].get()
-        for b in data['feedback']:
-            while not data['feedback'][b].empty():
-                x = data['feedback'][b].get()
-
-        data['stats']['moved'] = 0
-        data['stats']['moved_continuous'] = 0
-        data['stats']['moved_sum'] = 0
-        data['stats']['rec_start_time'] = 999999999999
-
-        sys.stdout.write(f"\r+{zip_file_name} saved.                     \n")
-        sys.stdout.flush()
-        # print(f'\n  {zip_file_name} saved.')
-
-       # time.sleep(200) #for testing
+        job = {
+            'data': data,
+            'out': data['folder']['out'],
+            'tmp': data['folder']['tmp'],
+            'zip_file_name': zip_file_name,
+            'names': ([(part['stream'], part['file']) for part in data['file']['parts']]
+                      + [(f, data['file']['name'][f]) for f in data['file']['open']]
+                      + ([('segments', SEGMENTS_FILE)] if data['file']['parts'] else [])),
+            'zip': data['file']['zip'],
+            'members': dict(data['file']['open']),
+            'rows': data['file']['rows'],
+            'parts': [(part['first_row'], part['rows']) for part in data['file']['parts'] if part['stream'] == 'eeg'],
+            'expand': data['conf']['expand_side_channels'],
+            'csv_delimiter': '\t' if data['conf']['use_tabseparator_for_csv'] else ',',
+            'add_header_row': data['conf']['add_header_row'],
+            'fsync': data['conf']['fsync'],
+            # the manifest etc. are made now, the counters are reset below
+            'manifest': recording_manifest(data, zip_file_name),
+            'extras': zip_extras(data, zip_file_name),
+            'zip_workers': data['conf']['zip_workers'],
+            'zip_level': data['conf']['zip_level'],
+            'lock': data['file']['lock'],
+            'recover': False,
+            'zip_part': None,
+        }
 
     except Exception as e:
         print(' Warning: recoded file not found.. \n', e)
 
-    data['file']['packing'] = False
+    # clear file list and tmp folder name, the next write starts a new recording
+    for f in data['file']['name']:
+        data['file']['name'][f] = ''
+    data['file']['open'] = {}
+    data['file']['throughput'] = {}
+    data['file']['histogram'] = {}
+    data['file']['zip'] = None
+    data['file']['part'] = None
+    data['file']['parts'] = []
+    data['file']['lock'] = None
+    data['file']['aligner'] = None
+    data['folder']['tmp'] = ''
+
+    # the buffers are not cleared (they may already hold the next recording), only the counters start again
+    for b in data['buffer']:
+        data['buffer'][b].reset_counters()
+    data['file']['lost'] = {}
+    for side in data['side'].values():
+        side.clear()
+
+    with data['stats'].changing():
+        for counters in data['stats']['feedback'].values():
+            counters.update(fired=0, continuous=0)
+        data['stats']['rec_start_time'] = 999999999999
+    for rate in data['rate'].values():
+        rate.reset_counters()
+
+    if job is not None:
+        with packer.lock:
+            data['file']['packing'] += 1
+        packer.submit(job)
 
     return True
 
 
+# called from the main thread (ctrl+c) or the input thread (x). packs all open recordings and stops all loops,
+# the programm ends when main() returns. a second call waits until the first one is done
 def gracefully_end(data):
 
-    if data['conf']['exiting'] or data['file']['packing']:
+    if data['conf']['exiting']:
         print('please wait shortly..')
-        while True:
-            if not data['conf']['exiting'] and not data['file']['packing']:
-                return
-            time.sleep(1)
+        data['conf']['ended'].wait()
+        return
 
     data['conf']['exiting'] = True
+    data['conf']['shutdown'].set()          # writer, stats and feedback loops stop
+    data['conf']['wakeup'].set()
+    if data['conf']['feedback_wakeup'] is not None:
+        data['conf']['feedback_wakeup'].set()
 
     sys.stdout.write(f"\r   (please wait.. finishing up)                    \n")
     sys.stdout.flush()
-    if data['folder']['tmp'] != '':
-        close_and_zip_files(data)
 
-    print('\nprogramm ended. all good.')
-    os._exit(0)
+    # --runtime multiprocess: no new samples, and the last state (gaps, ..) of the receiver is synced
+    if data['receiver'] is not None:
+        data['receiver'].stop()
+
+    # waits until the writer is done with the current write
+    with write_lock:
+        for dev in list(data['devices']):
+            if dev['folder']['tmp'] != '':
+                close_and_zip_files(dev)
 
+    # all closed recordings are zipped
+    packer.wait()
+    zipper.shutdown()
 
+    if data['receiver'] is not None:
+        data['receiver'].release()
+
+    print('\nprogramm ended. all good.')
+    data['conf']['ended'].set()
@@ -0,0 +1,248 @@
+import csv
+import json
+import os
+import re
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:     # windows
+    fcntl = None
+
+from lib.binary_format import HEADER_BYTES, read_header
+from lib.edf_format import repair_edf
+from lib.zip_stream import LOCAL_HEADER
+
+
+# crash recovery: recordings that were never packed because the recorder was killed (android kills termux often)
+#
+# a recording that is written holds a lock: the tmp folder on its LOCK_FILE, --compress_while_recording on the
+# .zip.part file itself. the lock is released by the os when the process dies, so at startup every tmp folder or
+# .zip.part in the out folder that can be locked is an orphan (on windows there is no flock: orphans are the ones
+# that were not changed for STALE_SECONDS). they are packed in the background by the packer (lib/record_to_file.py
+# recover_orphans()):
+#   - the torn last row of every csv file is cut off, .bin files are cut to the samples in their header, .edf / .bdf
+#     files to their complete records
+#   - the segments listed in SEGMENTS_FILE (--segment_minutes) are checked against their size and crc32
+#   - the result is saved in RECOVERY_FILE, which is packed with the files into <name>_recovered_<N>min.zip
+# of a .zip.part only the eeg file can be saved (the others were still in temporary files), it is decompressed
+# up to the last flush into a tmp folder first.
+
+LOCK_FILE = '.lock'
+SEGMENTS_FILE = 'segments.csv'
+RECOVERY_FILE = 'recovery.json'
+STALE_SECONDS = 60
+TAIL_BYTES = 65536
+
+# the eeg file (or its segments) of a recording
+EEG_FILE = re.compile(r'_eeg(_\d+)?\.(csv|bin|edf|bdf)$')
+
+
+def try_lock(f):
+    """ exclusive lock on an open file, held until it is closed. False if another process holds it """
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+def lock_folder(folder):
+    """ the lock of a tmp folder (open file) or None if it is locked by another process """
+    f = open(os.path.join(folder, LOCK_FILE), 'a+b')
+    if not try_lock(f):
+        f.close()
+        return None
+    return f
+
+
+def unlock_folder(folder, lock):
+    lock.close()
+    try:
+        os.remove(os.path.join(folder, LOCK_FILE))
+    except OSError:
+        pass
+
+
+def file_crc32(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                return crc
+            crc = zlib.crc32(chunk, crc)
+
+
+def record_segment(folder, file_name, stream, first_row, rows, fsync=False):
+    """ adds a closed segment file with its size and crc32 to SEGMENTS_FILE, returns the entry """
+    path = os.path.join(folder, file_name)
+    segment = {'file': file_name, 'stream': stream, 'first_row': first_row, 'rows': rows,
+               'bytes': os.path.getsize(path), 'crc32': f"{file_crc32(path):08x}"}
+    segments_path = os.path.join(folder, SEGMENTS_FILE)
+    new = not os.path.exists(segments_path)
+    with open(segments_path, 'a', newline='') as f:
+        if new:
+            f.write('file,stream,first_row,rows,bytes,crc32\r\n')
+        f.write(f"{file_name},{stream},{first_row},{rows},{segment['bytes']},{segment['crc32']}\r\n")
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+    return segment
+
+
+def is_stale(path):
+    """ without flock: nothing in path was changed for STALE_SECONDS """
+    paths = [path]
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in os.listdir(path)]
+    newest = max((os.path.getmtime(p) for p in paths), default=0)
+    return newest + STALE_SECONDS < time.time()
+
+
+def find_orphans(out):
+    """ (kind, name, lock) of the tmp folders ('folder') and .zip.part files ('zip_part') that no recorder writes """
+    orphans = []
+    if not os.path.isdir(out):
+        return orphans
+    for name in sorted(os.listdir(out)):
+        path = os.path.join(out, name)
+        if os.path.isdir(path):
+            if not any(EEG_FILE.search(file_name) for file_name in os.listdir(path)):
+                continue        # not a recording
+            kind = 'folder'
+        elif name.endswith('.zip.part'):
+            kind = 'zip_part'
+        else:
+            continue
+        if fcntl is None and not is_stale(path):
+            continue
+        if kind == 'folder':
+            lock = lock_folder(path)
+        else:
+            lock = open(path, 'rb')
+            if not try_lock(lock):
+                lock.close()
+                lock = None
+        if lock is not None:
+            orphans.append((kind, name, lock))
+    return orphans
+
+
+def truncate_torn_tail(path):
+    """ cuts off an incomplete last row (after the last newline), returns the removed bytes """
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as f:
+        end = size
+        while end > 0:
+            start = max(end - TAIL_BYTES, 0)
+            f.seek(start)
+            i = f.read(end - start).rfind(b'\n')
+            if i >= 0:
+                end = start + i + 1
+                break
+            end = start
+        f.truncate(end)
+    return size - end
+
+
+def truncate_binary(path):
+    """ cuts a .bin file to the samples in its header (the preallocated rest is zeros), returns (removed bytes, samples) """
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as f:
+        header = read_header(f.read(HEADER_BYTES))
+        end = min(header['header_bytes'] + header['samples'] * len(header['columns']) * 4, size)
+        f.truncate(end)
+    return size - end, header['samples']
+
+
+def count_rows(path):
+    rows = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                return rows
+            rows += chunk.count(b'\n')
+
+
+def read_segments(folder):
+    path = os.path.join(folder, SEGMENTS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, newline='') as f:
+        return {line['file']: line for line in csv.DictReader(f)}
+
+
+def recover_folder(folder, header_row=False):
+    """ repairs the files of an orphaned tmp folder and writes RECOVERY_FILE. returns the report (dict) """
+    if os.path.exists(os.path.join(folder, SEGMENTS_FILE)):
+        truncate_torn_tail(os.path.join(folder, SEGMENTS_FILE))
+    segments = read_segments(folder)
+    files = {}
+    eeg_rows = 0
+    for name in sorted(os.listdir(folder)):
+        if name in (LOCK_FILE, RECOVERY_FILE, SEGMENTS_FILE):
+            continue
+        path = os.path.join(folder, name)
+        segment = segments.get(name)
+        if segment is not None:
+            # closed segment: nothing is cut, it has to match its checksum
+            ok = os.path.getsize(path) == int(segment['bytes']) and f"{file_crc32(path):08x}" == segment['crc32']
+            entry = {'checksum': 'ok' if ok else 'bad', 'rows': int(segment['rows'])}
+        elif name.endswith('.bin'):
+            removed, samples = truncate_binary(path)
+            entry = {'checksum': 'none', 'truncated_bytes': removed, 'rows': samples}
+        elif name.endswith(('.edf', '.bdf')):
+            removed, samples = repair_edf(path)
+            entry = {'checksum': 'none', 'truncated_bytes': removed, 'rows': samples}
+        else:
+            removed = truncate_torn_tail(path)
+            entry = {'checksum': 'none', 'truncated_bytes': removed, 'rows': count_rows(path) - int(header_row)}
+        entry['bytes'] = os.path.getsize(path)
+        if EEG_FILE.search(name):
+            eeg_rows += max(entry['rows'], 0)
+        files[name] = entry
+
+    report = {
+        'recovered': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'recording': os.path.basename(folder),
+        'eeg_rows': eeg_rows,
+        'bad_segments': sorted(name for name, entry in files.items() if entry['checksum'] == 'bad'),
+        'files': files,
+        'note': 'the recorder did not end normally. the last row of every file was cut off if it was incomplete, '
+                'side channels were not expanded and the manifest of the recording is missing.',
+    }
+    with open(os.path.join(folder, RECOVERY_FILE), 'w') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
+    return report
+
+
+def salvage_zip_part(path, folder):
+    """
+    --compress_while_recording: decompresses the first member of an unfinished zip file (the eeg file) into
+    folder, up to its last complete flush. returns the file name, or None if nothing could be read
+    """
+    with open(path, 'rb') as f:
+        fixed = f.read(LOCAL_HEADER.size)
+        if len(fixed) < LOCAL_HEADER.size or fixed[:4] != b'PK\x03\x04':
+            return None
+        name_length, extra_length = LOCAL_HEADER.unpack(fixed)[-2:]
+        name = os.path.basename(f.read(name_length).decode('utf-8'))
+        f.read(extra_length)
+
+        decompressor = zlib.decompressobj(-15)
+        with open(os.path.join(folder, name), 'wb') as out:
+            while not decompressor.eof:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    break
+                try:
+                    out.write(decompressor.decompress(chunk))
+                except zlib.error:
+                    break       # the data after the last flush
+    return name
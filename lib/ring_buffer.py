@@ -0,0 +1,332 @@
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+
+# fixed size buffer between the osc handlers (one writer thread) and the file writer (one reader thread).
+#
+# every stream (eeg, acc, ..) has its own preallocated 2d array (rows = samples, columns = data['columns'][name]).
+# the osc handler copies the values of a sample into the next row, nothing is allocated per sample and the
+# memory usage stays the same even if the file writer stalls.
+#
+# total is the monotonic sample index: the number of samples ever stored. sample i lives in row i % capacity.
+# it is only increased after the row is copied, so a reader never sees a half written sample.
+#
+# reading is two steps: read() returns the oldest unread rows, advance(n) hands them back to the producer once the
+# reader is done with them (formatted and written). until then drop_newest and spill don't touch them. drop_oldest
+# never waits for the reader, so read() copies the rows into a preallocated block and drops the ones the producer
+# overwrote during the copy (writing = sample index the producer is writing up to, set before it copies).
+#
+# with timestamps=True every sample also gets its receive time (time.monotonic(), see lib/rate_monitor.py).
+#
+# if the writer falls behind by more than 'capacity' samples (--buffer_policy):
+#   drop_oldest: the oldest unread samples are overwritten (counted in .lost when the reader gets there)
+#   drop_newest: new samples are not stored (counted in .lost)
+#   spill:       new samples are appended to a temporary file until the reader caught up with it, nothing is lost.
+#                the spill file is only touched (with a lock) while spilling
+# high_water is the max number of unread samples (since reset_counters()).
+#
+# every counter has one writer (the producer and the reader may be different processes, see
+# lib/shared_ring_buffer.py): lost = dropped (producer) + overwritten (reader) - lost_base (reader, set by
+# reset_counters()). the producer keeps the high-water mark in peak and starts it again when it sees a new
+# peak_reset (reader).
+#
+# wake_writer(): the producer wakes up the file writer when enough samples are unread (lib/writer_wakeup.py).
+
+POLICIES = ('drop_oldest', 'drop_newest', 'spill')
+
+
+class Ring_Buffer:
+
+    def __init__(self, columns, capacity, dtype=np.float32, timestamps=False, policy='drop_oldest', spill_folder=None):
+        self.columns = list(columns)
+        self.width = len(self.columns)
+        self.capacity = capacity
+        self.data = np.zeros((capacity, self.width), dtype=dtype)
+        self.times = np.zeros(capacity, dtype=np.float64) if timestamps else None
+        self.policy = policy
+
+        self.total = 0          # written by the producer only
+        self.writing = 0        # written by the producer only
+        self.read_index = 0     # written by the reader only
+        self.dropped = 0        # producer: samples not stored (drop_newest)
+        self.overwritten = 0    # reader: samples overwritten before they were read (drop_oldest)
+        self.lost_base = 0      # reader: dropped + overwritten at the last reset_counters()
+        self.peak = 0           # producer: max unread samples
+        self.peak_seen = 0      # producer: the peak_reset the peak belongs to
+        self.peak_reset = 0     # reader: increased by reset_counters()
+
+        # spill policy
+        self.spill_folder = spill_folder
+        self.spill_lock = threading.Lock()
+        self.spill_file = None          # temporary file, only open while spilling
+        self.spill_start = 0            # sample index of the first spilled sample
+        self.spill_read = 0             # spilled samples the reader already got
+        self.spill_last_time = 0.0
+        self.spilled_bytes = 0
+        self.spill_dtype = np.dtype([('row', self.data.dtype, (self.width,)), ('t', np.float64)])
+
+        self._init_wakeup()
+        self._init_read()
+
+    def _init_read(self):
+        self.reading = 0        # sample index of the rows returned by the last read()
+        self.reading_spill = False
+        self.block = None       # drop_oldest: copy of the rows returned by read(), allocated on the first read
+        self.block_times = None
+
+    def _init_wakeup(self):
+        self.wakeup = None
+        self.wake_rows = self.capacity
+        self.wake_idle = False
+
+    def wake_writer(self, wakeup, rows, when_idle=False):
+        """ wakeup.set() when 'rows' samples are unread, with when_idle also for any sample while wakeup.idle """
+        self.wakeup = wakeup
+        self.wake_rows = max(int(rows), 1)
+        self.wake_idle = when_idle
+
+    def _wake(self, unread):
+        if (unread >= self.wake_rows or (self.wake_idle and self.wakeup.idle)) and not self.wakeup.is_set():
+            self.wakeup.set()
+
+    def wake_due(self):
+        """ True if the writer should be woken up (checked by the reader side, eg. for another process) """
+        unread = self.unread()
+        return self.wakeup is not None and unread > 0 and (unread >= self.wake_rows or (self.wake_idle and self.wakeup.idle))
+
+    @property
+    def lost(self):
+        """ samples lost because the buffer was full (since reset_counters()) """
+        return self.dropped + self.overwritten - self.lost_base
+
+    @property
+    def high_water(self):
+        """ max number of unread samples (since reset_counters()) """
+        if self.peak_seen != self.peak_reset:
+            return self.unread()        # the producer did not store anything since the reset
+        return self.peak
+
+    def _note_unread(self, unread):
+        """ producer: updates the high-water mark """
+        if self.peak_seen != self.peak_reset:
+            self.peak_seen = self.peak_reset
+            self.peak = 0
+        if unread > self.peak:
+            self.peak = unread
+
+    def append(self, row, t=0.0):
+        unread = self.total - self.read_index
+        if unread >= self.capacity or self.spill_file is not None:
+            if self.policy == 'drop_newest':
+                self.dropped += 1
+                return
+            if self.policy == 'spill' and self._spill(np.asarray([row[:self.width]], dtype=self.data.dtype), np.asarray([t])):
+                return
+
+        i = self.total % self.capacity
+        self.writing = self.total + 1
+        self.data[i] = row[:self.width]
+        if self.times is not None:
+            self.times[i] = t
+        self.total += 1
+        self._note_unread(min(unread + 1, self.capacity))
+        if self.wakeup is not None:
+            self._wake(unread + 1)
+
+    def extend(self, rows, t=0.0):
+        """ rows: 2d array, t: receive time of all rows (float) or one per row (array) """
+        n = len(rows)
+        if n == 0:
+            return
+        t = np.broadcast_to(t, (n,))
+
+        unread = self.total - self.read_index
+        if unread + n > self.capacity or self.spill_file is not None:
+            if self.policy == 'drop_newest':
+                free = max(0, self.capacity - unread)
+                self.dropped += n - free
+                rows, t, n = rows[:free], t[:free], free
+                if n == 0:
+                    return
+            elif self.policy == 'spill' and self._spill(rows[:, :self.width], t):
+                return
+
+        self.writing = self.total + n
+        if n > self.capacity:
+            # only the newest samples fit, but the sample index still counts all of them
+            self.total += n - self.capacity
+            rows = rows[-self.capacity:]
+            t = t[-self.capacity:]
+            n = self.capacity
+
+        i = self.total % self.capacity
+        first = min(n, self.capacity - i)
+        self.data[i:i + first] = rows[:first, :self.width]
+        if first < n:
+            self.data[:n - first] = rows[first:, :self.width]
+        if self.times is not None:
+            self.times[i:i + first] = t[:first]
+            if first < n:
+                self.times[:n - first] = t[first:]
+        self.total += n
+        self._note_unread(min(unread + n, self.capacity))
+        if self.wakeup is not None:
+            self._wake(unread + n)
+
+    def _spill(self, rows, t):
+        """ producer: appends the rows to the spill file. returns False if they fit into the ring again """
+        with self.spill_lock:
+            if self.spill_file is None:
+                if self.total - self.read_index + len(rows) <= self.capacity:
+                    return False
+                self.spill_file = tempfile.TemporaryFile(prefix='spill_', dir=self.spill_folder)
+                self.spill_start = self.total
+                self.spill_read = 0
+
+            records = np.empty(len(rows), dtype=self.spill_dtype)
+            records['row'] = rows
+            records['t'] = t
+            self.spill_file.seek(0, os.SEEK_END)
+            self.spill_file.write(records.tobytes())
+            self.spilled_bytes += records.nbytes
+            self.spill_last_time = float(t[-1])
+            self.total += len(rows)
+            self._note_unread(self.total - self.read_index)       # can be more than the capacity while spilling
+        return True
+
+    def _read_spill(self, max_rows):
+        with self.spill_lock:
+            count = self.total - self.spill_start - self.spill_read
+            n = min(count, self.capacity if max_rows is None else max_rows)
+            size = self.spill_dtype.itemsize
+            self.spill_file.seek(self.spill_read * size)
+            records = np.frombuffer(self.spill_file.read(n * size), dtype=self.spill_dtype)
+
+            start = self.spill_start + self.spill_read
+            self.reading = start
+            self.reading_spill = True
+
+        times = records['t'] if self.times is not None else None
+        return start, records['row'], times
+
+    def unread(self):
+        return self.total - self.read_index
+
+    def empty(self):
+        return self.read_index >= self.total
+
+    def read(self, max_rows=None):
+        """
+        Returns (start_index, rows, times) with the oldest unread samples, call advance(len(rows)) when done with them.
+        rows and times are views into the buffer (a copy with drop_oldest) and end at the physical end of the array,
+        so read() and advance() until empty() to get everything. times is None if the buffer has no timestamps.
+        """
+        # total is read before spill_file: the producer opens the spill file before it counts spilled samples
+        total = self.total
+        start = self.read_index
+        if self.spill_file is not None:
+            if start >= self.spill_start:
+                return self._read_spill(max_rows)
+            total = self.spill_start
+
+        if total - start > self.capacity:
+            # the producer overwrote samples we did not read yet
+            self.overwritten += total - self.capacity - start
+            start = total - self.capacity
+
+        i = start % self.capacity
+        n = min(total - start, self.capacity - i)
+        if max_rows is not None:
+            n = min(n, max_rows)
+
+        self.reading_spill = False
+        if self.policy != 'drop_oldest':
+            self.reading = start
+            times = self.times[i:i + n] if self.times is not None else None
+            return start, self.data[i:i + n], times
+
+        if self.block is None:
+            self.block = np.empty_like(self.data)
+            self.block_times = np.empty_like(self.times) if self.times is not None else None
+        rows = self.block[:n]
+        rows[:] = self.data[i:i + n]
+        times = None
+        if self.times is not None:
+            times = self.block_times[:n]
+            times[:] = self.times[i:i + n]
+
+        # samples the producer started to overwrite while they were copied
+        skip = min(max(0, self.writing - self.capacity - start), n)
+        if skip:
+            self.overwritten += skip
+            start += skip
+            rows = rows[skip:]
+            times = times[skip:] if times is not None else None
+        self.reading = start
+        return start, rows, times
+
+    def advance(self, n):
+        """ marks the n rows returned by the last read() as done, the producer can reuse them """
+        if not self.reading_spill:
+            self.read_index = max(self.read_index, self.reading + n)
+            return
+        with self.spill_lock:
+            if self.spill_file is not None:
+                self.spill_read = max(self.spill_read, self.reading + n - self.spill_start)
+                if self.spill_read == self.total - self.spill_start:
+                    # the reader caught up: back to the ring (it is empty now)
+                    self.spill_file.close()
+                    self.spill_file = None
+            self.read_index = max(self.read_index, self.reading + n)
+
+    def last_time(self):
+        """ receive time of the newest sample (0 if nothing was received yet) """
+        if self.times is None or self.total == 0:
+            return 0.0
+        if self.spill_file is not None:
+            return self.spill_last_time
+        return float(self.times[(self.total - 1) % self.capacity])
+
+    def next_index(self):
+        """ sample index of the oldest unread sample (the next one if everything was read) """
+        if self.policy == 'drop_oldest':
+            return max(self.read_index, self.total - self.capacity)
+        return self.read_index
+
+    def next_time(self):
+        """ receive time of the oldest unread sample """
+        if self.times is None or self.empty():
+            return 0.0
+        index = self.next_index()
+        with self.spill_lock:
+            if self.spill_file is not None and index >= self.spill_start:
+                size = self.spill_dtype.itemsize
+                self.spill_file.seek((index - self.spill_start) * size)
+                return float(np.frombuffer(self.spill_file.read(size), dtype=self.spill_dtype)['t'][0])
+        return float(self.times[index % self.capacity])
+
+    def clear(self, before=None):
+        """
+        Marks the samples before the sample index 'before' as read (all samples if None).
+        Returns the number of unread samples that were skipped.
+        """
+        with self.spill_lock:
+            end = self.total if before is None else min(before, self.total)
+            skipped = max(0, end - self.next_index())
+            if self.spill_file is not None and end > self.spill_start:
+                self.spill_read = max(self.spill_read, end - self.spill_start)
+                if self.spill_read == self.total - self.spill_start:
+                    self.spill_file.close()
+                    self.spill_file = None
+            self.read_index = max(self.read_index, end)
+        return skipped
+
+    def reset_counters(self):
+        """ reader: the counters start again (the producer's counters are not written here) """
+        self.lost_base = self.dropped + self.overwritten
+        self.peak_reset += 1
+        with self.spill_lock:
+            self.spilled_bytes = 0
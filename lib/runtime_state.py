@@ -0,0 +1,127 @@
+import copy
+import time
+
+
+# runtime state of the recorder as __slots__ objects (instead of dicts with string keys)
+#
+# the osc handlers get a direct reference to the state objects they change (functools.partial in
+# lib/osc_server.py) and use plain attributes: no lock and no dict lookup per sample.
+# all other code can still use them like the old dicts (data['stream']['rec']), unknown keys raise a KeyError.
+#
+# readers that need several values that belong together (eg. the stats line, the sync of the receiver process)
+# use snapshot(). writers that change several values at once do so inside 'with state.changing():'. this works
+# like a seqlock: the sequence number is odd while a change is in progress, snapshot() retries until it read all
+# values without a change in between. there is only one writer per value group, so the writers don't need a lock.
+
+class State:
+
+    __slots__ = ('_seq',)
+    DEFAULTS = {}
+
+    def __init__(self, values=None, **kwargs):
+        self._seq = 0
+        for name, value in self.DEFAULTS.items():
+            setattr(self, name, copy.copy(value))
+        self.update(values or {})
+        self.update(kwargs)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key not in self.DEFAULTS:
+            raise KeyError(f"Cannot set {key}. Only {', '.join(self.DEFAULTS)} are allowed.")
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.DEFAULTS
+
+    def keys(self):
+        return self.DEFAULTS.keys()
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.DEFAULTS]
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.DEFAULTS else default
+
+    def update(self, values):
+        for key, value in dict(values).items():
+            self[key] = value
+
+    def changing(self):
+        return _Change(self)
+
+    def snapshot(self):
+        """ all values as a dict, never a mix of before and after a change """
+        while True:
+            seq = self._seq
+            if seq % 2 == 0:
+                values = {name: getattr(self, name) for name in self.DEFAULTS}
+                if self._seq == seq:
+                    return values
+            time.sleep(0)       # let the writer finish
+
+
+class _Change:
+
+    __slots__ = ('state',)
+
+    def __init__(self, state):
+        self.state = state
+
+    def __enter__(self):
+        self.state._seq += 1
+        return self.state
+
+    def __exit__(self, *exc):
+        self.state._seq += 1
+        return False
+
+
+class Stream_State(State):
+    # which app is streaming and the recording state of the muse app (/muse_metrics)
+    DEFAULTS = {'from_muse_app': 0, 'from_mindmonitor_app': 0, 'last_data_received': 0, 'pause': 0, 'stop': 1,
+                'calibrate': 0, 'rec': 0}
+    __slots__ = tuple(DEFAULTS)
+
+
+class Signal_State(State):
+    # last received signal quality (/hsi, /is_good, mind monitor elements) and drl/ref values
+    DEFAULTS = {'electrode': [4, 4, 4, 4], 'ica_good': 0, 'ica': [0], 'ok': 0, 'blink': 0, 'jaw_clench': 0,
+                'touching_forehead': 0, 'drlref': [0, 0]}
+    __slots__ = tuple(DEFAULTS)
+
+
+class Stats_State(State):
+    # status line (lib/statistics.py) and feedback counters (lib/feedback.py): detector name -> {'fired': cues of
+    # this recording, 'continuous': cues in a row}, feedback_latency: sample -> sound of the last cue,
+    # feedback_delay: sample -> evaluation of the last read samples (seconds), band_power: last estimate
+    # (channels x bands, lib/band_power.py)
+    DEFAULTS = {'refresh_interval': 1, 'cpu': 0, 'cpu_one_core': 0.0, 'nr_cpu_cores': 1, 'battery': None,
+                'feedback': {}, 'feedback_latency': None, 'feedback_delay': None, 'band_power': None,
+                'counter': '-', 'recording': 0, 'rec_start_time': 999999999999, 'pause': False,
+                'process_pointer': None, 'child_pointers': []}
+    __slots__ = tuple(DEFAULTS)
+
+
+class Config(State):
+    # command line options (lib/init_config.py parse_arguments()) and the internal settings of init_conf(),
+    # all values are set in init_conf()
+    DEFAULTS = dict.fromkeys((
+        # command line
+        'only_record_if_signal_is_good', 'if_signal_is_not_good_set_signal_to', 'no_heart_rate_file', 'no_acc_file',
+        'no_signal_quality_file', 'no_ica_file', 'no_drlref_file', 'expand_side_channels', 'add_aux_columns',
+        'use_tabseparator_for_csv', 'add_time_column', 'fill_gaps_with_nan', 'add_header_row', 'port',
+        'split_by_sender', 'max_devices', 'ip', 'file_name_prefix', 'feedback', 'feedback_config',
+        'band_power', 'audio_backend', 'wait_before_starting_new_rec', 'graphs_folder', 'osc_engine', 'runtime', 'buffer_seconds', 'buffer_policy',
+        'format', 'compress_while_recording', 'flush_policy', 'flush_every', 'fsync', 'csv_decimals',
+        'max_latency', 'segment_minutes', 'zip_workers', 'zip_level', 'aligned_file', 'ica_lag',
+        # internal
+        'feedback_seconds', 'feedback_wakeup', 'side_channel_rate', 'wake_fill', 'wakeup', 'exiting', 'shutdown',
+        'ended', 'sampling_rate', 'gap_seconds', 'pause_seconds', 'nod_threshold_magnitude', 'nod_length', 'osc_batch_size',
+    ))
+    __slots__ = tuple(DEFAULTS)
@@ -1,53 +1,80 @@
-import threading
-from queue import Queue
+from lib.runtime_state import Config, Signal_State, Stats_State, Stream_State
+
 
 class Shared_Data:
+    """
+    All state of one device (headband), shared by the osc, writer, stats, feedback and input threads.
+    The entries are set once at startup and never replaced while the threads run, so reading them needs no lock.
+    Stream, signal, stats and conf are __slots__ objects (lib/runtime_state.py).
+    """
+
+    __slots__ = ('buffer', 'side', 'feedback', 'signal', 'stream', 'gate', 'rate', 'columns', 'conf', 'stats',
+                 'file', 'folder', 'source', 'devices', 'receiver')
+
     def __init__(self):
-        self._data = {
-            'buffer': {'eeg': Queue(), 'heart_rate': Queue(), 'acc': Queue(), 'ica': Queue(), 'signal_quality': Queue(), 'drlref': Queue()},
-            'feedback': {'eeg': Queue(), 'heart_rate': Queue(), 'acc': Queue(), 'ica': Queue(), 'signal_quality': Queue(), 'drlref': Queue()},
-            'signal': {'electrode': [4, 4, 4, 4], 'ica_good': 0, 'ok': 0, 'blink':0, 'jaw_clench':0, 'touching_forehead':0, 'drlref':[0,0] },
-            'stream': {'from_muse_app': 0, 'from_mindmonitor_app': 0, 'last_data_received': 0, 'pause': 0, 'stop': 1, 'calibrate': 0, 'rec':0 },
-            'columns': {'eeg': [], 'heart_rate': [], 'acc': [], 'ica': [], 'signal_quality': [], 'drlref': []},
-            'conf': {},
-            'stats': {'refresh_interval': 1, 'cpu': 0, 'cpu_one_core': 0.0, 'nr_cpu_cores': 1, 'battery': None,
-                'moved': '', 'moved_sum': 0, 'moved_continuous': 0, 'counter': '-',  'recording': 0,
-                'rec_start_time':999999999999, 'pause': False },
-            'file': {'name': {}, 'open': {}, 'csv_writer': {}, 'packing': False},
-            'folder': {'out': "out_eeg", 'tmp': '', 'note': []}
-        }
-        self._lock = threading.RLock()
-
-
-    # the following for
+        # ring buffers (lib/ring_buffer.py), created in init_conf() once the columns are known
+        self.buffer = {'eeg': None, 'heart_rate': None, 'acc': None}
+        # signal_quality, ica and drlref are stored as change events (lib/side_channels.py), created in init_conf()
+        self.side = {'signal_quality': None, 'ica': None, 'drlref': None}
+        # samples for the feedback detectors (--feedback, lib/feedback.py), ring buffers created in init_conf() for the
+        # streams the detectors need (None otherwise)
+        self.feedback = {'eeg': None, 'acc': None}
+        self.signal = Signal_State()
+        self.stream = Stream_State()
+        self.gate = None        # lib/signal_gate.py, created in init_conf()
+        self.rate = {'eeg': None, 'heart_rate': None, 'acc': None}     # lib/rate_monitor.py, created in init_conf()
+        self.columns = {'eeg': [], 'heart_rate': [], 'acc': [], 'ica': [], 'signal_quality': [], 'drlref': []}
+        self.conf = Config()
+        self.stats = Stats_State()
+        # packing: closed recordings of this device that the packer (lib/packer.py) has not zipped yet
+        # first_time / last_time: receive time (time.monotonic()) of the first and last eeg sample in the file
+        # rows: eeg rows written, segments: (sample index, samples, first row) of the eeg blocks of the last write,
+        # side_from / side_last: eeg sample index and value of the last written side channel change
+        # lost: buffer overflows already reported per stream
+        # row_format: '%' format of one row per file, throughput: rows / bytes written per file (lib/throughput.py)
+        # zip: the zip file that is written while recording (--compress_while_recording, lib/zip_stream.py)
+        # start_time: unix time of the first eeg sample, histogram: side channel values per eeg row (lib/manifest.py)
+        # part: the current segment (--segment_minutes), parts: the closed segments with their checksum,
+        # lock: lock file of the tmp folder (lib/recovery.py), pack_seconds: how long packing the last recording took
+        # notes_annotated: notes that are annotations of an edf file already (--format edf / bdf)
+        # aligner: the rows of the aligned file that are not written yet (--aligned_file, lib/alignment.py)
+        self.file = {'name': {}, 'open': {}, 'csv_writer': {}, 'packing': 0, 'first_time': None, 'last_time': None,
+                     'rows': 0, 'segments': [], 'side_from': 0, 'side_last': {}, 'lost': {},
+                     'row_format': {}, 'throughput': {}, 'zip': None, 'start_time': None, 'histogram': {},
+                     'part': None, 'parts': [], 'lock': None, 'pack_seconds': None,
+                     'notes_annotated': 0, 'aligner': None}
+        # prefix: file name prefix of this device (--file_name_prefix + device name if several headbands are recorded)
+        self.folder = {'out': "out_eeg", 'tmp': '', 'note': [], 'prefix': ''}
+        # the headband this data belongs to (name, port it is received on)
+        self.source = {'name': '', 'port': 0}
+        # all devices that are recorded. with only one headband that is the main data itself (lib/devices.py)
+        self.devices = []
+        # receiver process with --runtime multiprocess (lib/multiprocess_runtime.py)
+        self.receiver = None
+
+
+    # the old dict interface: data['buffer'], data['conf'] = ..
     def __getitem__(self, key):
-        with self._lock:
-            if key in self._data:
-                return self._data[key]
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            return None
 
     def __setitem__(self, key, value):
-        with self._lock:
-            if key in self._data:
-                self._data[key] = value
-            else:
-                raise KeyError(f"Cannot set {key}. Only {', '.join(self._data.keys())} are allowed.")
+        if key not in self.__slots__:
+            raise KeyError(f"Cannot set {key}. Only {', '.join(self.__slots__)} are allowed.")
+        setattr(self, key, value)
 
     def append(self, key, value):
-        with self._lock:
-            if key not in self._data:
-                raise KeyError(f"No such dataset: {key}")
-            self._data[key].append(value)
+        if key not in self.__slots__:
+            raise KeyError(f"No such dataset: {key}")
+        getattr(self, key).append(value)
 
     def clear(self, key):
-        with self._lock:
-            if key in self._data:
-                self._data[key].clear()
-            else:
-                raise KeyError(f"No such dataset: {key}")
+        if key in self.__slots__:
+            getattr(self, key).clear()
+        else:
+            raise KeyError(f"No such dataset: {key}")
 
     def set_value(self, key, value):
-        with self._lock:
-            if key in self._data:
-                self._data[key] = value
-            else:
-                raise KeyError(f"Cannot set {key}. Only {', '.join(self._data.keys())} are allowed.")
+        self[key] = value
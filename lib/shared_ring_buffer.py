@@ -0,0 +1,106 @@
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from lib.ring_buffer import Ring_Buffer
+
+
+# Ring_Buffer in shared memory (--runtime multiprocess, see lib/multiprocess_runtime.py)
+#
+# the receiver process appends, the main process (file writer) reads. rows, receive times and the indices
+# (total, read_index, the counters) live in one multiprocessing.shared_memory block, so there is nothing to copy between
+# the processes. same rules as the thread version: one producer, one consumer, total is only increased after the
+# row is copied. the object can be pickled (eg. sent through a multiprocessing.Queue), the copy attaches to the
+# same block by its name. the main process removes all blocks at exit (release()), the resource tracker of
+# multiprocessing removes them if the programm crashed.
+# --buffer_policy spill is not possible across processes (the spill file state would need a lock shared by both),
+# init_streams() uses drop_newest instead.
+
+_HEADER = 9     # int64: total, read_index, writing, dropped, overwritten, lost_base, peak, peak_seen, peak_reset
+
+
+def _header_slot(i):
+    """ attribute of Ring_Buffer stored in the shared header (each one is written by one process only) """
+    def get(self):
+        return int(self._header[i])
+
+    def set(self, value):
+        self._header[i] = value
+
+    return property(get, set)
+
+
+class Shared_Ring_Buffer(Ring_Buffer):
+
+    def __init__(self, columns, capacity, dtype=np.float32, timestamps=False, policy='drop_oldest', spill_folder=None):
+        self.columns = list(columns)
+        self.width = len(self.columns)
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.timestamps = timestamps
+        self.policy = policy
+        self._init_spill()
+        self._init_wakeup()
+        self._init_read()
+
+        size = _HEADER * 8 + capacity * self.width * self.dtype.itemsize
+        if timestamps:
+            size += capacity * 8
+        self.shm = shared_memory.SharedMemory(create=True, size=size)      # new blocks are filled with zeros
+        self._map()
+
+    def _init_spill(self):
+        # never spills, the attributes are only there for the shared methods of Ring_Buffer
+        self.spill_lock = threading.Lock()
+        self.spill_file = None
+        self.spill_start = 0
+        self.spilled_bytes = 0
+
+    def _map(self):
+        buf = self.shm.buf
+        self._header = np.ndarray((_HEADER,), dtype=np.int64, buffer=buf)
+        offset = _HEADER * 8
+        self.times = None
+        if self.timestamps:
+            self.times = np.ndarray((self.capacity,), dtype=np.float64, buffer=buf, offset=offset)
+            offset += self.capacity * 8
+        self.data = np.ndarray((self.capacity, self.width), dtype=self.dtype, buffer=buf, offset=offset)
+
+    total = _header_slot(0)
+    read_index = _header_slot(1)
+    writing = _header_slot(2)
+    dropped = _header_slot(3)
+    overwritten = _header_slot(4)
+    lost_base = _header_slot(5)
+    peak = _header_slot(6)
+    peak_seen = _header_slot(7)
+    peak_reset = _header_slot(8)
+
+    def __getstate__(self):
+        return {'columns': self.columns, 'capacity': self.capacity, 'dtype': self.dtype.str,
+                'timestamps': self.timestamps, 'policy': self.policy, 'name': self.shm.name}
+
+    def __setstate__(self, state):
+        self.columns = state['columns']
+        self.width = len(self.columns)
+        self.capacity = state['capacity']
+        self.dtype = np.dtype(state['dtype'])
+        self.timestamps = state['timestamps']
+        self.policy = state['policy']
+        self._init_spill()
+        self._init_wakeup()     # the wakeup stays in the process that set it
+        self._init_read()
+        # the receiver process shares the resource tracker of the main process, attaching registers the same name again
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self._map()
+
+    def release(self):
+        """
+        Removes the shared memory block once both processes are done with it. the memory stays mapped (and usable)
+        in this process until it exits, so threads that still look at the buffer don't crash.
+        """
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,110 @@
+import bisect
+import csv
+
+import numpy as np
+
+from lib.ring_buffer import Ring_Buffer
+
+
+# signal_quality, ica and drlref (side channels)
+#
+# these values only change a few times per second (/hsi, /is_good at about 10Hz). copying them into every eeg row
+# doubled the size of a recording, so they are stored as change events instead: the osc handler appends
+# (eeg sample index, new value) when the value changed, and the file writer writes one line per change with the
+# row of the eeg file from which on the new value is valid:
+#     eeg_row, tp9, af7, af8, tp10
+# the first line of every file (eeg_row 0) is the value at the start of the recording.
+# expand_side_channel() writes the old layout with one row per eeg row (--expand_side_channels, when zipping).
+
+# side channel -> key in data['signal']
+SIDE_CHANNELS = {'signal_quality': 'electrode', 'ica': 'ica', 'drlref': 'drlref'}
+
+
+class Side_Channel:
+
+    def __init__(self, columns, buffer_eeg, default, capacity, dtype=np.float32, buffer_class=Ring_Buffer):
+        self.columns = list(columns)
+        self.buffer_eeg = buffer_eeg
+        self.integer = np.issubdtype(dtype, np.integer)
+
+        # written by the osc thread. float64 holds the sample index exactly
+        self.events = buffer_class(['sample'] + self.columns, capacity, dtype=np.float64, timestamps=True)
+        self.last = None
+
+        # reader side (file writer): changes that are still needed, sorted by sample index.
+        # the default (initial data['signal'] value) is valid until the first change
+        self.samples = [0]
+        self.values = [self._convert(default)]
+
+    def _convert(self, values):
+        if self.integer:
+            return tuple(int(v) for v in values)
+        return tuple(float(v) for v in values)
+
+    def update(self, values, t):
+        """ osc thread: stores the value if it changed. it is valid from the next eeg sample on """
+        values = tuple(values)
+        if values != self.last:
+            self.last = values
+            self.events.append((self.buffer_eeg.total,) + values, t)
+
+    def _pull(self):
+        while not self.events.empty():
+            start, rows, times = self.events.read()
+            rows = rows.tolist()
+            self.events.advance(len(rows))
+            for row in rows:
+                self.samples.append(int(row[0]))
+                self.values.append(self._convert(row[1:]))
+
+    def value_at(self, sample):
+        """ value that was valid for the eeg sample with this index """
+        self._pull()
+        return self.values[bisect.bisect_right(self.samples, sample) - 1]
+
+    def changes(self, first, end):
+        """ (sample index, value) of all changes after the eeg sample 'first' and before 'end' """
+        self._pull()
+        i = bisect.bisect_right(self.samples, first)
+        j = bisect.bisect_left(self.samples, end)
+        return list(zip(self.samples[i:j], self.values[i:j]))
+
+    def prune(self, before):
+        """ forget changes that are no longer needed (the value at sample index 'before' is kept) """
+        i = bisect.bisect_right(self.samples, before) - 1
+        if i > 0:
+            del self.samples[:i]
+            del self.values[:i]
+
+    def clear(self):
+        """ after a recording: only the value at the next unread eeg sample is kept for the next recording """
+        self._pull()
+        self.prune(self.buffer_eeg.next_index())
+
+
+def expand_side_channel(file_in, file_out, n_rows, csv_delimiter=',', header=False, first_row=0):
+    """
+    Reads the change events of a side channel file (eeg_row, values..) and writes one row per eeg row
+    (n_rows = number of data rows of the eeg file), the layout EegLab needs.
+    first_row: the eeg file is a segment that starts with this row of the recording (--segment_minutes)
+    """
+    reader = csv.reader(file_in, delimiter=csv_delimiter)
+    if header:
+        columns = next(reader, ['eeg_row'])[1:]
+        file_out.write(csv_delimiter.join(columns) + '\r\n')
+
+    changes = {}
+    for line in reader:
+        # several changes for the same row (eg. the rows in between were not recorded): the last one counts
+        changes[int(line[0])] = csv_delimiter.join(line[1:]) + '\r\n'
+
+    rows = sorted(changes)
+    last_row = first_row + n_rows
+    for i, row in enumerate(rows):
+        end = rows[i + 1] if i + 1 < len(rows) else last_row
+        count = min(end, last_row) - max(row, first_row)
+        # long runs of the same value are written in chunks
+        while count > 0:
+            n = min(count, 65536)
+            file_out.write(changes[row] * n)
+            count -= n
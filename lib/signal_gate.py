@@ -0,0 +1,66 @@
+import bisect
+
+import numpy as np
+
+from lib.ring_buffer import Ring_Buffer
+
+
+# state for --only_record_if_signal_is_good
+#
+# the signal is only good if all 4 electrodes have good fit (each is 1) and ica is 1.
+# the state is updated incrementally by the /hsi and /is_good handlers (about 10 times per second) and every
+# change is stored as an event (eeg sample index, good). the file writer builds a boolean mask for a whole block
+# of samples from these events, so the eeg handler itself does not need to look at the signal quality at all.
+
+class Signal_Gate:
+
+    def __init__(self, buffer_eeg, capacity=4096, buffer_class=Ring_Buffer):
+        self.buffer_eeg = buffer_eeg
+        self.good = 0
+
+        # written by the osc thread (Shared_Ring_Buffer if the osc server runs in its own process)
+        self.events = buffer_class(['sample', 'good'], capacity, dtype=np.int64)
+
+        # reader side (file writer): all events that are still needed, sorted by sample index
+        self.samples = [0]
+        self.states = [0]
+
+    def update(self, signal):
+        good = int(signal.ica_good == 1 and sum(signal.electrode) == 4)
+        if good != self.good:
+            self.good = good
+            # the change is valid from the next eeg sample on
+            self.events.append((self.buffer_eeg.total, good))
+
+    def _pull(self):
+        while not self.events.empty():
+            start, rows, times = self.events.read()
+            rows = rows.tolist()
+            self.events.advance(len(rows))
+            for sample, good in rows:
+                self.samples.append(sample)
+                self.states.append(good)
+
+    def mask(self, start, n):
+        """ returns a boolean array for the eeg samples start .. start+n (True = signal was good) """
+        self._pull()
+
+        mask = np.empty(n, dtype=bool)
+        i = bisect.bisect_right(self.samples, start) - 1
+        pos = start
+        state = self.states[i] if i >= 0 else 0
+        i += 1
+        while i < len(self.samples) and self.samples[i] < start + n:
+            mask[pos - start:self.samples[i] - start] = state
+            pos = self.samples[i]
+            state = self.states[i]
+            i += 1
+        mask[pos - start:] = state
+        return mask
+
+    def prune(self, before):
+        """ forget events that are no longer needed (all readers are past sample index 'before') """
+        i = bisect.bisect_right(self.samples, before) - 1
+        if i > 0:
+            del self.samples[:i]
+            del self.states[:i]
@@ -3,6 +3,8 @@ import sys
 
 import psutil
 
+from lib.band_power import BANDS, theta_alpha
+
 
 
 
@@ -30,80 +32,148 @@ def is_run_in_pycharm():
     return 'PYCHARM_HOSTED' in os.environ
 
 
-def get_process_cpu_usage(data):
+def get_process_cpu_usage(data, interval=None):
 
-    """Return the CPU usage percentage of the current process."""
+    """Return the CPU usage percentage of the current process.
+    blocks for 'interval' seconds (default refresh_interval). interval=0 returns the usage since the last call."""
     # process = psutil.Process(os.getpid())
+    if interval is None:
+        interval = data['stats']['refresh_interval']
     data['stats']['cpu_one_core'] = data['stats']['process_pointer'].cpu_percent(
-        interval=data['stats']['refresh_interval'])  # cpu usage averaged over 10 seconds
+        interval=interval or None)  # cpu usage averaged over 10 seconds
+    # + the osc receiver process (--runtime multiprocess)
+    for child in data['stats']['child_pointers']:
+        try:
+            data['stats']['cpu_one_core'] += child.cpu_percent(interval=None)
+        except psutil.Error:
+            pass
     return round(data['stats']['cpu_one_core'] / data['stats']['nr_cpu_cores'], 1)
 
 
-# stats thread
-def start_stats(data):
-
+def init_stats(data):
 
     data['stats']['nr_cpu_cores'] = psutil.cpu_count(logical=True)
     data['stats']['process_pointer'] = psutil.Process(os.getpid())
+    data['stats']['child_pointers'] = data['stats']['process_pointer'].children()
 
-    while True:
 
-        # cpu usage for the complete processor # ({data['stats']['cpu_one_core']}/{data['stats']['nr_cpu_cores']})
-        data['stats']['cpu'] = get_process_cpu_usage(data)
-
-        si = rec = acc = cpu = nod = mem = ''
-        if False:
-            if data['feedback']['acc']:
-                # if False:
-                a = data['feedback']['acc'][-1]
-                x = a['x']
-                y = a['y']
-                z = a['z']
-                acc = f" | {x:<18.16f} {y:<18.16f} {z:<18.16f}"
+# stats thread
+def start_stats(data):
 
+    init_stats(data)
 
-        if True:
-            #cpu = f" | 1cpu: {data['stats']['cpu_one_core']:>4.1f}%"
-            cpu = f" | ∑cpu: {data['stats']['cpu']:>4.1f}%"
+    while not data['conf']['shutdown'].is_set():
 
-        if False:
-            si = f" | signal: {data['signal']['is_good']}"
+        # cpu usage for the complete processor # ({data['stats']['cpu_one_core']}/{data['stats']['nr_cpu_cores']})
+        # waits automatically because of get_process_cpu_usage()
+        data['stats']['cpu'] = get_process_cpu_usage(data)
 
-        if True:
-            if not data['buffer']['eeg'].empty():
-                rec = "rec "
-            else:
-                rec = "wait"
-            if data['file']['packing']:
-                rec = "pack"
+        print_stats(data)
 
-        if True:
-            #m = round(data['stats']['process_pointer'].memory_percent(), 1)
-            mem_info = data['stats']['process_pointer'].memory_info()
-            # Convert bytes to megabytes
-            m = round(mem_info.rss / (1024 ** 2),0)
-            mem = f" | mem: {m:3.0f}MB"
 
-        if data['conf']['feedback_acc']:
-            try:
-                #nod = f" | nod: {data['stats']['nod']:<18.16f}"
-                nod = f" | nod: {data['stats']['moved_sum']} ∞{data['stats']['moved_continuous']}"
+# prints the status line (also used by the asyncio runtime, lib/async_runtime.py)
+def print_stats(data):
 
-            except Exception as e:
-                pass
+    si = rec = acc = cpu = nod = bands = mem = drop = buf = io = pack = ''
+    # consistent copies of the values the other threads change (lib/runtime_state.py)
+    stats = data['stats'].snapshot()
+    if False:
+        if data['feedback']['acc']:
+            # if False:
+            a = data['feedback']['acc'][-1]
+            x = a['x']
+            y = a['y']
+            z = a['z']
+            acc = f" | {x:<18.16f} {y:<18.16f} {z:<18.16f}"
 
 
+    if True:
+        #cpu = f" | 1cpu: {data['stats']['cpu_one_core']:>4.1f}%"
+        cpu = f" | ∑cpu: {stats['cpu']:>4.1f}%"
 
-        # cpu usage, received osc streams, good fit
-        if not data['stats']['pause']:
-            sys.stdout.write(f"\r{data['stats']['counter']} {rec}{cpu}{mem}{acc}{si}{nod} ")
-            sys.stdout.flush()
+    if False:
+        si = f" | signal: {data['signal']['is_good']}"
 
-        if data['stats']['counter'] == '-':
-            data['stats']['counter'] = '+'
+    if True:
+        devices = list(data['devices'])
+        recording = sum(1 for dev in devices if not dev['buffer']['eeg'].empty())
+        if recording > 0:
+            rec = "rec "
         else:
-            data['stats']['counter'] = '-'
-
-        # waits automatically because of get_process_cpu_usage()
-        # time.sleep(data['stats']['refresh_interval'])
-
+            rec = "wait"
+        if any(dev['file']['packing'] for dev in devices):
+            # a closed recording is zipped in the background (lib/packer.py)
+            rec = f"{rec.strip()}+pack"
+        if len(devices) > 1 or data['conf']['split_by_sender']:
+            # several headbands: number of recording devices / all devices
+            rec = f"{rec} {recording}/{len(devices)}"
+
+    if True:
+        #m = round(data['stats']['process_pointer'].memory_percent(), 1)
+        mem_info = data['stats']['process_pointer'].memory_info()
+        # Convert bytes to megabytes
+        m = round(mem_info.rss / (1024 ** 2),0)
+        mem = f" | mem: {m:3.0f}MB"
+
+    if True:
+        # samples lost in udp gaps during this recording (all streams)
+        dropped = sum(rate.dropped for dev in devices for rate in dev['rate'].values())
+        drop = f" | drop: {dropped}"
+
+    if True:
+        # fullest ring buffer (high-water mark since the recording started) and its overflows (--buffer_policy)
+        buffers = [buffer for dev in devices for buffer in dev['buffer'].values()]
+        if buffers:
+            fill = max(100 * buffer.high_water // buffer.capacity for buffer in buffers)
+            buf = f" | buf: {fill}%"
+            lost = sum(buffer.lost for buffer in buffers)
+            if lost > 0:
+                buf += f" lost: {lost}"
+            spilled = sum(buffer.spilled_bytes for buffer in buffers)
+            if spilled > 0:
+                buf += f" spill: {spilled // 1024}kB"
+
+    if True:
+        # bytes written per second to the files of the current recordings (lib/throughput.py)
+        counters = [counter for dev in devices for counter in list(dev['file']['throughput'].values())]
+        if counters:
+            io = f" | io: {sum(counter.bytes_per_second() for counter in counters) / 1024:.1f}kB/s"
+
+    if True:
+        # time it took to zip the last recording (lib/parallel_zip.py)
+        packed = [dev['file']['pack_seconds'] for dev in devices if dev['file']['pack_seconds'] is not None]
+        if packed:
+            pack = f" | pack: {max(packed):.1f}s"
+
+    if data['conf']['feedback']:
+        try:
+            # cues of this recording and in a row per detector, time from the newest sample to its evaluation and
+            # from the sample that fired to the sound of the last cue (lib/feedback.py)
+            for s in (dev['stats'].snapshot() for dev in devices):
+                nod += " | " + " ".join(f"{name}: {c['fired']} ∞{c['continuous']}" for name, c in list(s['feedback'].items()))
+                if s['feedback_delay'] is not None:
+                    nod += f" fb: {s['feedback_delay'] * 1000:.0f}ms"
+                if s['feedback_latency'] is not None:
+                    nod += f" cue: {s['feedback_latency'] * 1000:.0f}ms"
+
+        except Exception as e:
+            pass
+
+    if data['conf']['band_power']:
+        # theta / alpha ratio and the band powers (uV^2) of the last estimate, mean over the channels (lib/band_power.py)
+        for estimate in (dev['stats']['band_power'] for dev in devices):
+            if estimate is not None:
+                mean = estimate.mean(axis=0)
+                bands += f" | θ/α: {theta_alpha(estimate):.2f} (" + " ".join(f"{name[0]}{power:.0f}" for name, power in zip(BANDS, mean)) + ")"
+
+
+
+    # cpu usage, received osc streams, good fit
+    if not stats['pause']:
+        sys.stdout.write(f"\r{stats['counter']} {rec}{cpu}{mem}{drop}{buf}{io}{pack}{acc}{si}{nod}{bands} ")
+        sys.stdout.flush()
+
+    if data['stats']['counter'] == '-':
+        data['stats']['counter'] = '+'
+    else:
+        data['stats']['counter'] = '-'
@@ -0,0 +1,58 @@
+import time
+
+
+# rows and bytes written to one file of a recording (lib/record_to_file.py), and for the sample streams the receive
+# time of the first / last written sample and the rows with NaN values (lib/manifest.py).
+#
+# bytes_per_second / rows_per_second are measured over the time since the first sample of the recording was
+# received (start, time.monotonic(): what the recording produces), write_seconds is the time spent formatting
+# and writing (what it costs). both end up in throughput.csv in the zip file, the status line shows the sum
+# of all streams.
+
+class Throughput_Counter:
+
+    def __init__(self, start=None):
+        self.start = time.monotonic() if start is None else start
+        self.rows = 0
+        self.bytes = 0
+        self.write_seconds = 0.0
+        self.first_time = None
+        self.last_time = None
+        self.nan_rows = 0
+
+        # --flush_policy: rows and time of the last flush
+        self.flushed_rows = 0
+        self.flushed_time = time.monotonic()
+
+    def add(self, rows, n_bytes, seconds):
+        self.rows += rows
+        self.bytes += n_bytes
+        self.write_seconds += seconds
+
+    def samples(self, times, nan_rows):
+        """ receive times and number of NaN rows of a written block of samples """
+        if self.first_time is None:
+            self.first_time = float(times[0])
+        self.last_time = float(times[-1])
+        self.nan_rows += nan_rows
+
+    def elapsed(self):
+        return max(time.monotonic() - self.start, 1e-9)
+
+    def bytes_per_second(self):
+        return self.bytes / self.elapsed()
+
+    def rows_per_second(self):
+        return self.rows / self.elapsed()
+
+    def flush_due(self, policy, every):
+        """ True if the file should be flushed now (--flush_policy seconds / samples, never for rotation) """
+        if policy == 'seconds':
+            return time.monotonic() - self.flushed_time >= every
+        if policy == 'samples':
+            return self.rows - self.flushed_rows >= every
+        return False
+
+    def flushed(self):
+        self.flushed_rows = self.rows
+        self.flushed_time = time.monotonic()
@@ -0,0 +1,60 @@
+import asyncio
+import threading
+
+
+# wakes up the file writer (lib/record_to_file.py process_buffers(), lib/async_runtime.py writer_task())
+#
+# the writer used to sleep 10s between two writes, so up to 10s of data were only in memory and a stopped stream
+# was noticed up to 10s late. now it sleeps until its next write is due (next_write_delay(): --max_latency after
+# the last write, or when a recording times out: receive time of its last eeg sample + --wait_before_starting_new_rec)
+# and is woken up earlier by
+#   - the ring buffers (osc handlers): a buffer is filled up to 'wake_fill' of its capacity, or while nothing is
+#     recorded (idle) the first eeg sample arrives
+#   - gracefully_end(): exiting
+#
+# the producers only call set() when a threshold is crossed and the event is not set yet, nothing happens per
+# sample otherwise. --runtime multiprocess: the buffers are filled in the receiver process, the sync thread of the
+# main process checks them whenever the receiver sends its state (every 0.25s, check()).
+#
+# the feedback engine (lib/feedback.py) has its own one (conf 'feedback_wakeup'), set by its buffers when new samples
+# arrive.
+
+class Writer_Wakeup:
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.loop = None
+        self.loop_thread = None
+        self.idle = True        # no recording open, set by the writer before it waits
+
+    def use_asyncio(self):
+        """ --runtime asyncio: the writer task waits in the event loop (called in the loop before the osc servers start) """
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.event = asyncio.Event()
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def set(self):
+        if self.loop is None or threading.get_ident() == self.loop_thread:
+            self.event.set()
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    def check(self, buffers):
+        """ sets the event if a buffer reached its threshold (buffers that are filled by another process) """
+        if any(buffer.wake_due() for buffer in buffers):
+            self.set()
+
+    def wait(self, timeout):
+        """ threads: blocks until set() or timeout seconds """
+        self.event.wait(timeout)
+        self.event.clear()
+
+    async def wait_async(self, timeout):
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.event.clear()
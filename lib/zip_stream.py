@@ -0,0 +1,183 @@
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+
+
+# zip file that is written while recording (--compress_while_recording)
+#
+# the normal way (close_and_zip_files()) writes plain csv files into a tmp folder and deflates them into a zip
+# file when the recording ends, which reads everything a second time (about half a minute per hour of eeg on
+# a phone). here every file of the recording is deflated while it is written:
+#
+#   direct member (the eeg file): its compressed data goes straight into the zip file, the sizes and crc follow
+#     in a data descriptor when it is closed (zip flag bit 3, like a zip written to a pipe)
+#   other members (heart rate, acc, side channels): a zip member has to be contiguous, so their compressed data
+#     is collected in a temporary file (in memory while small) and copied behind the direct member on close.
+#     they are about 5% of the eeg data
+#
+# closing only copies already compressed bytes and writes the central directory. Zip_Member can be used like
+# the open csv file (write(), flush(), fileno() for --fsync, close()). lib/parallel_zip.py uses direct members
+# for data that is deflated in other processes (write_deflated()).
+#
+# no zip64 support: a member must stay below 4GB (about 2 days of eeg csv).
+
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+DATA_DESCRIPTOR = struct.Struct('<4sLLL')
+CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+END_OF_CENTRAL_DIR = struct.Struct('<4s4H2LH')
+
+ZIP_VERSION = 20                # deflate
+FLAG_DATA_DESCRIPTOR = 0x08
+METHOD_DEFLATED = 8
+SPOOL_BYTES = 4 * 1024 * 1024   # compressed bytes of a member kept in memory before using a temporary file
+
+
+def dos_date_time(t=None):
+    t = time.localtime(t)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class Zip_Member:
+
+    def __init__(self, zip_stream, name, direct, encoding='utf-8'):
+        self.zip = zip_stream
+        self.name = name
+        self.direct = direct
+        self.encoding = encoding
+        self.compressor = zlib.compressobj(zip_stream.level, zlib.DEFLATED, -15)
+        self.crc = 0
+        self.size = 0               # uncompressed bytes
+        self.compressed = 0
+        self.closed = False
+        self.discarded = False
+        self.dos_time, self.dos_date = dos_date_time()
+
+        if direct:
+            self.offset = zip_stream.file.tell()
+            zip_stream.write_local_header(self, FLAG_DATA_DESCRIPTOR)
+            self.out = zip_stream.file
+        else:
+            self.offset = None
+            self.out = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+
+    def write(self, text):
+        raw = text.encode(self.encoding)
+        self.crc = zlib.crc32(raw, self.crc)
+        self.size += len(raw)
+        self._out(self.compressor.compress(raw))
+        return len(text)
+
+    def write_deflated(self, compressed, raw):
+        """ raw deflated elsewhere (without a final block, eg. ending with a sync flush) """
+        self.crc = zlib.crc32(raw, self.crc)
+        self.size += len(raw)
+        self._out(compressed)
+
+    def _out(self, compressed):
+        if compressed:
+            self.out.write(compressed)
+            self.compressed += len(compressed)
+
+    def flush(self):
+        # direct member: everything written so far can be decompressed from the zip file (eg. after a crash)
+        if self.direct and not self.closed:
+            self._out(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.out.flush()
+
+    def fileno(self):
+        return self.zip.file.fileno()
+
+    def close(self):
+        if self.closed:
+            return
+        self._out(self.compressor.flush())
+        self.closed = True
+        if self.direct:
+            self.out.write(DATA_DESCRIPTOR.pack(b'PK\x07\x08', self.crc, self.compressed, self.size))
+            self.zip.direct = None
+        self.zip.check_size(self)
+
+    def text(self):
+        """ the uncompressed content of a closed, not direct member (eg. to expand the side channels) """
+        self.out.seek(0)
+        return zlib.decompress(self.out.read(), -15).decode(self.encoding)
+
+    def discard(self):
+        """ a closed, not direct member that is not added to the zip file """
+        self.discarded = True
+
+
+class Zip_Stream:
+
+    def __init__(self, path, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.path = path
+        self.level = level
+        self.file = open(path, 'wb')
+        self.members = []           # in the order of the central directory
+        self.pending = []           # closed members that are not in the zip file yet
+        self.direct = None
+
+    def open_member(self, name, direct=False):
+        """ only one direct member can be open at a time, the others are collected until close() """
+        if direct and self.direct is not None:
+            raise ValueError(f'zip member {self.direct.name} is still written')
+        member = Zip_Member(self, name, direct)
+        if direct:
+            self.direct = member
+            self.members.append(member)
+        else:
+            self.pending.append(member)
+        return member
+
+    def write_member(self, name, text):
+        """ a small file that is complete (notes, channel locations, ..) """
+        member = self.open_member(name, direct=True)
+        member.write(text)
+        member.close()
+
+    def write_local_header(self, member, flags):
+        name = member.name.encode('utf-8')
+        self.file.write(LOCAL_HEADER.pack(b'PK\x03\x04', ZIP_VERSION, 0, flags, METHOD_DEFLATED,
+                                          member.dos_time, member.dos_date, member.crc if not flags else 0,
+                                          member.compressed if not flags else 0, member.size if not flags else 0,
+                                          len(name), 0))
+        self.file.write(name)
+
+    def check_size(self, member):
+        if member.size >= 0xFFFFFFFF or member.compressed >= 0xFFFFFFFF:
+            raise ValueError(f'zip member {member.name} is too big (more than 4GB)')
+
+    def close(self):
+        if self.direct is not None:
+            self.direct.close()
+
+        # the collected members, their sizes are known now
+        for member in self.pending:
+            member.close()
+            if member.discarded:
+                member.out.close()
+                continue
+            member.offset = self.file.tell()
+            self.write_local_header(member, 0)
+            member.out.seek(0)
+            shutil.copyfileobj(member.out, self.file)
+            member.out.close()
+            self.members.append(member)
+        self.pending = []
+
+        directory_offset = self.file.tell()
+        for member in self.members:
+            name = member.name.encode('utf-8')
+            flags = FLAG_DATA_DESCRIPTOR if member.direct else 0
+            self.file.write(CENTRAL_HEADER.pack(b'PK\x01\x02', ZIP_VERSION, 3, ZIP_VERSION, 0, flags, METHOD_DEFLATED,
+                                                member.dos_time, member.dos_date, member.crc, member.compressed,
+                                                member.size, len(name), 0, 0, 0, 0, 0o644 << 16, member.offset))
+            self.file.write(name)
+        directory_size = self.file.tell() - directory_offset
+        if directory_offset + directory_size >= 0xFFFFFFFF:
+            raise ValueError(f'{self.path} is too big (more than 4GB)')
+        self.file.write(END_OF_CENTRAL_DIR.pack(b'PK\x05\x06', 0, 0, len(self.members), len(self.members),
+                                                directory_size, directory_offset, 0))
+        self.file.close()
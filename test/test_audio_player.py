@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+
+import pytest
+
+from lib.audio_player import Audio_Player, Stub_Backend
+from lib.feedback import Feedback_Rule
+
+
+WOLF = 'audio/wolf.mp3'
+OWL = 'audio/boreal_owl.mp3'
+
+
+def wait_until(condition, timeout=2.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, 'timed out'
+        time.sleep(0.005)
+
+
+class Blocking_Backend(Stub_Backend):
+    """ play() waits for release, so the cues after it stay queued """
+
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def play(self, path, volume):
+        super().play(path, volume)
+        self.release.wait(2)
+        return True
+
+
+@pytest.fixture
+def player():
+    players = []
+
+    def create(backend, sounds=(WOLF, OWL)):
+        players.append(Audio_Player(backend, sounds))
+        return players[-1]
+
+    yield create
+    for p in players:
+        p.close()
+
+
+def test_stub_plays_every_cue_after_the_sound_ended(player):
+    backend = Stub_Backend()
+    audio = player(backend)
+    for i in range(3):
+        audio.cue(WOLF)
+        wait_until(lambda: len(backend.played) == i + 1)
+    assert audio.merged == 0
+    assert backend.playing() is None
+
+
+def test_queue_plays_in_order_and_merges_queued_cues(player):
+    backend = Blocking_Backend()
+    audio = player(backend)
+    audio.cue(WOLF, 50)
+    wait_until(lambda: len(backend.played) == 1)
+    audio.cue(OWL, 40)
+    audio.cue(OWL, 70)
+    audio.cue(OWL, 60)
+    assert audio.merged == 2
+    backend.release.set()
+    wait_until(lambda: len(backend.played) == 2)
+    assert [(os.path.basename(path), volume) for path, volume, t in backend.played] == \
+        [('wolf.mp3', 50), ('boreal_owl.mp3', 70)]
+
+
+def test_cue_of_the_playing_sound_raises_its_volume(player):
+    backend = Stub_Backend(duration=60)
+    audio = player(backend)
+    audio.cue(WOLF, 50)
+    wait_until(lambda: len(backend.played) == 1)
+    audio.cue(WOLF, 30)
+    wait_until(lambda: audio.merged == 1)
+    assert backend.volume == 50
+    audio.cue(WOLF, 80)
+    wait_until(lambda: audio.merged == 2)
+    assert backend.volume == 80
+    assert len(backend.played) == 1
+
+
+def test_latency_is_reported_from_the_cued_sample(player):
+    backend = Stub_Backend()
+    audio = player(backend)
+    reported = []
+    audio.cue(WOLF, since=time.monotonic() - 1.0, done=reported.append)
+    wait_until(lambda: reported)
+    assert 1.0 <= reported[0] < 2.0
+    assert len(audio.latencies) == 1 and 0 <= audio.latencies[0] < 1.0
+
+
+def rule(**settings):
+    settings = dict({'begin_after': 0, 'cooldown': 0, 'reset_after': 60,
+                     'ladder': [(0, WOLF, 40), (2, OWL, 70), (4, WOLF, 100)]}, **settings)
+    return Feedback_Rule(settings, {'fired': 0, 'continuous': 0})
+
+
+def test_rule_escalates_along_the_ladder():
+    r = rule()
+    assert [r.update(True, 0) for i in range(5)] == \
+        [(WOLF, 40), (WOLF, 40), (OWL, 70), (OWL, 70), (WOLF, 100)]
+    assert r.counters == {'fired': 5, 'continuous': 5}
+
+
+def test_rule_starts_the_ladder_again_after_reset_after():
+    r = rule(reset_after=0)
+    r.update(True, 0)
+    r.update(True, 0)
+    assert r.update(False, 0) is None
+    assert r.counters['continuous'] == 0
+    assert r.update(True, 0) == (WOLF, 40)
+
+
+def test_rule_waits_for_begin_after_and_cooldown():
+    r = rule(begin_after=3600)
+    assert r.update(True, time.time()) is None
+    r = rule(cooldown=60)
+    assert r.update(True, 0) == (WOLF, 40)
+    assert r.update(True, 0) is None
+    assert r.counters['fired'] == 1
@@ -0,0 +1,39 @@
+import numpy as np
+
+from lib.edf_format import Edf_File, read_edf_bytes
+
+
+STREAMS = [('eeg', ['tp9', 'af7', 'af8', 'tp10'], 256), ('heart_rate', ['ppg1', 'ppg2', 'ppg3'], 64),
+           ('acc', ['x', 'y', 'z'], 52)]
+
+
+def write_edf(path, rows, kind='edf'):
+    edf = Edf_File(str(path), STREAMS, start_time=1700000000.0, kind=kind)
+    for name, count in rows.items():
+        width = len(dict((n, c) for n, c, r in STREAMS)[name])
+        edf.streams[name].append(np.full((count, width), 0.5))
+    for stream in edf.streams.values():
+        stream.close()
+    with open(path, 'rb') as f:
+        return read_edf_bytes(f.read())
+
+
+def annotation(annotations, name):
+    return [text for onset, duration, text in annotations if text.startswith(f"{name}:")]
+
+
+def test_padding_of_the_last_records_is_annotated(tmp_path):
+    streams, annotations = write_edf(tmp_path / 'rec.edf', {'eeg': 1000, 'acc': 200})
+    assert len(streams['eeg'][1]) == 1024
+    assert len(streams['heart_rate'][1]) == 256
+    assert len(streams['acc'][1]) == 208
+    assert annotation(annotations, 'eeg') == ['eeg: 24 samples padded, 0 dropped']
+    assert annotation(annotations, 'heart_rate') == ['heart_rate: 256 samples padded, 0 dropped']
+    assert annotation(annotations, 'acc') == ['acc: 8 samples padded, 0 dropped']
+
+
+def test_complete_records_have_no_stream_annotation(tmp_path):
+    streams, annotations = write_edf(tmp_path / 'rec.bdf', {'eeg': 512, 'heart_rate': 128, 'acc': 104}, kind='bdf')
+    assert [len(samples) for columns, samples in streams.values()] == [512, 128, 104]
+    assert not [text for onset, duration, text in annotations if text != 'recording end']
+    assert np.allclose(streams['acc'][1], 0.5, atol=1e-3)
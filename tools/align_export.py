@@ -0,0 +1,107 @@
+import argparse
+import concurrent.futures
+import os
+import sys
+import time
+
+import numpy as np
+
+# run from the script folder or from tools/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib.alignment import align_recording
+from lib.archive_reader import find_files, is_up_to_date, load_recording, output_path, unique_outputs
+
+
+# exports recordings as one time aligned table: one row per eeg row with heart rate and acc resampled to it and
+# signal_quality, ica and drlref filled in (lib/alignment.py), for zip files of the recorder or their .npz files
+# (tools/zip_to_npz.py)
+#
+#   python tools/align_export.py osc_out                 -> osc_out/eeg_2024.10.18_11.06_12min_aligned.npz, ..
+#   python tools/align_export.py osc_out --csv --ica_lag 1.2
+#
+# the .npz file holds 'aligned' (rows x columns, float32) and 'columns'. the receive times are used if the
+# recording has them (--add_time_column), otherwise the nominal sampling rates from the first eeg sample on.
+# recordings whose export is newer are skipped (--force exports them again).
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Export recordings as one table aligned to the eeg rows.')
+    parser.add_argument('paths', nargs='+',
+                        help='zip files, .npz files of tools/zip_to_npz.py or folders')
+    parser.add_argument('--out', type=str, default=None,
+                        help='Folder for the exported files (with the subfolders of the searched folders). Default: next to the recording.')
+    parser.add_argument('--csv', action='store_true',
+                        help='Write a csv file (with a header row) instead of a .npz file.')
+    parser.add_argument('--method', type=str, default='linear', choices=['linear', 'previous'],
+                        help='Default "linear". Heart rate and acc at an eeg row: interpolated between the samples around it, or the last sample before it.')
+    parser.add_argument('--ica_lag', type=float, default=1.0,
+                        help='Default 1.0. Seconds the ica values arrive after the eeg they belong to, they are moved back by this.')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Default 0: one per cpu core. Number of processes that export recordings.')
+    parser.add_argument('--force', action='store_true',
+                        help='Also export recordings whose export is up to date.')
+    return parser.parse_args()
+
+
+def export_path(path, folder, out, csv):
+    name = os.path.splitext(os.path.basename(path))[0] + ('_aligned.csv' if csv else '_aligned.npz')
+    return output_path(path, folder, out, name)
+
+
+def export(path, out_path, csv, method, ica_lag):
+    """ runs in a worker process. returns (rows, seconds) """
+    start = time.monotonic()
+    meta, arrays = load_recording(path)
+    if 'eeg' not in arrays:
+        raise ValueError('the recording has no eeg')
+    columns, table = align_recording(meta, arrays, lags={'ica': ica_lag}, method=method)
+
+    # written under another name first, an interrupted export doesn't look up to date
+    part = out_path + '.part'
+    os.makedirs(os.path.dirname(part) or '.', exist_ok=True)
+    with open(part, 'wb') as f:
+        if csv:
+            np.savetxt(f, table, fmt='%.6g', delimiter=',', header=','.join(columns), comments='')
+        else:
+            np.savez(f, aligned=table.astype(np.float32), columns=np.array(columns))
+    os.replace(part, out_path)
+    return len(table), time.monotonic() - start
+
+
+def main():
+    args = parse_arguments()
+    if args.out is not None:
+        os.makedirs(args.out, exist_ok=True)
+
+    # export path -> recordings, the .npz file of a zip file is read instead of it (faster)
+    recordings = {}
+    for path, folder in find_files(args.paths, ('.zip', '.npz')):
+        if path.endswith('_aligned.npz'):
+            continue
+        recordings.setdefault(export_path(path, folder, args.out, args.csv), []).append(path)
+    jobs = []
+    for out_path, paths in recordings.items():
+        npz = [path for path in paths if path.endswith('.npz')]
+        jobs += [(path, out_path) for path in (npz or paths)]
+    jobs = [(path, out_path) for path, out_path in unique_outputs(jobs)
+            if args.force or not is_up_to_date(path, out_path)]
+    print(f' {len(jobs)} recordings to export.')
+
+    start = time.monotonic()
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(args.workers or os.cpu_count() or 1) as pool:
+        futures = {pool.submit(export, path, out_path, args.csv, args.method, args.ica_lag): out_path
+                   for path, out_path in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                rows, seconds = future.result()
+                print(f' {futures[future]} saved ({rows} rows, {seconds:.1f}s).')
+            except Exception as e:
+                failed += 1
+                print(f' {futures[future]}: could not be exported.. \n', e)
+    print(f' done in {time.monotonic() - start:.1f}s' + (f', {failed} failed.' if failed else '.'))
+
+
+if __name__ == '__main__':
+    main()
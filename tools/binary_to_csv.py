@@ -0,0 +1,75 @@
+import argparse
+import io
+import os
+import sys
+import zipfile
+
+# run from the script folder or from tools/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib.binary_format import read_binary, read_binary_bytes, export_csv
+
+
+# converts recordings of --format binary to the csv files of --format csv (eg. for EegLab)
+#
+#   python tools/binary_to_csv.py osc_out/eeg_2024.10.18_11.06_12min.zip   -> eeg_2024.10.18_11.06_12min_csv.zip
+#   python tools/binary_to_csv.py eeg_2024.10.18_11.06_eeg.bin             -> eeg_2024.10.18_11.06_eeg.csv
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Convert --format binary recordings (.bin or zip files) to csv.')
+    parser.add_argument('files', nargs='+',
+                        help='zip files of the recorder or single .bin files')
+    parser.add_argument('--use_tabseparator_for_csv', action='store_true',
+                        help='Use a tab instead of a comma (like the recorder option).')
+    parser.add_argument('--add_header_row', action='store_true',
+                        help='Add the column names as first row (like the recorder option).')
+    parser.add_argument('--csv_decimals', type=int, default=None,
+                        help='Number of decimals (like the recorder option). Default: full precision.')
+    return parser.parse_args()
+
+
+def convert_zip(path, args, csv_delimiter):
+    """ copies the zip file, every .bin file is replaced by its csv file """
+    out_path = path[:-len('.zip')] + '_csv.zip'
+    with zipfile.ZipFile(path) as zip_in, zipfile.ZipFile(out_path, 'w', zipfile.ZIP_DEFLATED) as zip_out:
+        for member in zip_in.namelist():
+            if not member.endswith('.bin'):
+                zip_out.writestr(member, zip_in.read(member))
+                continue
+            header, samples = read_binary_bytes(zip_in.read(member))
+            with zip_out.open(member[:-len('.bin')] + '.csv', 'w') as raw_out:
+                file_out = io.TextIOWrapper(raw_out, newline='')
+                export_csv(header, samples, file_out, csv_delimiter=csv_delimiter,
+                           add_header_row=args.add_header_row, decimals=args.csv_decimals)
+                file_out.flush()
+                file_out.detach()
+    return out_path
+
+
+def convert_bin(path, args, csv_delimiter):
+    out_path = path[:-len('.bin')] + '.csv'
+    header, samples = read_binary(path)
+    with open(out_path, 'w', newline='') as file_out:
+        export_csv(header, samples, file_out, csv_delimiter=csv_delimiter,
+                   add_header_row=args.add_header_row, decimals=args.csv_decimals)
+    return out_path
+
+
+def main():
+    args = parse_arguments()
+    csv_delimiter = '\t' if args.use_tabseparator_for_csv else ','
+
+    for path in args.files:
+        if path.endswith('.zip'):
+            out_path = convert_zip(path, args, csv_delimiter)
+        elif path.endswith('.bin'):
+            out_path = convert_bin(path, args, csv_delimiter)
+        else:
+            print(f' {path}: not a .zip or .bin file, skipped')
+            continue
+        print(f' {out_path} saved.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# run from the script folder or from tools/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib.archive_reader import find_files, is_up_to_date, output_path, read_recording, unique_outputs
+
+
+# converts the zip files of the recorder (csv or --format binary) to numpy .npz files, so analysis scripts load a
+# recording with one np.load() instead of parsing its csv files every time
+#
+#   python tools/zip_to_npz.py osc_out                  -> osc_out/eeg_2024.10.18_11.06_12min.npz, ..
+#   python tools/zip_to_npz.py osc_out --out osc_npz --workers 4   -> osc_npz/<subfolder in osc_out>/..npz
+#
+# the zip files are converted by a pool of processes, the members are parsed while they are decompressed (nothing
+# is extracted). a zip file whose .npz file is newer is skipped (--force converts it again). the .npz file holds
+# the arrays of lib/archive_reader.py and 'meta' (json text: columns, files, manifest.json, ..):
+#
+#   npz = np.load('eeg_2024.10.18_11.06_12min.npz')
+#   eeg = npz['eeg']
+#   meta = json.loads(str(npz['meta']))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Convert the zip files of the recorder to numpy .npz files.')
+    parser.add_argument('paths', nargs='+',
+                        help='zip files or folders (all zip files in them and their subfolders)')
+    parser.add_argument('--out', type=str, default=None,
+                        help='Folder for the .npz files (with the subfolders of the searched folders). Default: next to the zip file.')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Default 0: one per cpu core. Number of processes that convert zip files.')
+    parser.add_argument('--compress', action='store_true',
+                        help='Deflate the arrays in the .npz file (smaller, slower to load).')
+    parser.add_argument('--force', action='store_true',
+                        help='Also convert zip files whose .npz file is up to date.')
+    return parser.parse_args()
+
+
+def npz_path(path, folder, out):
+    return output_path(path, folder, out, os.path.basename(path)[:-len('.zip')] + '.npz')
+
+
+def convert(path, out_path, compress=False):
+    """ runs in a worker process. returns (eeg rows, seconds) """
+    start = time.monotonic()
+    meta, arrays = read_recording(path)
+    arrays['meta'] = np.array(json.dumps(meta))
+    # written under another name first, an interrupted conversion doesn't leave a .npz file that looks up to date
+    part = out_path + '.part'
+    os.makedirs(os.path.dirname(part) or '.', exist_ok=True)
+    with open(part, 'wb') as f:
+        (np.savez_compressed if compress else np.savez)(f, **arrays)
+    os.replace(part, out_path)
+    return meta['streams'].get('eeg', {}).get('rows', 0), time.monotonic() - start
+
+
+def main():
+    args = parse_arguments()
+    if args.out is not None:
+        os.makedirs(args.out, exist_ok=True)
+
+    jobs = []
+    for path, folder in find_files(args.paths):
+        jobs.append((path, npz_path(path, folder, args.out)))
+    jobs = [(path, out_path) for path, out_path in unique_outputs(jobs)
+            if args.force or not is_up_to_date(path, out_path)]
+    print(f' {len(jobs)} zip files to convert.')
+
+    start = time.monotonic()
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(args.workers or os.cpu_count() or 1) as pool:
+        futures = {pool.submit(convert, path, out_path, args.compress): out_path for path, out_path in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                rows, seconds = future.result()
+                print(f' {futures[future]} saved ({rows} eeg rows, {seconds:.1f}s).')
+            except Exception as e:
+                failed += 1
+                print(f' {futures[future]}: could not be converted.. \n', e)
+    print(f' done in {time.monotonic() - start:.1f}s' + (f', {failed} failed.' if failed else '.'))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,16 @@
-
-
+import asyncio
 import threading
 
 import os
-import time
 
 
-from lib.feedback import feedback_acc_start
+from lib.async_runtime import run_async
+from lib.devices import init_devices, start_osc_threads
+from lib.feedback import feedback_start
 from lib.init_config import init_conf
 from lib.input_handler import start_input
-from lib.osc_server import osc_start
-from lib.record_to_file import process_buffers, gracefully_end
+from lib.multiprocess_runtime import Receiver_Process
+from lib.record_to_file import process_buffers, gracefully_end, recover_orphans
 from lib.shared_data import Shared_Data
 from lib.statistics import start_stats, is_run_in_pycharm
 from lib.web_server import start_web_server
@@ -21,44 +21,54 @@ def main():
 
     data = Shared_Data()
     init_conf(data)
+    init_devices(data)
+
+    # --runtime multiprocess: the osc receiver process is started first (before any thread is running)
+    if data['conf']['runtime'] == 'multiprocess':
+        data['receiver'] = Receiver_Process(data)
+        data['receiver'].start()
+
+    # recordings a killed recorder left behind are packed in the background
+    recover_orphans(data)
 
     server_folder = data['conf']['graphs_folder']
     create_folder(server_folder)
     web_server_thread = threading.Thread(target=start_web_server, args=(server_folder,), daemon=True)
     web_server_thread.start()
 
-    stats_thread = threading.Thread(target=start_stats, args=(data,), daemon=True)
-    stats_thread.start()
-
     # pycharm has problems with the input.. works great in termux
     #if not is_run_in_pycharm():
     # if False:
     input_thread = threading.Thread(target=start_input, args=(data,), daemon=True)
     input_thread.start()
 
+    if data['conf']['runtime'] == 'asyncio':
+        # osc server, writer, stats and feedback in one event loop (lib/async_runtime.py)
+        try:
+            asyncio.run(run_async(data))
+        except KeyboardInterrupt:
+            pass
+        gracefully_end(data)
+        return
+
+    stats_thread = threading.Thread(target=start_stats, args=(data,), daemon=True)
+    stats_thread.start()
+
     # Starting the separate thread  for writing to file
     write_thread = threading.Thread(target=process_buffers, args=(data,))
     write_thread.start()
 
-     # Starting the separate thread  for writing to file
-    osc_thread = threading.Thread(target=osc_start, args=(data,), daemon=True)
-    osc_thread.start()
-
-    # if data['conf']['feedback_acc']:
-    #      # Starting the separate thread  for writing to file
-    #     feedback_thread = threading.Thread(target=feedback_acc_start, args=(data,), daemon=True)
-    #     feedback_thread.start()
+    # Starting the separate thread(s) for receiving the osc stream: one receiver per port / headband
+    if data['conf']['runtime'] == 'threads':
+        start_osc_threads(data)
 
+    # the feedback engine (--feedback) runs in the main thread until the programm is exiting (ctrl+c here, or x in
+    # the input thread)
     try:
-        while True:
-            feedback_acc_start(data)
-            time.sleep(0.2)
+        feedback_start(data)
     except KeyboardInterrupt:
-        gracefully_end(data)
-
-
-    finally:
         pass
+    gracefully_end(data)
 
 
 